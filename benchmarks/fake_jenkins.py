@@ -0,0 +1,371 @@
+"""
+A fake Jenkins server to run the benchmarks against.
+
+It only emulates the parts of the Jenkins API that the launcher uses (the
+crumb issuer, job parameters, build triggers, queue items, pipeline status
+and build logs), but sends responses of realistic sizes, and counts the
+requests and bytes it serves.
+
+Builds spend `queue_time` seconds in the queue and `build_time` seconds
+running, and their log is `log_size` bytes long. Logs are generated as they
+are sent, so they can be as big as needed.
+"""
+import json
+import re
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+
+def parse_tree(tree):
+    """
+    Parse a `tree` query parameter into a nested dict of field names, e.g.
+    'a,b[c,d]' into {'a': {}, 'b': {'c': {}, 'd': {}}}.
+    """
+    tokens = re.findall(r'[^,\[\]]+|[,\[\]]', tree)
+
+    def parse(pos):
+        fields = {}
+        while pos < len(tokens) and tokens[pos] != ']':
+            name = tokens[pos].strip()
+            pos += 1
+            fields[name] = {}
+            if pos < len(tokens) and tokens[pos] == '[':
+                fields[name], pos = parse(pos + 1)
+                pos += 1  # closing bracket
+            if pos < len(tokens) and tokens[pos] == ',':
+                pos += 1
+        return fields, pos
+
+    return parse(0)[0]
+
+
+def apply_tree(data, fields):
+    """
+    Keep only the given fields of a json object, like Jenkins does with the
+    `tree` parameter. `_class` is always kept.
+    """
+    if isinstance(data, list):
+        return [apply_tree(item, fields) for item in data]
+    if not isinstance(data, dict) or not fields:
+        return data
+    return {
+        key: apply_tree(value, fields.get(key))
+        for key, value in data.items()
+        if key in fields or key == '_class'
+    }
+
+
+def job_description(url, builds=2000):
+    """
+    The json description of a busy parametrized job, with its build history,
+    health reports and actions.
+    """
+    return {
+        '_class': 'org.jenkinsci.plugins.workflow.job.WorkflowJob',
+        'description': 'A job with a long history',
+        'displayName': 'master',
+        'url': url,
+        'buildable': True,
+        'actions': [
+            {'_class': 'hudson.model.ParametersDefinitionProperty'},
+            {'_class': 'com.cloudbees.plugins.credentials.ViewCredentials'},
+        ]
+        * 20,
+        'builds': [
+            {
+                '_class': 'org.jenkinsci.plugins.workflow.job.WorkflowRun',
+                'number': number,
+                'url': '%s%d/' % (url, number),
+            }
+            for number in range(builds, 0, -1)
+        ],
+        'healthReport': [
+            {
+                'description': 'Build stability: No recent builds failed.',
+                'iconClassName': 'icon-health-80plus',
+                'score': 100,
+            }
+        ],
+        'property': [
+            {
+                '_class': 'hudson.model.ParametersDefinitionProperty',
+                'parameterDefinitions': [
+                    {
+                        '_class': 'hudson.model.ChoiceParameterDefinition',
+                        'defaultParameterValue': {'value': 'a'},
+                        'description': 'A parameter with choices',
+                        'name': 'choice%d' % i,
+                        'type': 'ChoiceParameterDefinition',
+                        'choices': ['a', 'b', 'c'],
+                    }
+                    for i in range(10)
+                ],
+            }
+        ],
+    }
+
+
+LOG_LINES = b''.join(
+    b'[2020-09-13T12:26:40.%03dZ] Step %d: compiling module %d of the project '
+    b'with the default options\n' % (i, i % 7, i)
+    for i in range(1000)
+)
+
+
+def waiting_item(url):
+    """
+    The json description of a queue item whose build hasn't started yet.
+    """
+    return {
+        '_class': 'hudson.model.Queue$WaitingItem',
+        'actions': [],
+        'blocked': False,
+        'buildable': True,
+        'id': 1,
+        'inQueueSince': 1600000000000,
+        'params': '',
+        'stuck': False,
+        'task': {'name': 'master', 'url': url, 'color': 'blue'},
+        'url': 'queue/item/1/',
+        'why': 'Waiting for next available executor',
+        'buildableStartMilliseconds': 1600000000000,
+    }
+
+
+def pipeline_description(build_url, elapsed, duration):
+    """
+    The json description of a pipeline run (as in wfapi/describe) that
+    started `elapsed` seconds ago and takes `duration` seconds to finish.
+    Every one of its stages takes the same time.
+    """
+    stages = []
+    names = ['Checkout', 'Build', 'Unit tests', 'Integration tests', 'Deploy']
+    stage_time = duration / len(names)
+    for i, name in enumerate(names):
+        start = i * stage_time
+        if elapsed < start:
+            break
+        done = elapsed >= start + stage_time or elapsed >= duration
+        stages.append(
+            {
+                '_links': {
+                    'self': {
+                        'href': '%sexecution/node/%d/wfapi/describe'
+                        % (build_url, i + 6)
+                    }
+                },
+                'id': str(i + 6),
+                'name': name,
+                'execNode': '',
+                'status': 'SUCCESS' if done else 'IN_PROGRESS',
+                'startTimeMillis': 1600000000000 + int(start * 1000),
+                'durationMillis': int(min(elapsed - start, stage_time) * 1000),
+                'pauseDurationMillis': 0,
+            }
+        )
+    finished = elapsed >= duration
+    return {
+        '_links': {'self': {'href': build_url + 'wfapi/describe'}},
+        'id': '1',
+        'name': '#1',
+        'status': 'SUCCESS' if finished else 'IN_PROGRESS',
+        'startTimeMillis': 1600000000000,
+        'endTimeMillis': 1600000000000 + int(elapsed * 1000),
+        'durationMillis': int(min(elapsed, duration) * 1000),
+        'queueDurationMillis': 5,
+        'pauseDurationMillis': 0,
+        'stages': stages,
+    }
+
+
+def queue_item(url, build_url):
+    """
+    The json description of a queue item whose build has already started.
+    """
+    return {
+        '_class': 'hudson.model.Queue$LeftItem',
+        'actions': [
+            {
+                '_class': 'hudson.model.CauseAction',
+                'causes': [
+                    {
+                        'shortDescription': 'Started by user admin',
+                        'userId': 'admin',
+                        'userName': 'admin',
+                    }
+                ],
+            }
+        ],
+        'blocked': False,
+        'buildable': False,
+        'id': 1,
+        'inQueueSince': 1600000000000,
+        'params': '',
+        'stuck': False,
+        'task': {'name': 'master', 'url': url, 'color': 'blue'},
+        'url': 'queue/item/1/',
+        'why': None,
+        'cancelled': False,
+        'executable': {'number': 1, 'url': build_url},
+    }
+
+
+class FakeJenkinsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, so avoid the delayed ACK
+    # stalls that nagle would cause and that the real Jenkins doesn't have
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        split = urlsplit(self.path)
+        query = parse_qs(split.query)
+        server = self.server
+        build_path = server.job_path + '1/'
+        if split.path == '/crumbIssuer/api/xml':
+            self.send(200, b'Jenkins-Crumb:0123456789abcdef')
+            return
+        if split.path == build_path + 'consoleText':
+            self.send_log(server.log_size)
+            return
+        if split.path == build_path + 'logText/progressiveText':
+            start = min(int(query['start'][0]), server.log_size)
+            size = server.log_size
+            self.send_log(size - start, {'X-Text-Size': str(size)})
+            return
+
+        started = server.started()
+        if split.path == server.job_path + 'api/json':
+            data = job_description(server.url + server.job_path)
+        elif split.path == '/queue/item/1/api/json':
+            if started is None:
+                data = waiting_item(server.job_url)
+            else:
+                data = queue_item(server.job_url, server.url + build_path)
+        elif split.path == build_path + 'wfapi/describe':
+            if started is None:
+                self.send(404, b'')
+                return
+            data = pipeline_description(
+                server.url + build_path,
+                time.monotonic() - started,
+                server.build_time,
+            )
+        else:
+            self.send(404, b'')
+            return
+
+        if 'tree' in query:
+            data = apply_tree(data, parse_tree(query['tree'][0]))
+        self.send(200, json.dumps(data).encode('utf-8'))
+
+    def do_POST(self):
+        split = urlsplit(self.path)
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        builds = ('build', 'buildWithParameters')
+        if split.path in [server.job_path + b for b in builds]:
+            with server.lock:
+                server.launched = time.monotonic()
+            location = server.url + '/queue/item/1/'
+            self.send(201, b'', {'Location': location})
+        else:
+            self.send(404, b'')
+
+    def send(self, status, body, headers=None):
+        self.start_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.count(len(body))
+
+    def send_log(self, size, headers=None):
+        """
+        Send a build log of `size` bytes, made of the same lines over and
+        over again.
+        """
+        self.start_response(200)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'text/plain;charset=UTF-8')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        block = LOG_LINES * (1024 * 1024 // len(LOG_LINES) + 1)
+        left = size
+        while left > 0:
+            chunk = block[:left]
+            self.wfile.write(chunk)
+            left -= len(chunk)
+        self.count(size)
+
+    def start_response(self, status):
+        with self.server.lock:
+            if self.server.first_request is None:
+                self.server.first_request = time.monotonic()
+        self.send_response(status)
+
+    def count(self, size):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes_sent += size
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+
+class FakeJenkins(ThreadingMixIn, HTTPServer):
+    """
+    Run a fake Jenkins in a background thread. Use as a context manager.
+    """
+
+    daemon_threads = True
+    job_path = '/job/folder/job/master/'
+
+    def __init__(self, queue_time=0.0, build_time=0.0, log_size=1024 * 1024):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeJenkinsHandler)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.job_url = self.url + self.job_path
+        self.build_url = self.job_url + '1/'
+        self.queue_time = queue_time
+        self.build_time = build_time
+        self.log_size = log_size
+        self.lock = threading.Lock()
+        self.launched = None
+        self.reset()
+
+    def started(self):
+        """
+        Get the time when the last build left the queue (as given by
+        `time.monotonic`), or None if it hasn't yet. Builds that were never
+        launched are considered to have started long ago.
+        """
+        with self.lock:
+            launched = self.launched
+        if launched is None:
+            return 0.0
+        started = launched + self.queue_time
+        return started if started <= time.monotonic() else None
+
+    def reset(self):
+        """
+        Reset the request and byte counters, and the time of the first
+        request (as given by `time.monotonic`).
+        """
+        self.requests = 0
+        self.bytes_sent = 0
+        self.first_request = None
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
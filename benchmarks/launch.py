@@ -0,0 +1,109 @@
+"""
+Measure the cost of supervising a build: the requests it takes, how long the
+launcher takes to notice that the build started and ended, and how long every
+status check takes.
+
+Usage: python -m benchmarks.launch [-n RUNS] [--queue-time SECONDS]
+    [--build-time SECONDS] [--interval SECONDS]
+
+Builds are launched against a fake Jenkins, which keeps them in the queue
+and running for the given times. The latency columns are how much later than
+that the launcher noticed.
+"""
+import argparse
+import time
+
+from launch_jenkins import CONFIG
+from launch_jenkins import Session
+from launch_jenkins import format_table
+
+from .fake_jenkins import FakeJenkins
+
+
+def launch(server, make_session, interval):
+    """
+    Launch a build with the session returned by `make_session`, and wait for
+    it to finish. Returns the number of requests it took (including those
+    to set up the session), and the time in milliseconds from the build
+    leaving the queue until `wait_queue` returned, and from the build
+    finishing until `wait_job` returned.
+    """
+    server.reset()
+    session = make_session()
+    location = session.launch_build(server.job_url, {'choice0': 'b'})
+    build_url = session.wait_queue(location, interval)
+    started = time.monotonic()
+    start_lag = started - (server.launched + server.queue_time)
+    session.wait_job(build_url, interval)
+    end_lag = time.monotonic() - (started - start_lag + server.build_time)
+    return server.requests, start_lag * 1000, end_lag * 1000
+
+
+def poll_times(server, session, polls):
+    """
+    Return the time in milliseconds that every status check of a running
+    build takes.
+    """
+    times = []
+    for _ in range(polls):
+        start = time.monotonic()
+        session.job_status(server.build_url)
+        times.append((time.monotonic() - start) * 1000)
+    return times
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('--queue-time', type=float, default=0.5)
+    parser.add_argument('--build-time', type=float, default=1.0)
+    parser.add_argument('--interval', type=float, default=0.1)
+    args = parser.parse_args()
+    CONFIG['quiet'] = True
+
+    server = FakeJenkins(args.queue_time, args.build_time)
+    with server:
+        rows = []
+        warm = Session(server.url, cache=False)
+        for name, new_session in [
+            ('new session', lambda: Session(server.url, cache=False)),
+            ('reused session', lambda: warm),
+        ]:
+            results = [
+                launch(server, new_session, args.interval)
+                for _ in range(args.runs)
+            ]
+            requests, start_lags, end_lags = zip(*results)
+            rows.append(
+                [
+                    name,
+                    '%d' % median(requests),
+                    '%.1f' % median(start_lags),
+                    '%.1f' % max(start_lags),
+                    '%.1f' % median(end_lags),
+                    '%.1f' % max(end_lags),
+                ]
+            )
+        header = ['SESSION', 'REQUESTS', 'START LAG MS', 'MAX', 'END LAG MS']
+        print(format_table(header + ['MAX'], rows))
+
+        times = poll_times(server, warm, 100)
+        rows = [
+            [
+                'job_status',
+                '%.2f' % min(times),
+                '%.2f' % median(times),
+                '%.2f' % max(times),
+            ]
+        ]
+        print()
+        print(format_table(['CALL', 'MIN MS', 'MEDIAN MS', 'MAX MS'], rows))
+
+
+if __name__ == '__main__':
+    main()
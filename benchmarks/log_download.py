@@ -0,0 +1,89 @@
+"""
+Measure how fast build logs are downloaded, for logs from 1 MB to a few GB.
+
+Usage: python -m benchmarks.log_download [--sizes SIZES] [--grep PATTERN]
+
+SIZES is a comma separated list of sizes in bytes, with an optional K, M or
+G suffix (default: 1M,10M,100M,1G). Every log is downloaded whole to a sink
+that throws it away, filtered with --grep (by default, a pattern that never
+matches, so that the whole log is searched), and saved to a file.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from launch_jenkins import CONFIG
+from launch_jenkins import LineFilter
+from launch_jenkins import Session
+from launch_jenkins import format_table
+
+from .fake_jenkins import FakeJenkins
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1:] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+class Sink:
+    """
+    A file-like object that throws away everything written to it.
+    """
+
+    def write(self, text):
+        pass
+
+
+def throughput(size, func):
+    """
+    Call `func` and return how many MB per second it took to download a log
+    of `size` bytes.
+    """
+    start = time.monotonic()
+    func()
+    return size / (time.monotonic() - start) / 1024 ** 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', default='1M,10M,100M,1G')
+    parser.add_argument('--grep', default='Exception in thread')
+    args = parser.parse_args()
+    CONFIG['quiet'] = True
+
+    directory = tempfile.mkdtemp()
+    server = FakeJenkins()
+    try:
+        with server:
+            session = Session(server.url, cache=False)
+            build = server.build_url
+            output = os.path.join(directory, 'log.txt')
+            rows = []
+            for size in [parse_size(s) for s in args.sizes.split(',')]:
+                server.log_size = size
+                line_filter = LineFilter([args.grep])
+                cases = [
+                    lambda: session.dump_log(build, Sink()),
+                    lambda: session.dump_log(build, Sink(), None, line_filter),
+                    lambda: session.dump_log(build, output),
+                ]
+                speeds = [throughput(size, case) for case in cases]
+                rows.append(
+                    ['%.1f' % (size / 1024 ** 2)]
+                    + ['%.1f' % speed for speed in speeds]
+                )
+    finally:
+        shutil.rmtree(directory)
+
+    header = ['LOG MB', 'MB/S', 'MB/S GREP', 'MB/S TO FILE']
+    print(format_table(header, rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Measure how long the launcher takes to start: the time to import the
+package, as reported by `python -X importtime`, and the time from starting
+the command line tool until it sends its first request.
+
+Usage: python -m benchmarks.startup [-n RUNS] [--max-import-ms MS]
+
+With --max-import-ms, exits with an error if importing the package takes
+longer than that, so it can be used to catch regressions.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+from launch_jenkins import format_table
+
+from .fake_jenkins import FakeJenkins
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# what the launch_jenkins console script does
+CLI = [
+    sys.executable,
+    '-c',
+    'from launch_jenkins.launch_jenkins import main; main()',
+]
+
+
+def run(args):
+    # make sure the interpreter can use the cached bytecode
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return subprocess.run(
+        args,
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+def import_times():
+    """
+    Import the package in a new interpreter and return the total import time
+    in milliseconds, and a list of (module, milliseconds) tuples with the
+    modules that took the longest to import themselves.
+    """
+    args = [sys.executable, '-X', 'importtime', '-c', 'import launch_jenkins']
+    result = run(args)
+    times = {}
+    for line in result.stderr.decode('utf-8').splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)', line)
+        if match:
+            own, total, _, module = match.groups()
+            times[module] = (int(own) / 1000, int(total) / 1000)
+    slowest = sorted(times.items(), key=lambda item: -item[1][0])[:5]
+    return times['launch_jenkins'][1], [(m, t[0]) for m, t in slowest]
+
+
+def cli_times(server):
+    """
+    Launch a build with the command line tool and return the time until the
+    first request reached the server and until the process exited, in
+    milliseconds.
+    """
+    server.reset()
+    auth = ['-u', 'user', '-t', 'token']
+    args = ['-j', server.job_url, '-l', '-q', '--no-cache'] + auth
+    start = time.monotonic()
+    result = run(CLI + args)
+    end = time.monotonic()
+    assert result.returncode == 0, result.stderr.decode('utf-8')
+    return (server.first_request - start) * 1000, (end - start) * 1000
+
+
+def command_time(args):
+    """
+    Run the command line tool and return how long it took in milliseconds.
+    """
+    start = time.monotonic()
+    run(CLI + args)
+    return (time.monotonic() - start) * 1000
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('--max-import-ms', type=float, metavar='MS')
+    args = parser.parse_args()
+
+    run([sys.executable, '-c', 'import launch_jenkins'])  # write the .pyc
+    imports = [import_times() for _ in range(args.runs)]
+    version = [command_time(['--version']) for _ in range(args.runs)]
+    usage = [command_time(['-j']) for _ in range(args.runs)]
+    with FakeJenkins() as server:
+        launches = [cli_times(server) for _ in range(args.runs)]
+
+    results = [
+        ('import launch_jenkins', [i[0] for i in imports]),
+        ('launch_jenkins --version', version),
+        ('launch_jenkins (usage error)', usage),
+        ('launch, until first request', [t[0] for t in launches]),
+        ('launch, until exit', [t[1] for t in launches]),
+    ]
+    rows = [
+        [name, '%.1f' % min(times), '%.1f' % median(times)]
+        for name, times in results
+    ]
+    print(format_table(['CASE', 'MIN MS', 'MEDIAN MS'], rows))
+
+    print('\nSlowest modules to import:')
+    rows = [[module, '%.1f' % ms] for module, ms in imports[-1][1]]
+    print(format_table(['MODULE', 'MS'], rows))
+
+    import_ms = median([i[0] for i in imports])
+    if args.max_import_ms and import_ms > args.max_import_ms:
+        print(
+            '\nImporting took %.1f ms, more than the allowed %.1f ms'
+            % (import_ms, args.max_import_ms)
+        )
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
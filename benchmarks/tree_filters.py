@@ -0,0 +1,70 @@
+"""
+Compare the size and latency of the json API calls with and without `tree`
+filters.
+
+Usage: python -m benchmarks.tree_filters [-n REQUESTS]
+"""
+import argparse
+import time
+
+from launch_jenkins import Session
+from launch_jenkins import format_table
+
+from .fake_jenkins import FakeJenkins
+
+
+def measure(server, func, requests):
+    """
+    Call `func` a number of times and return the average number of bytes
+    served and the average latency in milliseconds.
+    """
+    func()  # warm up the connection
+    server.reset()
+    start = time.time()
+    for _ in range(requests):
+        func()
+    elapsed = time.time() - start
+    return server.bytes_sent / requests, elapsed * 1000 / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', '--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    with FakeJenkins() as server:
+        session = Session(server.url)
+        queue = server.url + '/queue/item/1/'
+        cases = [
+            (
+                'get_job_params',
+                lambda: session.get_url(server.job_url + 'api/json'),
+                lambda: session.get_job_params(server.job_url),
+            ),
+            (
+                'get_queue_status',
+                lambda: session.get_url(queue + 'api/json'),
+                lambda: session.get_queue_status(queue),
+            ),
+        ]
+
+        rows = []
+        for name, before, after in cases:
+            size_before, time_before = measure(server, before, args.requests)
+            size_after, time_after = measure(server, after, args.requests)
+            rows.append(
+                [
+                    name,
+                    '%d' % size_before,
+                    '%d' % size_after,
+                    '%.2f' % time_before,
+                    '%.2f' % time_after,
+                ]
+            )
+
+    header = ['CALL', 'BYTES BEFORE', 'BYTES AFTER', 'MS BEFORE', 'MS AFTER']
+    print(format_table(header, rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,9 @@
 from .launch_jenkins import *
 from .launch_jenkins import __version__
+
+
+def __getattr__(name):
+    # names that launch_jenkins imports lazily (python 3.7+)
+    from . import launch_jenkins
+
+    return getattr(launch_jenkins, name)
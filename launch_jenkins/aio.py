@@ -0,0 +1,576 @@
+"""
+Asyncio version of the launcher's Session, to supervise many builds from a
+single event loop.
+
+Requests go through a small HTTP/1.1 client built on asyncio streams, so
+there are no dependencies outside of the standard library.
+"""
+import asyncio
+import copy
+import io
+import json
+import socket
+from http.client import RemoteDisconnected, parse_headers
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urljoin, urlsplit
+from urllib.request import Request
+
+from . import launch_jenkins
+from .launch_jenkins import BUILD_TIMES_TREE
+from .launch_jenkins import CRUMB_URL
+from .launch_jenkins import JOB_PARAMS_TREE
+from .launch_jenkins import QUEUE_ITEM_TREE
+from .launch_jenkins import CaseInsensitiveDict
+from .launch_jenkins import ConnectionPool
+from .launch_jenkins import RetryPolicy
+from .launch_jenkins import adaptive_interval
+from .launch_jenkins import api_url
+from .launch_jenkins import basic_auth
+from .launch_jenkins import init_ssl
+from .launch_jenkins import log
+from .launch_jenkins import log_decoder
+from .launch_jenkins import monotonic
+from .launch_jenkins import open_output
+from .launch_jenkins import parse_expected_end
+from .launch_jenkins import parse_job_params
+from .launch_jenkins import parse_job_status
+from .launch_jenkins import parse_queue_status
+from .launch_jenkins import validate_params
+
+
+class AsyncResponse:
+    """
+    An HTTP response whose body is read with the `read` coroutine.
+
+    Once the body has been read completely, the connection is handed back to
+    the pool it came from.
+    """
+
+    def __init__(self, reader, writer, status, reason, msg, release):
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.reason = reason
+        self.msg = msg
+        self.headers = CaseInsensitiveDict(msg.items())
+        self.url = None
+        self.text = None
+        self._release = release
+        self._chunked = 'chunked' in msg.get('Transfer-Encoding', '').lower()
+        self._chunk_left = 0
+        self._length = None
+        if not self._chunked and msg.get('Content-Length') is not None:
+            self._length = int(msg['Content-Length'])
+        self.will_close = msg.get('Connection', '').lower() == 'close'
+        self.will_close |= not self._chunked and self._length is None
+        self.done = False
+
+    def info(self):
+        return self.msg
+
+    def finish(self, reusable=True):
+        """
+        Mark the body as read and give the connection back to the pool.
+        """
+        if not self.done:
+            self.done = True
+            self._release(reusable and not self.will_close)
+
+    async def read(self, amt=None):
+        """
+        Read up to `amt` bytes of the body, or all of it if `amt` is None.
+        Returns an empty bytes object when there is nothing left to read.
+        """
+        if amt is None:
+            blocks = []
+            while True:
+                block = await self.read(65536)
+                if not block:
+                    return b''.join(blocks)
+                blocks.append(block)
+
+        if self.done:
+            return b''
+        if self._chunked:
+            return await self._read_chunk(amt)
+
+        if self._length is None:
+            data = await self.reader.read(amt)
+            if not data:
+                self.finish(reusable=False)
+            return data
+
+        data = await self.reader.read(min(amt, self._length))
+        if not data and self._length:
+            self.finish(reusable=False)
+            raise asyncio.IncompleteReadError(data, self._length)
+        self._length -= len(data)
+        if not self._length:
+            self.finish()
+        return data
+
+    async def _read_chunk(self, amt):
+        if not self._chunk_left:
+            line = await self.reader.readline()
+            size = int(line.split(b';')[0].strip() or b'0', 16)
+            if not size:
+                # skip the trailers until the final empty line
+                while (await self.reader.readline()).strip():
+                    pass
+                self.finish()
+                return b''
+            self._chunk_left = size
+
+        data = await self.reader.readexactly(min(amt, self._chunk_left))
+        self._chunk_left -= len(data)
+        if not self._chunk_left:
+            await self.reader.readexactly(2)  # CRLF after every chunk
+        return data
+
+
+class AsyncConnectionPool:
+    """
+    Asyncio counterpart of `ConnectionPool`. Keeps up to `maxsize` idle
+    connections to every host and reuses them for later requests.
+    """
+
+    redirect_codes = (301, 302, 303, 307, 308)
+    max_redirects = 10
+    idempotent_methods = ConnectionPool.idempotent_methods
+
+    def __init__(self, context=None, maxsize=4):
+        self.context = context
+        self.maxsize = maxsize
+        self.idle = {}
+
+    async def get_connection(self, key):
+        """
+        Get an idle connection for the given (scheme, netloc) key, or open a
+        new one. Returns a (reader, writer, reused) tuple.
+        """
+        idle = self.idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+
+        scheme, netloc = key
+        split = urlsplit('//' + netloc)
+        if scheme == 'https':
+            port = split.port or 443
+            reader, writer = await asyncio.open_connection(
+                split.hostname, port, ssl=self.context
+            )
+        else:
+            port = split.port or 80
+            reader, writer = await asyncio.open_connection(
+                split.hostname, port
+            )
+        return reader, writer, False
+
+    def put_connection(self, key, reader, writer, reusable):
+        idle = self.idle.setdefault(key, [])
+        if reusable and len(idle) < self.maxsize:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def clear(self):
+        """
+        Close all the idle connections in the pool.
+        """
+        idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for _, writer in connections:
+                writer.close()
+
+    def is_stale(self, request, error, sent):
+        """
+        Tell whether a request that failed on a reused connection can be sent
+        again. See `ConnectionPool.is_stale`.
+        """
+        if not sent:
+            return isinstance(error, (BrokenPipeError, ConnectionResetError))
+        if request.get_method() not in self.idempotent_methods:
+            return False
+        return isinstance(error, RemoteDisconnected)
+
+    async def send(self, request):
+        """
+        Send a request through a pooled connection and return the response.
+        """
+        url = request.get_full_url()
+        split = urlsplit(url)
+        key = (split.scheme, split.netloc)
+        selector = split.path or '/'
+        if split.query:
+            selector += '?' + split.query
+        data = request.data or b''
+        method = request.get_method()
+
+        headers = dict(request.header_items())
+        headers['Host'] = split.netloc
+        if data or method == 'POST':
+            headers['Content-Length'] = str(len(data))
+        head = ['%s %s HTTP/1.1' % (method, selector)]
+        head += ['%s: %s' % item for item in headers.items()]
+        head = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+
+        while True:
+            reader, writer, reused = await self.get_connection(key)
+            sent = False
+            try:
+                writer.write(head + data)
+                await writer.drain()
+                sent = True
+                response = await self._read_head(reader, writer, key)
+            except (ConnectionError, asyncio.IncompleteReadError) as error:
+                writer.close()
+                if reused and self.is_stale(request, error, sent):
+                    # stale keep-alive connection. Retry with a new one
+                    continue
+                raise
+            except asyncio.CancelledError:
+                writer.close()
+                raise
+            break
+
+        response.url = url
+        if method == 'HEAD' or response.status in (204, 304):
+            response.finish()
+        return response
+
+    async def _read_head(self, reader, writer, key):
+        line = await reader.readline()
+        if not line:
+            raise RemoteDisconnected('Connection closed by the server')
+        parts = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        status = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+
+        raw = []
+        while True:
+            line = await reader.readline()
+            raw.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        msg = parse_headers(io.BytesIO(b''.join(raw)))
+
+        def release(reusable):
+            self.put_connection(key, reader, writer, reusable)
+
+        return AsyncResponse(reader, writer, status, reason, msg, release)
+
+    async def urlopen(self, request):
+        """
+        Send a request and return the response, following redirects and
+        raising `HTTPError` for error status codes like `urllib` would.
+        """
+        for _ in range(self.max_redirects):
+            response = await self.send(request)
+            location = response.headers.get('Location')
+            if response.status in self.redirect_codes and location:
+                if request.get_method() not in ('GET', 'HEAD'):
+                    return response
+                await response.read()
+                url = urljoin(request.get_full_url(), location)
+                headers = dict(request.header_items())
+                request = Request(url, headers=headers)
+                continue
+
+            if response.status >= 400:
+                body = await response.read()
+                raise HTTPError(
+                    response.url,
+                    response.status,
+                    response.reason,
+                    response.msg,
+                    io.BytesIO(body),
+                )
+            return response
+
+        raise HTTPError(
+            response.url,
+            response.status,
+            'Too many redirects',
+            response.msg,
+            None,
+        )
+
+
+class AsyncSession:
+    """
+    Coroutine version of `Session`, for use from asyncio applications.
+
+    Waiting for a build doesn't block the event loop, so a single thread can
+    supervise as many builds as needed. The CSRF crumb is requested with the
+    first request instead of when the session is created. Progress bars are
+    not shown.
+
+    Requests that take longer than `timeout` seconds (by default, the
+    request_timeout setting) raise `socket.timeout`, like in `Session`.
+    """
+
+    def __init__(
+        self, base, auth=None, pool_size=4, retry=None, timeout=None
+    ):
+        self.auth = auth
+        if timeout is None:
+            timeout = launch_jenkins.CONFIG['request_timeout']
+        self.timeout = timeout
+        self.headers = {'User-Agent': 'foobar'}
+        self.context = init_ssl()
+        self.pool = AsyncConnectionPool(self.context, maxsize=pool_size)
+        self.retry = retry or RetryPolicy()
+        self.jar = CookieJar()
+        split = urlsplit(base)
+        self.base = '{}://{}'.format(split.scheme, split.netloc)
+        self._crumb = None
+
+        if self.auth:
+            self.headers['Authorization'] = basic_auth(self.auth)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close all the connections of this session.
+        """
+        self.pool.clear()
+
+    async def _get_crumb(self):
+        """
+        Get the necessary crumb header if our Jenkins instance is CSRF
+        protected, and automatically add it to this session's default headers.
+        """
+        try:
+            resp = await self._get_url(self.base + CRUMB_URL)
+        except HTTPError as err:
+            # only ignore the error if it's a 404 (i.e. Jenkins is not CSRF
+            # protected)
+            if err.code != 404:
+                raise
+        else:
+            key, value = resp.text.split(':')
+            self.headers[key] = value
+
+    async def get_url(
+        self, url, data=None, stream=False, retries=None, idempotent=None
+    ):
+        """
+        Send a GET request, or a POST if there is `data`, retrying it like
+        `Session.get_url` does.
+        """
+        if self._crumb is None:
+            self._crumb = asyncio.ensure_future(self._get_crumb())
+        try:
+            await self._crumb
+        except Exception:
+            self._crumb = None
+            raise
+        if idempotent is None:
+            idempotent = data is None
+        return await self._get_url(url, data, stream, retries, idempotent)
+
+    async def _get_url(
+        self, url, data=None, stream=False, retries=None, idempotent=True
+    ):
+        headers = self.headers.copy()
+        if data is not None:
+            data = urlencode(data).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = Request(url, data, headers=headers)
+        self.jar.add_cookie_header(req)
+
+        policy = self.retry
+        if retries is not None:
+            policy = copy.copy(policy)
+            policy.attempts = retries
+        start = monotonic()
+        attempt = 1
+        while True:
+            try:
+                response = await self.with_timeout(self.pool.urlopen(req))
+                break
+            except Exception as error:
+                elapsed = monotonic() - start
+                delay = policy.next_delay(attempt, error, elapsed, idempotent)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+        self.jar.extract_cookies(response, req)
+        if not stream:
+            try:
+                body = await self.with_timeout(response.read())
+            except socket.timeout:
+                response.writer.close()
+                raise
+            response.text = body.decode('utf-8')
+        return response
+
+    async def with_timeout(self, coro):
+        """
+        Wait for a coroutine to finish, and raise `socket.timeout` if it takes
+        longer than the timeout of this session.
+        """
+        try:
+            return await asyncio.wait_for(coro, self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('timed out')
+
+    async def get_job_params(self, url):
+        """
+        Get the list of allowed parameters and their respective choices.
+        """
+        response = await self.get_url(api_url(url, JOB_PARAMS_TREE))
+        return parse_job_params(json.loads(response.text))
+
+    async def launch_build(self, url, params=None):
+        """
+        Submit job and return the queue item location.
+        """
+        url = url.rstrip('/') + '/'
+        job_params = await self.get_job_params(url)
+        validate_params(job_params, params)
+
+        url += 'buildWithParameters' if job_params else 'build'
+        url += '?delay=0'
+        log('Sending build request')
+        response = await self.get_url(url, data=params or "")
+
+        assert (
+            'Location' in response.headers
+        ), 'Something went wrong with the Jenkins API'
+        location = response.headers['Location']
+
+        assert 'queue' in location, 'Something went wrong with the Jenkins API'
+        return location
+
+    async def get_queue_status(self, location):
+        """
+        Check the status of a queue item. Returns the build url if the job is
+        already executing, or None if it's still in the queue.
+        """
+        response = await self.get_url(api_url(location, QUEUE_ITEM_TREE))
+        return parse_queue_status(json.loads(response.text))
+
+    async def wait_queue(self, location, interval=5.0):
+        """
+        Wait until the item starts building.
+        """
+        while True:
+            job_url = await self.get_queue_status(location)
+            if job_url is not None:
+                return job_url
+            await asyncio.sleep(interval)
+
+    async def job_status(self, build_url):
+        """
+        Check the status of a running build. See `Session.job_status`.
+        """
+        poll_url = build_url.rstrip('/') + '/wfapi/describe'
+        try:
+            response = await self.get_url(poll_url)
+        except HTTPError as error:
+            if error.code == 404:
+                build_number = build_url.rstrip('/').rpartition('/')[2]
+                error.msg = 'Build #%s does not exist' % build_number
+            raise
+        return parse_job_status(json.loads(response.text))
+
+    async def get_expected_end(self, build_url):
+        """
+        Get the time (in millis, by the Jenkins clock) when a build is
+        expected to end. See `Session.get_expected_end`.
+        """
+        response = await self.get_url(api_url(build_url, BUILD_TIMES_TREE))
+        return parse_expected_end(json.loads(response.text))
+
+    async def wait_job(
+        self, build_url, interval=5.0, output=None, max_interval=None
+    ):
+        """
+        Wait until the build finishes. See `Session.wait_job`.
+        """
+        expected_end = None
+        if max_interval:
+            expected_end = await self.get_expected_end(build_url)
+        name = '#' + build_url.rstrip('/').split('/')[-1]
+        offset, decoder = 0, log_decoder()
+        while True:
+            status, stage = await self.job_status(build_url)
+            if output is not None:
+                offset, more = await self.follow_log(
+                    build_url, output, offset, decoder
+                )
+                while status is not None and more:
+                    await asyncio.sleep(interval / 5)
+                    offset, more = await self.follow_log(
+                        build_url, output, offset, decoder
+                    )
+            if status is not None:
+                status_name = 'SUCCESS' if status else 'FAILURE'
+                log('Job', name, 'ended in', status_name)
+                return status
+            delay = interval
+            if max_interval:
+                delay = adaptive_interval(
+                    expected_end, stage, interval, max_interval
+                )
+            await asyncio.sleep(delay)
+
+    async def write_log(self, url, file, decoder=None):
+        """
+        Download a log from `url` and write it to a file, block by block.
+        Returns the response, for its headers.
+
+        Pass an incremental `decoder` to keep characters split between two
+        calls in one piece. Otherwise the log is expected to end here.
+        """
+        response = await self.get_url(url, stream=True)
+        final = decoder is None
+        decoder = decoder or log_decoder()
+        while True:
+            block = await response.read(8192)
+            if not block:
+                break
+            file.write(decoder.decode(block))
+        if final:
+            file.write(decoder.decode(b'', True))
+        return response
+
+    async def retrieve_log(self, build_url):
+        """
+        Get the build log and return it as a string.
+        """
+        output = io.StringIO()
+        await self.write_log(build_url.rstrip('/') + '/consoleText', output)
+        return output.getvalue()
+
+    async def follow_log(self, build_url, file, start=0, decoder=None):
+        """
+        Write the part of the build log that comes after byte `start` to a
+        file. See `Session.follow_log`.
+        """
+        url = build_url.rstrip('/') + '/logText/progressiveText?start=%d'
+        response = await self.write_log(url % start, file, decoder)
+        file.flush()
+
+        offset = int(response.headers.get('X-Text-Size', start))
+        more = response.headers.get('X-More-Data', '').lower() == 'true'
+        return offset, more
+
+    async def dump_log(self, build_url, filename=None):
+        """
+        Save the build log to a file.
+        """
+        url = build_url.rstrip('/') + '/consoleText'
+        with open_output(build_url, filename) as file:
+            await self.write_log(url, file)
@@ -6,36 +6,105 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import absolute_import
 
-import argparse
-import json
 import sys
 import time
+import errno
 import os
 import re
-import base64
 import io
-import ssl
+import signal
+import copy
+import heapq
+import importlib
 import functools
+import threading
 import warnings
+import codecs
+import zlib
+import contextlib
 from itertools import cycle
 from collections import namedtuple
+from collections import deque
 from collections import OrderedDict
 
 if sys.version_info >= (3,):
-    from urllib.request import Request, HTTPCookieProcessor  # noqa:F401
-    from urllib.request import urlopen, urlsplit, install_opener
-    from urllib.request import build_opener  # noqa:F401
-    from urllib.error import HTTPError  # noqa:F401
-    from urllib.parse import urlencode  # noqa:F401
-    from collections.abc import Mapping, MutableMapping  # noqa:F401
-    from http.cookiejar import CookieJar  # noqa:F401
+    from urllib.parse import urlencode, urljoin, urlsplit, unquote
+    from collections.abc import Mapping, MutableMapping
 else:
-    from urllib2 import Request, HTTPError, HTTPCookieProcessor  # noqa:F401
-    from urllib2 import urlopen, build_opener, install_opener  # noqa:F401
-    from urllib import urlencode  # noqa:F401
-    from urlparse import urlsplit  # noqa:F401
-    from collections import Mapping, MutableMapping  # noqa:F401
-    from cookielib import CookieJar  # noqa:F401
+    from urllib import urlencode, unquote
+    from urlparse import urlsplit, urljoin
+    from collections import Mapping, MutableMapping
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported when one of its attributes
+    is first accessed.
+
+    Most of the standard library modules that we need are slow to import, and
+    there's no reason to pay for them just to print the `--help` message or
+    report a wrong argument.
+    """
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attr)
+
+
+argparse = LazyModule('argparse')
+base64 = LazyModule('base64')
+csv = LazyModule('csv')
+hashlib = LazyModule('hashlib')
+json = LazyModule('json')
+random = LazyModule('random')
+socket = LazyModule('socket')
+ssl = LazyModule('ssl')
+if sys.version_info >= (3,):
+    http_client = LazyModule('http.client')
+    cookiejar = LazyModule('http.cookiejar')
+    urllib_request = LazyModule('urllib.request')
+else:
+    http_client = LazyModule('httplib')
+    cookiejar = LazyModule('cookielib')
+    urllib_request = LazyModule('urllib2')
+
+# Names that this module used to import eagerly, and where to find them now.
+# They are still available as module attributes for backwards compatibility
+LAZY_NAMES = {
+    'Request': urllib_request,
+    'HTTPError': urllib_request,
+    'HTTPCookieProcessor': urllib_request,
+    'build_opener': urllib_request,
+    'install_opener': urllib_request,
+    'getproxies': urllib_request,
+    'proxy_bypass': urllib_request,
+    'CookieJar': cookiejar,
+    'LWPCookieJar': cookiejar,
+    'LoadError': cookiejar,
+    'HTTPConnection': http_client,
+    'HTTPSConnection': http_client,
+    'HTTPException': http_client,
+}
+
+
+def __getattr__(name):
+    if name in LAZY_NAMES:
+        return getattr(LAZY_NAMES[name], name)
+    raise AttributeError(
+        "module '{}' has no attribute '{}'".format(__name__, name)
+    )
+
+
+if sys.version_info < (3, 7):
+    # There's no module level __getattr__ (PEP 562), so these have to be
+    # imported now
+    for _name in LAZY_NAMES:
+        globals()[_name] = __getattr__(_name)
 
 
 CONFIG = {
@@ -43,10 +112,48 @@ CONFIG = {
     'quiet': False,
     'progress': False,
     'mode': 'full',
+    'follow': False,
+    'tail': None,
+    'grep': None,
+    'before_context': 0,
+    'after_context': 0,
+    'max_count': None,
+    'batch': None,
+    'workers': 4,
+    'interval': 5.0,
+    'max_interval': None,
+    'cache': True,
+    'cache_ttl': 1800,
+    'timeout': None,
+    'queue_timeout': None,
+    'abort_on_timeout': False,
+    'request_timeout': 60,
     'debug': False,
+    'stats': False,
+    'metrics_file': None,
+    'trace': None,
     'verify_ssl': True,
 }
 __version__ = '3.1.0'
+monotonic = getattr(time, 'monotonic', time.time)
+WaitResult = namedtuple('WaitResult', 'item build_url status error')
+RequestEvent = namedtuple(
+    'RequestEvent',
+    'method url endpoint status bytes retries start dns connect tls '
+    'first_byte total error',
+)
+StageEvent = namedtuple('StageEvent', 'build_url stages')
+TIMEOUT_EXIT_CODE = 124  # same as timeout(1)
+TAIL_WINDOW = 64 * 1024  # bytes to download first when tailing a log
+CRUMB_URL = (
+    '/crumbIssuer/api/xml?xpath=concat(//crumbRequestField,":",//crumb)'
+)
+# Fields that we read from every json API, so that Jenkins doesn't send the
+# rest of them. See https://www.jenkins.io/doc/book/using/remote-access-api/
+JOB_PARAMS_TREE = 'property[_class,parameterDefinitions[name,choices]]'
+QUEUE_ITEM_TREE = 'cancelled,executable[url]'
+QUEUE_TREE = 'items[id,why,blocked,stuck,task[url]]'
+BUILD_TIMES_TREE = 'timestamp,estimatedDuration'
 
 
 class CaseInsensitiveDict(MutableMapping):
@@ -133,6 +240,11 @@ def errlog(*args, **kwargs):
     print(*args, **kwargs)
 
 
+def debug(*args, **kwargs):
+    if CONFIG['debug']:
+        errlog(*args, **kwargs)
+
+
 def parse_kwarg(kwarg):
     """
     Parse a key=value argument from the command line and return it as a
@@ -164,12 +276,21 @@ def parse_args():
     parser.add_argument(
         '-t', '--token', help='User token', type=str, required=True
     )
+    jobs = parser.add_mutually_exclusive_group(required=True)
+    jobs.add_argument(
+        '-j', '--job', help='The full url of the job to launch', type=str
+    )
+    jobs.add_argument(
+        '--batch',
+        help='Launch all the builds listed in a JSON or CSV file',
+        metavar='FILE',
+    )
     parser.add_argument(
-        '-j',
-        '--job',
-        help='The full url of the job to launch',
-        type=str,
-        required=True,
+        '--workers',
+        help='Number of builds to launch, and of logs to download, at the '
+        'same time in batch mode (default: %(default)s)',
+        type=int,
+        default=CONFIG['workers'],
     )
     parser.add_argument(
         '--dump',
@@ -180,6 +301,106 @@ def parse_args():
         '-o', '--output', help='Dump job output to FILE (use - for stdout)',
         nargs='?', const=True, required=False, metavar='FILE'
     )
+    parser.add_argument(
+        '-f',
+        '--follow',
+        help='Write the job output as it runs, instead of downloading it at '
+        'the end. Implies -o',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--tail',
+        help='Only save the last LINES lines of the job output. Implies -o',
+        type=int,
+        metavar='LINES',
+    )
+    parser.add_argument(
+        '--grep',
+        help='Only save the lines of the job output that match this regular '
+        'expression. Can be used many times. Implies -o',
+        action='append',
+        metavar='PATTERN',
+    )
+    parser.add_argument(
+        '-A',
+        '--after-context',
+        help='Save this many lines after every line that matches --grep',
+        type=int,
+        default=0,
+        metavar='LINES',
+    )
+    parser.add_argument(
+        '-B',
+        '--before-context',
+        help='Save this many lines before every line that matches --grep',
+        type=int,
+        default=0,
+        metavar='LINES',
+    )
+    parser.add_argument(
+        '-m',
+        '--max-count',
+        help='Stop downloading the job output after this many lines match '
+        '--grep',
+        type=int,
+        metavar='NUM',
+    )
+    parser.add_argument(
+        '--interval',
+        help='Seconds between status checks, or the minimum if '
+        '--max-interval is used (default: %(default)s)',
+        type=float,
+        default=CONFIG['interval'],
+    )
+    parser.add_argument(
+        '--max-interval',
+        help='Adapt the time between status checks of a running build to its '
+        'estimated duration, waiting at most this many seconds',
+        type=float,
+        metavar='SECONDS',
+    )
+    parser.add_argument(
+        '--timeout',
+        help='Give up if the build hasn\'t finished after this many seconds, '
+        'counting the time spent in the queue',
+        type=float,
+        metavar='SECONDS',
+    )
+    parser.add_argument(
+        '--queue-timeout',
+        help='Give up if the build hasn\'t started after this many seconds',
+        type=float,
+        metavar='SECONDS',
+    )
+    parser.add_argument(
+        '--abort-on-timeout',
+        help='Cancel the queue item or stop the build when giving up',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--no-cache',
+        help='Do not reuse the Jenkins crumb and cookies from previous runs',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--stats',
+        help='Print a summary of the requests sent and of where the time '
+        'went at exit',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Write the request counts and timings to this file at exit, in '
+        'the OpenMetrics text format',
+        metavar='PATH',
+    )
+    parser.add_argument(
+        '--trace',
+        help='Write a timeline of the requests sent, the time spent in the '
+        'queue and the pipeline stages to this file at exit, in the Chrome '
+        'trace event format',
+        metavar='FILE',
+    )
     parser.add_argument(
         '--debug', help='Print debug output', action='store_true'
     )
@@ -220,14 +441,51 @@ def parse_args():
     elif args.output:
         CONFIG['output'] = args.output
 
+    if args.follow and args.tail is not None:
+        parser.error('--tail can not be used with --follow')
+    if args.grep and (args.follow or args.tail is not None):
+        parser.error('--grep can not be used with --follow or --tail')
+    if args.grep:
+        # check the patterns now, rather than after the build is over
+        try:
+            LineFilter(args.grep)
+        except re.error as error:
+            parser.error('invalid --grep pattern: %s' % error)
+    filtered = args.tail is not None or args.grep
+    if (args.follow or filtered) and not CONFIG['output']:
+        CONFIG['output'] = True
+    CONFIG['follow'] = args.follow
+    CONFIG['tail'] = args.tail
+    CONFIG['grep'] = args.grep
+    CONFIG['before_context'] = args.before_context
+    CONFIG['after_context'] = args.after_context
+    CONFIG['max_count'] = args.max_count
+    CONFIG['cache'] = not args.no_cache
+    CONFIG['interval'] = args.interval
+    CONFIG['max_interval'] = args.max_interval
+    CONFIG['timeout'] = args.timeout
+    CONFIG['queue_timeout'] = args.queue_timeout
+    CONFIG['abort_on_timeout'] = args.abort_on_timeout
     CONFIG['quiet'] = args.quiet
     CONFIG['progress'] = args.progress
     CONFIG['debug'] = args.debug
+    CONFIG['stats'] = args.stats
+    CONFIG['metrics_file'] = args.metrics_file
+    CONFIG['trace'] = args.trace
     if args.launch_only:
         CONFIG['mode'] = 'launch'
     elif args.wait_only:
         CONFIG['mode'] = 'wait'
 
+    if args.batch:
+        if args.params:
+            parser.error('build parameters must go in the batch file')
+        if CONFIG['output'] not in (True, False):
+            parser.error('batch mode only supports the default output files')
+        CONFIG['batch'] = args.batch
+        CONFIG['workers'] = args.workers
+        return (None, (args.user, args.token), {})
+
     job = parse_job_url(args.job, has_number=args.wait_only)
     try:
         params = {k: v for k, v in map(parse_kwarg, args.params)}
@@ -309,34 +567,250 @@ def format_millis(millis):
     return formatted
 
 
+class ProgressBar(object):
+    """
+    Show a message and a progress bar on stderr while we wait for a build.
+    Use as a context manager, and change the message with `update`.
+
+    The bar is redrawn by a background thread, so that the spinner keeps
+    going while requests to Jenkins are in flight. The width of the terminal
+    is cached, and only read again when it is resized (on SIGWINCH) or, where
+    we can't get that signal, every `resize_check` seconds. When stderr can't
+    show a progress bar, every message is printed once instead.
+    """
+
+    frame_time = 0.1
+    resize_check = 1.0
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.thread = None
+        self.msg = None
+        self.millis = None
+        self.since = None
+        self.spinner = cycle(['|', '/', '-', '\\'])
+        self.columns = None
+        self.checked = None
+        self.resized = False
+        self.watching = False
+        self.previous_handler = None
+
+    def __enter__(self):
+        if CONFIG['quiet'] or not is_progressbar_capable():
+            return self
+        self.watch_resize()
+        self.thread = threading.Thread(target=self.run, name='progress')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        thread = self.thread
+        if thread is None:
+            return
+        with self.cond:
+            self.thread = None
+            self.cond.notify()
+        thread.join()
+        self.unwatch_resize()
+
+    def update(self, msg, millis=None):
+        """
+        Change the message, and the time (in millis) shown next to it, which
+        then keeps counting up.
+        """
+        if self.thread is None:
+            log(msg + '...', end='\r')
+            return
+        with self.cond:
+            self.msg = msg.strip() + ' '
+            self.millis = millis
+            self.since = monotonic()
+            self.cond.notify()
+
+    def show(self, msg, duration, millis=None):
+        """
+        Show a message for the specified amount of time.
+        """
+        self.update(msg, millis)
+        time.sleep(duration)
+
+    def run(self):
+        thread = threading.current_thread()
+        with self.cond:
+            while self.thread is thread:
+                if self.msg is not None:
+                    self.draw()
+                self.cond.wait(self.frame_time)
+
+    def draw(self):
+        out_msg = self.msg
+        if self.millis is not None:
+            millis = self.millis + (monotonic() - self.since) * 1000
+            out_msg = '[{}] {}'.format(format_millis(millis), self.msg)
+        spaces = max(self.terminal_columns() - len(out_msg) - 3, 40)
+        out = '{}{}  {}'.format(out_msg, '.' * spaces, next(self.spinner))
+        log(out, end='\r')
+        sys.stderr.flush()
+
+    def terminal_columns(self):
+        """
+        Get the width of the terminal, reading it again only if it may have
+        changed.
+        """
+        now = monotonic()
+        stale = self.checked is None or (
+            not self.watching and now - self.checked >= self.resize_check
+        )
+        if stale or self.resized:
+            self.resized = False
+            self.checked = now
+            try:
+                self.columns = get_stderr_size_unix().columns
+            except Exception:
+                self.columns = self.columns or 80
+        return self.columns
+
+    def on_resize(self, signum, frame):
+        self.resized = True
+        if callable(self.previous_handler):
+            self.previous_handler(signum, frame)
+
+    def watch_resize(self):
+        """
+        Install a SIGWINCH handler to know when the terminal is resized. This
+        can only be done from the main thread.
+        """
+        if not hasattr(signal, 'SIGWINCH'):
+            return
+        try:
+            handler = signal.signal(signal.SIGWINCH, self.on_resize)
+        except ValueError:
+            return
+        self.previous_handler = handler
+        self.watching = True
+
+    def unwatch_resize(self):
+        if not self.watching:
+            return
+        handler = self.previous_handler
+        signal.signal(signal.SIGWINCH, handler or signal.SIG_DFL)
+        self.watching = False
+
+
 def show_progress(msg, duration, millis=None):
     """
-    Show a message and a progress bar for the specified amount of time.
+    Show a message and a progress bar for the specified amount of time. See
+    `ProgressBar`.
 
     Note that you need to print a newline manually if you intend to post any
     other message to stdout.
     """
-    bar = cycle(['|', '/', '-', '\\'])
-    progress = is_progressbar_capable()
-    if not progress:
-        log(msg + '...', end='\r')
-        time.sleep(duration)
-        return
+    with ProgressBar() as progress:
+        progress.show(msg, duration, millis=millis)
 
-    msg = msg.strip() + ' '
-    out_msg = msg
-    elapsed = 0
-    while elapsed < duration:
-        if millis is not None:
-            out_msg = '[{}] {}'.format(format_millis(millis), msg)
-            millis += 100
-
-        spaces = get_stderr_size_unix().columns - len(out_msg) - 3
-        spaces = max(spaces, 40)
-        out = '{}{}  {}'.format(out_msg, '.' * spaces, next(bar))
-        log(out, end='\r')
-        time.sleep(0.1)
-        elapsed += 0.1
+
+class DeadlineExceeded(RuntimeError):
+    """
+    Raised when a build takes longer than allowed to start or finish. `url`
+    is the queue item or build that we were waiting for.
+    """
+
+    def __init__(self, msg, url):
+        RuntimeError.__init__(self, msg)
+        self.url = url
+
+
+def deadline_delay(delay, deadline, msg, url):
+    """
+    Get how long to wait before checking a build again, without going past
+    `deadline` (a `monotonic` timestamp, or None for no deadline). Raises
+    DeadlineExceeded with `msg` if the deadline has already passed.
+    """
+    if deadline is None:
+        return delay
+    left = deadline - monotonic()
+    if left <= 0:
+        raise DeadlineExceeded(msg, url)
+    return min(delay, left)
+
+
+class PollSchedule(object):
+    """
+    Fixed-rate schedule for polling a build: every check is due some delay
+    after the previous one was due, not after it ended, so the time spent
+    waiting for Jenkins doesn't stretch the interval. A check that runs late
+    by more than a whole delay is sent right away, and the schedule goes on
+    from there instead of sending a burst of checks to catch up.
+
+    Keeps the times when checks were sent, to report how regular they were
+    with --debug.
+    """
+
+    def __init__(self):
+        self.due = None
+        self.starts = []
+        self.jitter = []
+
+    def poll(self):
+        """
+        Record that a check is being sent now.
+        """
+        now = monotonic()
+        if self.due is None:
+            self.due = now
+        else:
+            self.jitter.append(abs(now - self.due))
+        self.starts.append(now)
+
+    def wait_time(self, delay):
+        """
+        Get how long to wait for the next check, due `delay` seconds after
+        the last one.
+        """
+        now = monotonic()
+        self.due = max(self.due + delay, now)
+        return self.due - now
+
+    def report(self, what):
+        """
+        Print the average time between checks and their jitter (how far from
+        their due time they were sent) as debug output.
+        """
+        if len(self.starts) < 2:
+            return
+        period = (self.starts[-1] - self.starts[0]) / (len(self.starts) - 1)
+        debug(
+            'Checked %s %d times, every %.2fs on average. Jitter: %.1f ms '
+            'mean, %.1f ms max'
+            % (
+                what,
+                len(self.starts),
+                period,
+                sum(self.jitter) * 1000 / len(self.jitter),
+                max(self.jitter) * 1000,
+            )
+        )
+
+
+def adaptive_interval(expected_end, stage, min_interval, max_interval):
+    """
+    Get the number of seconds to wait before checking a build again, based on
+    how much time it's expected to have left.
+
+    `expected_end` is the time (in millis, by the Jenkins clock) when the
+    build should end, and `stage` is its current stage as returned by
+    `Session.job_status`, whose start time and duration tell us what time it
+    is now for Jenkins. We wait a fourth of the remaining time, so builds are
+    checked rarely at the beginning and more often as they approach their
+    end, always within the given bounds.
+    """
+    start = stage.get('startTimeMillis', None)
+    duration = stage.get('durationMillis', None)
+    if expected_end is None or start is None or duration is None:
+        return min_interval
+    remaining = (expected_end - start - duration) / 1000.0
+    return max(min_interval, min(max_interval, remaining / 4))
 
 
 def deprecate(instead):
@@ -370,316 +844,1959 @@ def deprecate(instead):
     return decorator
 
 
-def stream_response(response):
-    while True:
-        response.text = response.read(8192)
-        if not response.text:
-            break
-        yield response
+class ContentDecoder:
+    """
+    Incremental decompressor for response bodies sent with a gzip or deflate
+    `Content-Encoding`.
+    """
 
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.obj = zlib.decompressobj()
+        self.first = True
 
-def init_ssl():
+    def decompress(self, data, max_length=0):
+        """
+        Decompress a block of data, returning at most `max_length` bytes (if
+        not 0). The rest of the input is kept in `unconsumed_tail`.
+        """
+        try:
+            return self.obj.decompress(data, max_length)
+        except zlib.error:
+            if not self.first or self.encoding != 'deflate':
+                raise
+            # some servers send raw deflate data, without the zlib header
+            self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.obj.decompress(data, max_length)
+        finally:
+            self.first = False
+
+    @property
+    def unconsumed_tail(self):
+        return self.obj.unconsumed_tail
+
+    def flush(self):
+        return self.obj.flush()
+
+
+def content_decoder(headers):
     """
-    Create an SSL context and load certificates from the system's directory.
+    Get a ContentDecoder for a response with the given headers, or None if
+    its body isn't compressed.
     """
-    context = ssl.create_default_context()
-    if CONFIG['verify_ssl']:
-        ca_dir = os.environ.get('SSL_CERT_DIR', '/etc/ssl/certs')
-        ca_file = os.environ.get('SSL_CERT_FILE', None)
-        if not ca_file:
-            bundles = [
-                '/etc/ssl/certs/ca-bundle.crt',
-                '/etc/ssl/certs/ca-certificates.crt',
-            ]
-            for bundle in bundles:
-                if os.path.exists(bundle):
-                    ca_file = bundle
-        context.load_verify_locations(ca_file, ca_dir, None)
-    else:
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
+    encoding = (headers.get('Content-Encoding') or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return ContentDecoder('gzip')
+    if encoding == 'deflate':
+        return ContentDecoder('deflate')
+    return None
 
-    return context
 
-
-def validate_params(definitions, supplied):
+def decode_content(body, headers):
     """
-    Check the dict of supplied params against the list of allowed choices.
+    Decompress a whole response body according to its `Content-Encoding`.
     """
-    if not supplied:
-        return True
+    decoder = content_decoder(headers)
+    if decoder is None:
+        return body
+    return decoder.decompress(body) + decoder.flush()
 
-    if supplied and not definitions:
-        raise ValueError('This build does not take any parameters')
 
-    nonexistent = [p for p in supplied if p not in definitions]
-    if nonexistent:
-        nonexistent = ', '.join(nonexistent)
-        raise ValueError('These parameters do not exist: ' + nonexistent)
+def debug_transfer(url, wire_bytes, decoded_bytes):
+    """
+    Print how many bytes of a response body came through the network and
+    how many they were after decompressing them.
+    """
+    if not CONFIG['debug']:
+        return
+    if wire_bytes == decoded_bytes:
+        debug('%s: %d bytes' % (url, wire_bytes))
+        return
+    saved = 100 - wire_bytes * 100.0 / (decoded_bytes or 1)
+    msg = '%s: %d bytes on the wire, %d decoded (%.0f%% saved)'
+    debug(msg % (url, wire_bytes, decoded_bytes, saved))
 
-    for key, value in supplied.items():
-        choices = definitions[key]
-        if choices is None:
-            continue
-        if str(value) not in choices:
-            msg = "Invalid choice '{}' for parameter '{}'."
-            msg += "\n\nValid choices are {}"
-            raise ValueError(msg.format(value, key, choices))
 
+class ResponseStream:
+    """
+    Iterator over the body of a response, in blocks of `blocksize` bytes.
 
-class Session:
-    def __init__(self, base, auth=None):
-        self.auth = auth
-        self.headers = {'User-Agent': 'foobar'}
-        self.context = init_ssl()
-        self.jar = CookieJar()
-        split = urlsplit(base)
-        self.base = '{}://{}'.format(split.scheme, split.netloc)
+    Every iteration yields the response itself with the current block in its
+    `text` attribute. The response headers are available from the start, even
+    before reading the first block.
 
-        if self.auth:
-            auth = ':'.join(self.auth)
-            if sys.version_info >= (3,):
-                basic = base64.b64encode(auth.encode('ascii')).decode('ascii')
-            else:
-                basic = base64.b64encode(auth)
-            self.headers['Authorization'] = 'Basic {}'.format(basic)
+    Compressed bodies are decompressed as they're read, and no block is ever
+    larger than `blocksize`, however well the data compresses. The number of
+    bytes read from the network and after decompressing them are kept in
+    `wire_bytes` and `decoded_bytes`.
+    """
 
-        self._get_crumb()
+    def __init__(self, response, blocksize=8192):
+        self.response = response
+        self.headers = response.headers
+        self.blocksize = blocksize
+        self.decoder = content_decoder(response.headers)
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self.done = False
+        self.callback = None  # called with the stream when it's finished
 
-    def _get_crumb(self):
-        """
-        Get the necessary crumb header if our Jenkins instance is CSRF
-        protected, and automatically add it to this session's default headers.
-        """
-        try:
-            args = 'xpath=concat(//crumbRequestField,":",//crumb)'
-            resp = self.get_url(self.base + '/crumbIssuer/api/xml?' + args)
-        except HTTPError as err:
-            # only ignore the error if it's a 404 (i.e. Jenkins is not CSRF
-            # protected)
-            if err.code != 404:
-                raise
-        else:
-            key, value = resp.text.split(':')
-            self.headers[key] = value
+    def __iter__(self):
+        return self
 
-    def get_url(self, url, data=None, stream=False, retries=5):
-        headers = self.headers.copy()
-        if data is not None:
-            data = urlencode(data).encode('utf-8')
-            headers['Content-Type'] = 'application/x-www-form-urlencoded'
-            retries = 1  # do not retry POSTs
-        req = Request(url, data, headers=headers)
-        self.jar.add_cookie_header(req)
-        for i in range(retries):  # pragma: nocover
-            try:
-                response = urlopen(req, context=self.context)
-            except HTTPError:
-                if i == retries - 1:
-                    raise
-                time.sleep(0.1)
-            else:
-                break
-        self.jar.extract_cookies(response, req)
-        if sys.version_info >= (3,):
-            response.headers = CaseInsensitiveDict(response.headers._headers)
-        else:
-            response.headers = CaseInsensitiveDict(response.headers.dict)
-        if stream:
-            return stream_response(response)
-        else:
-            response.text = response.read().decode('utf-8')
-            return response
+    def __next__(self):
+        while not self.done:
+            text = self.read_block()
+            if text:
+                self.decoded_bytes += len(text)
+                self.response.text = text
+                return self.response
 
-    def get_job_params(self, url):
-        """
-        Get the list of allowed parameters and their respective choices.
-        """
-        url = url.rstrip('/') + '/api/json'
-        response = self.get_url(url)
-        response = json.loads(response.text)
-        props = response.get('property', [])
-        definition_prop = 'hudson.model.ParametersDefinitionProperty'
-        defs = next(
-            (
-                p['parameterDefinitions']
-                for p in props
-                if p.get('_class', '') == definition_prop
-            ),
-            [],
-        )
-        if not defs:
-            return {}
+        raise StopIteration
 
-        params = {}
-        for definition in defs:
-            params[definition['name']] = definition.get('choices', None)
-        return params
+    next = __next__  # python 2
 
-    def launch_build(self, url, params=None):
+    def close(self):
         """
-        Submit job and return the queue item location.
+        Stop reading the response. The rest of the body is not downloaded,
+        and the connection is closed instead of going back to the pool.
         """
-        url = url.rstrip('/') + '/'
-        job_params = self.get_job_params(url)
-        validate_params(job_params, params)
+        if not self.done:
+            self.done = True
+            self.response.release_conn()
+            self.finished()
+
+    def finished(self):
+        if self.callback is not None:
+            callback, self.callback = self.callback, None
+            callback(self)
+
+    def read_block(self):
+        decoder = self.decoder
+        if decoder is not None and decoder.unconsumed_tail:
+            return decoder.decompress(decoder.unconsumed_tail, self.blocksize)
+
+        data = self.response.read(self.blocksize)
+        self.wire_bytes += len(data)
+        if not data:
+            self.done = True
+            self.response.release_conn()
+            url = getattr(self.response, 'url', None)
+            debug_transfer(url, self.wire_bytes, self.decoded_bytes)
+            self.finished()
+            return decoder.flush() if decoder is not None else data
+        if decoder is None:
+            return data
+        return decoder.decompress(data, self.blocksize)
+
+
+def log_decoder():
+    """
+    Get an incremental decoder for build logs, so that characters split
+    between two blocks of the log are decoded properly.
+    """
+    return codecs.getincrementaldecoder('utf-8')(errors='ignore')
 
-        url += 'buildWithParameters' if job_params else 'build'
-        url += '?delay=0'
-        log('Sending build request')
-        data = params or ""  # urllib will send a POST with an empty string
-        response = self.get_url(url, data=data)
 
-        assert (
-            'Location' in response.headers
-        ), 'Something went wrong with the Jenkins API'
-        location = response.headers['Location']
+class LineFilter:
+    """
+    Filter a build log as it's downloaded, keeping only the lines that match
+    any of a list of regular expressions, like grep does.
+
+    The log is fed in blocks of raw bytes, and only the lines that match
+    (plus `before` and `after` lines of context around them) are returned,
+    so the rest of the log is never split into lines or decoded. Like in
+    grep, the patterns are matched against one line at a time, without its
+    new line, so they never match across lines. Once
+    `max_count` lines have matched and their context has been returned,
+    `done` is set and the rest of the log can be skipped.
+    """
 
-        assert 'queue' in location, 'Something went wrong with the Jenkins API'
-        return location
+    separator = b'--\n'
 
-    def get_queue_status(self, location):
+    def __init__(self, patterns, before=0, after=0, max_count=None):
+        patterns = [
+            p if isinstance(p, bytes) else p.encode('utf-8') for p in patterns
+        ]
+        self.regex = re.compile(
+            b'|'.join(b'(?:' + p + b')' for p in patterns), re.MULTILINE
+        )
+        self.before = before
+        self.after = after
+        self.max_count = max_count
+        self.context = deque(maxlen=before)
+        self.partial = b''
+        self.matches = 0
+        self.after_left = 0
+        self.emitted = False
+        self.skipped = False
+        self.done = False
+
+    def feed(self, data):
         """
-        Check the status of a queue item. Returns the build url if the job is
-        already executing, or None if it's still in the queue.
+        Add a block of the log and return the lines to keep from it.
         """
-        queue = location.rstrip('/') + '/api/json'
-        response = self.get_url(queue)
-        response = json.loads(response.text)
-        if response.get('cancelled', False):
-            raise RuntimeError('Build was cancelled')
-        if response.get('executable', False):
-            return response['executable']['url']
-        return None
-
-    @deprecate(instead='wait_queue')
-    def wait_queue_item(self, *args, **kwargs):
-        pass
-
-    def wait_queue(self, location, interval=5.0):
+        if self.done:
+            return b''
+        data = self.partial + data
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        return self.filter(data, end)
+
+    def flush(self):
         """
-        Wait until the item starts building.
+        Return the lines to keep from the end of the log, if it doesn't end
+        with a new line.
         """
-        while True:
-            job_url = self.get_queue_status(location)
-            if job_url is not None:
-                break
-            show_progress('Job queued', interval)
-        log('')
-        return job_url
+        data, self.partial = self.partial, b''
+        if self.done or not data:
+            return b''
+        return self.filter(data + b'\n', len(data) + 1)
 
-    @deprecate(instead='job_status')
-    def get_job_status(self, *args, **kwargs):
-        pass
+    def filter(self, data, end):
+        """
+        Get the lines to keep from `data[:end]`, which is made of whole lines.
+        """
+        out = []
+        pos = 0
+        while pos < end and not self.done:
+            if self.after_left:
+                start, pos = pos, data.index(b'\n', pos) + 1
+                matched = self.regex.search(data, start, pos - 1) is not None
+            else:
+                found = self.search(data, pos, end)
+                if found is None:
+                    self.skip(data, pos, end)
+                    break
+                start, stop = found
+                self.skip(data, pos, start)
+                pos = stop
+                matched = True
+            self.keep(out, data[start:pos], matched)
+        return b''.join(out)
+
+    def search(self, data, pos, end):
+        """
+        Find the first line in `data[pos:end]` that matches, and return its
+        (start, stop) boundaries, with its new line. Returns None if no line
+        matches.
 
-    def job_status(self, build_url):
+        The whole block is searched at once, and only the lines where the
+        regex matched are looked at on their own, to make sure it didn't
+        match across lines.
         """
-        Check the status of a running build.
+        while pos < end:
+            match = self.regex.search(data, pos, end)
+            if match is None or match.start() >= end:
+                return None
+            start = max(pos, data.rfind(b'\n', pos, match.start()) + 1)
+            stop = data.index(b'\n', match.start()) + 1
+            if self.regex.search(data, start, stop - 1) is not None:
+                return start, stop
+            pos = stop
+        return None
 
-        Returns a tuple with the status of the build and the current stage.
-        The status is True on successful exit, False on failure or None if the
-        build is still running.
+    def keep(self, out, line, matched):
         """
-        poll_url = build_url.rstrip('/') + '/wfapi/describe'
-        try:
-            response = self.get_url(poll_url)
-        except HTTPError as error:
-            if error.code == 404:
-                build_number = build_url.rstrip('/').rpartition('/')[2]
-                error.msg = 'Build #%s does not exist' % build_number
-            raise
-        response = json.loads(response.text)
-
-        status = response.get('status', '')
-        stages = response.get('stages', [{}])
-        if status == 'NOT_EXECUTED':
-            if response.get('durationMillis', 0) == 0:
-                # Build has just been launched. Report it as in_progress
-                return None, {}
-            # Build finished as not_executed. Probably an in your Jenkinsfile
-            return False, stages[-1]
-        elif status == 'IN_PROGRESS':
-            in_progress = [
-                s for s in stages if s.get('status', '') == 'IN_PROGRESS'
-            ]
-            in_progress = in_progress or [{}]
-            return None, in_progress[0]
+        Add a line that matched, or a line of context after one, to `out`.
+        """
+        limit = self.max_count is not None and self.matches >= self.max_count
+        if matched and not limit:
+            if self.skipped and self.emitted and (self.before or self.after):
+                out.append(self.separator)
+            out.extend(self.context)
+            self.context.clear()
+            self.matches += 1
+            self.after_left = self.after
         else:
-            # Jenkins returns false negatives in the 'status' field sometimes.
-            # Instead of trusting 'status', we will determine if the build
-            # failed by checking if any of the stages failed.
-            last = stages[-1]
-            status = all(
-                s.get('status', '') in ('SUCCESS', 'NOT_EXECUTED')
-                for s in stages
-            )
-            return status, last
-
-    @deprecate(instead='wait_job')
-    def wait_for_job(self, *args, **kwargs):
-        pass
-
-    def wait_job(self, build_url, interval=5.0):
+            self.after_left -= 1
+        out.append(line)
+        self.emitted = True
+        self.skipped = False
+        limit = self.max_count is not None and self.matches >= self.max_count
+        self.done = limit and not self.after_left
+
+    def skip(self, data, pos, stop):
         """
-        Wait until the build finishes.
+        Leave out the lines in `data[pos:stop]`, but remember the last ones as
+        context for the next match.
         """
-        name = '#' + build_url.rstrip('/').split('/')[-1]
-        last_stage = None
-        while True:
-            status, stage = self.job_status(build_url)
-            if status is not None:
-                status_name = 'SUCCESS' if status else 'FAILURE'
-                log('\nJob', name, 'ended in', status_name)
-                return status
-
-            stage_name = stage.get('name', '')
-            msg = stage_name or 'Build %s in progress' % name
-            millis = stage.get('durationMillis', None)
-            if stage_name != last_stage:
-                last_stage = stage_name
-                msg = '\n' + msg
-            show_progress(msg, interval, millis=millis)
-
-    def retrieve_log(self, build_url):
+        if pos >= stop:
+            return
+        if not self.before:
+            self.skipped = True
+            return
+        lines = data.count(b'\n', pos, stop)
+        if len(self.context) + lines > self.before:
+            self.skipped = True
+        start = stop
+        for _ in range(min(lines, self.before)):
+            index = data.rfind(b'\n', pos, start - 1)
+            start = index + 1 if index >= 0 else pos
+        last = data[start:stop].split(b'\n')[:-1]
+        self.context.extend(line + b'\n' for line in last)
+
+
+def grep_filter():
+    """
+    Create a `LineFilter` from the --grep options, or return None if there
+    are no patterns to look for.
+    """
+    if not CONFIG['grep']:
+        return None
+    return LineFilter(
+        CONFIG['grep'],
+        CONFIG['before_context'],
+        CONFIG['after_context'],
+        CONFIG['max_count'],
+    )
+
+
+def stream_response(response):
+    return ResponseStream(response)
+
+
+SSL_CONTEXTS = {}
+SSL_CONTEXTS_LOCK = threading.Lock()
+
+
+def init_ssl():
+    """
+    Create an SSL context and load certificates from the system's directory.
+
+    Loading the certificates is slow, so contexts are created only once for
+    every combination of settings and shared by all the sessions.
+    """
+    verify = CONFIG['verify_ssl']
+    ca_dir = os.environ.get('SSL_CERT_DIR', '/etc/ssl/certs')
+    ca_file = os.environ.get('SSL_CERT_FILE', None)
+    key = (verify, ca_file, ca_dir)
+    with SSL_CONTEXTS_LOCK:
+        if key in SSL_CONTEXTS:
+            return SSL_CONTEXTS[key]
+
+        if verify:
+            context = ssl.create_default_context()
+            if not ca_file:
+                bundles = [
+                    '/etc/ssl/certs/ca-bundle.crt',
+                    '/etc/ssl/certs/ca-certificates.crt',
+                ]
+                ca_file = next(
+                    (b for b in bundles if os.path.exists(b)), None
+                )
+            context.load_verify_locations(ca_file, ca_dir, None)
+        else:
+            protocol = getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23)
+            context = ssl.SSLContext(protocol)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        SSL_CONTEXTS[key] = context
+        return context
+
+
+def timed_create_connection(timings):
+    """
+    Get a replacement for `socket.create_connection` that records in the
+    `timings` dict how long it took to resolve the host name ('dns') and to
+    connect to it ('connect').
+    """
+
+    def create_connection(address, *args, **kwargs):
+        start = monotonic()
+        host, port = address[:2]
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        resolved = monotonic()
+        timings['dns'] = resolved - start
+        error = socket.error('getaddrinfo returned an empty list')
+        for info in infos:
+            try:
+                sock = socket.create_connection(info[4][:2], *args, **kwargs)
+            except socket.error as e:
+                error = e
+                continue
+            timings['connect'] = monotonic() - resolved
+            return sock
+        raise error
+
+    return create_connection
+
+
+HTTPS_CONNECTION_CLASS = []
+
+
+def https_connection_class():
+    """
+    Get the class for our HTTPS connections. It is created the first time
+    it's needed, since it has to subclass `HTTPSConnection`.
+    """
+    if HTTPS_CONNECTION_CLASS:
+        return HTTPS_CONNECTION_CLASS[0]
+
+    class ResumableHTTPSConnection(http_client.HTTPSConnection):
+        """
+        An HTTPS connection that tries to resume a previous TLS session, so
+        that reconnecting to the same server only needs an abbreviated
+        handshake.
+        """
+
+        tls_session = None
+
+        def connect(self):
+            base = http_client.HTTPSConnection
+            if self.tls_session is None or not hasattr(ssl, 'SSLSession'):
+                return base.connect(self)
+
+            http_client.HTTPConnection.connect(self)
+            server_hostname = self._tunnel_host or self.host
+            self.sock = self._context.wrap_socket(
+                self.sock,
+                server_hostname=server_hostname,
+                session=self.tls_session,
+            )
+
+    HTTPS_CONNECTION_CLASS.append(ResumableHTTPSConnection)
+    return ResumableHTTPSConnection
+
+
+class ConnectionPool:
+    """
+    A pool of persistent HTTP/1.1 connections, grouped by host.
+
+    Requests sent through `urlopen` reuse an idle connection to the same host
+    if there is one, so polling a Jenkins instance doesn't pay for a new TCP
+    connection and TLS handshake every time. A connection goes back to the
+    pool once its response has been read completely (see `release_conn`).
+
+    Sockets that were closed on the server's end while they sat idle in the
+    pool are detected when we try to reuse them, and the request is sent
+    again over a fresh connection. This is only done when the server can't
+    have processed the request (see `is_stale`), so a build is never
+    launched twice.
+    """
+
+    redirect_codes = (301, 302, 303, 307, 308)
+    max_redirects = 10
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+    def __init__(self, context=None, maxsize=4, timeout=None):
+        self.context = context  # created on the first HTTPS connection
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle = {}
+        self.tls_sessions = {}
+        self.lock = threading.Lock()
+
+    def new_connection(self, scheme, netloc):
+        """
+        Open a new connection to the given host, going through a proxy if the
+        environment says so.
+        """
+        if scheme == 'https' and self.context is None:
+            self.context = init_ssl()
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        host = netloc.rpartition('@')[2]
+        proxy = urllib_request.getproxies().get(scheme)
+        bypass = urllib_request.proxy_bypass(host.split(':')[0])
+        if proxy and not bypass:
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            split = urlsplit(proxy)
+            proxy = split.netloc.rpartition('@')[2]
+            proxy_headers = {}
+            if split.username:
+                credentials = (
+                    unquote(split.username),
+                    unquote(split.password or ''),
+                )
+                proxy_headers['Proxy-Authorization'] = basic_auth(credentials)
+            if scheme == 'https':
+                conn = https_connection_class()(
+                    proxy, context=self.context, **kwargs
+                )
+                conn.set_tunnel(host, headers=proxy_headers)
+            else:
+                conn = http_client.HTTPConnection(proxy, **kwargs)
+                conn.absolute_urls = True
+                conn.proxy_headers = proxy_headers
+        elif scheme == 'https':
+            conn = https_connection_class()(
+                host, context=self.context, **kwargs
+            )
+        else:
+            conn = http_client.HTTPConnection(host, **kwargs)
+
+        if scheme == 'https':
+            with self.lock:
+                conn.tls_session = self.tls_sessions.get((scheme, netloc))
+        return conn
+
+    def get_connection(self, key):
+        """
+        Get an idle connection for the given (scheme, netloc) key, or open a
+        new one if there are none left. Returns a tuple with the connection
+        and a boolean indicating whether it's been used before.
+        """
+        with self.lock:
+            idle = self.idle.get(key, [])
+            if idle:
+                return idle.pop(), True
+        return self.new_connection(*key), False
+
+    def put_connection(self, key, conn, response):
+        """
+        Give a connection back to the pool after its response has been
+        consumed. Connections with pending data or that the server asked us to
+        close are discarded instead.
+        """
+        reusable = response.isclosed() and not response.will_close
+        if reusable:
+            with self.lock:
+                idle = self.idle.setdefault(key, [])
+                if len(idle) < self.maxsize:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def clear(self):
+        """
+        Close all the idle connections in the pool.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def is_stale(self, request, error, sent):
+        """
+        Tell whether a request that failed with `error` on a reused
+        connection can be sent again, because the server closed the
+        connection while it was idle and never processed the request.
+
+        That's the case if the connection was reset or broken while we were
+        sending the request, or if it was closed before we got a single byte
+        of the response (and the request can be repeated safely anyway).
+        Timeouts are never retried, since the server may still be working on
+        the request.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if not sent:
+            code = getattr(error, 'errno', None)
+            return code in (errno.EPIPE, errno.ECONNRESET)
+        if request.get_method() not in self.idempotent_methods:
+            return False
+        if isinstance(error, getattr(http_client, 'RemoteDisconnected', ())):
+            return True
+        # python 2 doesn't have RemoteDisconnected, and says this instead
+        return isinstance(error, http_client.BadStatusLine) and str(
+            error.line
+        ).startswith('No status line received')
+
+    def send(self, request):
+        """
+        Send a request through a pooled connection and return the response.
+        """
+        url = request.get_full_url()
+        split = urlsplit(url)
+        key = (split.scheme, split.netloc)
+        selector = split.path or '/'
+        if split.query:
+            selector += '?' + split.query
+        headers = dict(request.header_items())
+
+        while True:
+            conn, reused = self.get_connection(key)
+            path = url if getattr(conn, 'absolute_urls', False) else selector
+            conn_headers = headers
+            if getattr(conn, 'proxy_headers', None):
+                conn_headers = dict(headers)
+                conn_headers.update(conn.proxy_headers)
+            timings = dict.fromkeys(['dns', 'connect', 'tls', 'first_byte'])
+            sent = False
+            try:
+                start = monotonic()
+                if not reused:
+                    conn._create_connection = timed_create_connection(timings)
+                    conn.connect()
+                    if split.scheme == 'https' and timings['connect']:
+                        timings['tls'] = monotonic() - start - timings['dns']
+                        timings['tls'] -= timings['connect']
+                    start = monotonic()
+                conn.request(
+                    request.get_method(), path, request.data, conn_headers
+                )
+                sent = True
+                response = conn.getresponse()
+                timings['first_byte'] = monotonic() - start
+            except (http_client.HTTPException, socket.error) as error:
+                conn.close()
+                if reused and self.is_stale(request, error, sent):
+                    # stale keep-alive connection. Retry with a new one
+                    continue
+                raise
+            break
+
+        # Remember the TLS session for the next connection to this host. TLS
+        # 1.3 servers only send it after the handshake, so it's not available
+        # until we've read something
+        tls_session = getattr(conn.sock, 'session', None)
+        if tls_session is not None:
+            with self.lock:
+                self.tls_sessions[key] = tls_session
+
+        response.url = url
+        response.timings = timings
+        response.release_conn = functools.partial(
+            self.put_connection, key, conn, response
+        )
+        if not hasattr(response, 'info'):
+            response.info = lambda: response.msg
+        if not hasattr(response, 'headers'):
+            response.headers = response.msg
+        return response
+
+    def urlopen(self, request):
+        """
+        Send a request and return the response, following redirects and
+        raising `HTTPError` for error status codes like `urllib` would.
+
+        The caller is responsible for calling `response.release_conn()` after
+        reading the whole body.
+        """
+        for _ in range(self.max_redirects):
+            response = self.send(request)
+            status = response.status
+            location = response.getheader('Location')
+            if status in self.redirect_codes and location:
+                if request.get_method() not in ('GET', 'HEAD'):
+                    return response
+                response.read()
+                response.release_conn()
+                url = urljoin(request.get_full_url(), location)
+                headers = dict(request.header_items())
+                request = urllib_request.Request(url, headers=headers)
+                continue
+
+            if status >= 400:
+                body = decode_content(response.read(), response.msg)
+                response.release_conn()
+                raise urllib_request.HTTPError(
+                    response.url,
+                    status,
+                    response.reason,
+                    response.msg,
+                    io.BytesIO(body),
+                )
+            return response
+
+        raise urllib_request.HTTPError(
+            response.url, status, 'Too many redirects', response.msg, None
+        )
+
+
+def default_cache_dir():
+    """
+    Get the directory where we keep our cache files.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache'
+    )
+    return os.path.join(base, 'launch_jenkins')
+
+
+def write_atomic(path, text, mode=0o666):
+    """
+    Atomically replace the contents of a file with `text`, so that readers
+    never see it half written. New files are created with the permissions in
+    `mode` (minus the umask). `text` is written as UTF-8, unless it's
+    already bytes (as json.dumps returns in python 2).
+    """
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    # threads writing the same file each need their own temporary file
+    thread = threading.current_thread().ident
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), thread)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with io.open(fd, 'wb') as file:
+            file.write(text)
+        getattr(os, 'replace', os.rename)(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def write_private(path, text):
+    """
+    Atomically replace the contents of a file with `text`, making sure it is
+    only readable by the current user.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    write_atomic(path, text, 0o600)
+
+
+class CrumbCache:
+    """
+    Keeps the crumb and cookies of a Jenkins session on disk, so that new
+    sessions for the same instance and user can start sending requests right
+    away. Entries expire after `ttl` seconds.
+
+    Only the crumb header and cookies are stored, never the credentials. The
+    cache is just an optimization, so errors reading or writing it are
+    ignored.
+    """
+
+    def __init__(self, base, user=None, directory=None, ttl=1800):
+        self.directory = directory or default_cache_dir()
+        key = '{}\n{}'.format(base, user or '').encode('utf-8')
+        key = hashlib.sha1(key).hexdigest()
+        self.path = os.path.join(self.directory, key + '.json')
+        self.cookies_path = os.path.join(self.directory, key + '.cookies')
+        self.ttl = ttl
+
+    def load(self, jar):
+        """
+        Load the cached cookies into `jar` and return the cached crumb as a
+        (header, value) tuple, or an empty tuple if the instance doesn't use
+        crumbs. Returns None if there is no valid entry in the cache.
+        """
+        try:
+            with io.open(self.path, encoding='utf-8') as file:
+                entry = json.load(file)
+            if time.time() - entry['time'] > self.ttl:
+                return None
+            jar.load(self.cookies_path, ignore_discard=True)
+        except (IOError, OSError, ValueError, KeyError, cookiejar.LoadError):
+            return None
+        return tuple(entry['crumb'] or ())
+
+    def save(self, crumb, jar):
+        """
+        Save a crumb tuple (see `load`) and the cookies in `jar`.
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, 0o700)
+            # create the file with restricted permissions before writing
+            path = self.cookies_path
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+            jar.save(path, ignore_discard=True)
+            entry = {'time': time.time(), 'crumb': list(crumb)}
+            write_private(self.path, json.dumps(entry, ensure_ascii=False))
+        except (IOError, OSError):
+            pass
+
+    def clear(self):
+        """
+        Remove the cached entry.
+        """
+        for path in (self.path, self.cookies_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ParamsCache:
+    """
+    Keeps the parameter definitions of the jobs we launch, so that we don't
+    have to ask Jenkins for them every time. Entries are kept in memory and,
+    if a `directory` is given, on disk too, and they expire after `ttl`
+    seconds.
+    """
+
+    def __init__(self, directory=None, ttl=1800):
+        self.directory = directory
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def _path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.params.json')
+
+    def get(self, url):
+        """
+        Get the cached parameter definitions of a job, or None if they are not
+        in the cache or have expired.
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is None and self.directory:
+            try:
+                with io.open(self._path(url), encoding='utf-8') as file:
+                    entry = json.load(file)
+                entry = (entry['time'], entry['params'])
+            except (IOError, OSError, ValueError, KeyError):
+                return None
+            with self.lock:
+                self.entries[url] = entry
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def set(self, url, params):
+        """
+        Save the parameter definitions of a job.
+        """
+        entry = (time.time(), params)
+        with self.lock:
+            self.entries[url] = entry
+        if self.directory:
+            text = json.dumps({'time': entry[0], 'params': params})
+            try:
+                write_private(self._path(url), text)
+            except (IOError, OSError):
+                pass
+
+    def discard(self, url):
+        """
+        Remove the cached parameter definitions of a job.
+        """
+        with self.lock:
+            self.entries.pop(url, None)
+        if self.directory:
+            try:
+                os.remove(self._path(url))
+            except OSError:
+                pass
+
+
+class RetryPolicy:
+    """
+    Decides which failed requests are worth sending again, and how long to
+    wait before each new attempt.
+
+    A request is retried if the connection fails, or if Jenkins answers with
+    one of the status codes in `statuses`, which by default are the ones it
+    sends while it's restarting or overloaded. Other errors, like a 404, are
+    raised right away.
+
+    The delay doubles with every attempt, from `backoff` up to `max_backoff`
+    seconds, and a random part of it is dropped so that many clients don't
+    come back at the same time. A `Retry-After` header from the server takes
+    precedence. We give up after `attempts` attempts in total, or when the
+    next one would start more than `max_elapsed` seconds after the first.
+
+    Only idempotent requests are retried. GETs are, POSTs are not unless the
+    caller says so, since retrying a build request could launch two builds.
+    """
+
+    statuses = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        attempts=5,
+        backoff=0.5,
+        max_backoff=30,
+        max_elapsed=300,
+        statuses=None,
+        jitter=True,
+    ):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_elapsed = max_elapsed
+        if statuses is not None:
+            self.statuses = tuple(statuses)
+        self.jitter = jitter
+
+    def retryable(self, error):
+        """
+        Check whether an exception raised while sending a request is worth
+        retrying.
+        """
+        if isinstance(error, urllib_request.HTTPError):
+            return error.code in self.statuses
+        if isinstance(error, ssl.SSLError):
+            # most likely a certificate problem, which won't go away
+            return False
+        return isinstance(
+            error,
+            (http_client.HTTPException, socket.error, urllib_request.URLError),
+        )
+
+    def delay(self, attempt, error=None):
+        """
+        Get the number of seconds to wait after the given attempt (starting
+        at 1) failed with `error`.
+        """
+        retry_after = parse_retry_after(getattr(error, 'headers', None))
+        if retry_after is not None:
+            return retry_after
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(delay / 2, delay)
+        return delay
+
+    def next_delay(self, attempt, error, elapsed, idempotent=True):
+        """
+        Get how long to wait before retrying a request that failed with
+        `error` on its attempt number `attempt`, `elapsed` seconds after the
+        first one was sent. Returns None if it shouldn't be retried.
+        """
+        if not idempotent or attempt >= self.attempts:
+            return None
+        if not self.retryable(error):
+            return None
+        delay = self.delay(attempt, error)
+        if self.max_elapsed is not None:
+            if elapsed + delay > self.max_elapsed:
+                return None
+        return delay
+
+
+def parse_retry_after(headers):
+    """
+    Get the number of seconds to wait from the `Retry-After` header, which can
+    be a number of seconds or a date. Returns None if there's no such header.
+    """
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    from email.utils import parsedate_tz, mktime_tz
+
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+
+def output_file(build_url, filename=None):
+    """
+    Get the file where the output of a build should be saved.
+
+    This is `filename` if given, or the one set in CONFIG['output'], or a
+    default one named after the job.
+    """
+    build_url = build_url.rstrip('/') + '/'
+    if filename:
+        return filename
+    if CONFIG['output'] and CONFIG['output'] is not True:
+        return CONFIG['output']
+    job_name = build_url[build_url.find('/job/') :]
+    job_name = job_name.replace('/', '_').replace('_job_', '_').strip('_')
+    return job_name + '.txt'
+
+
+@contextlib.contextmanager
+def open_output(build_url, filename=None):
+    """
+    Open the file where the output of a build should be saved (see
+    `output_file`). File-like objects (e.g. sys.stdout) are used as they are
+    and not closed afterwards.
+    """
+    file = output_file(build_url, filename)
+    if hasattr(file, 'write'):
+        yield file
+        return
+
+    with io.open(file, 'w', encoding='utf-8') as opened:
+        yield opened
+    log('Job output saved to', file)
+
+
+class PartialLog:
+    """
+    The marker kept next to a build log while it's being downloaded to
+    `path`, so that an interrupted download can be resumed later.
+
+    It records the build the log belongs to, how many bytes of the log have
+    been saved (`offset`, as Jenkins counts them in its raw log), and the
+    size of the file at that point, which differs from the offset because
+    console notes and invalid UTF-8 are left out. A marker for any other
+    build is ignored, so a partial log is never completed with the output of
+    a different build.
+    """
+
+    def __init__(self, path, build_url):
+        self.path = path
+        self.marker = path + '.partial'
+        self.build_url = build_url.rstrip('/') + '/'
+
+    def load(self):
+        """
+        Get the (offset, size) to resume the download from, or (0, 0) if
+        there is nothing to resume.
+        """
+        try:
+            with io.open(self.marker, encoding='utf-8') as file:
+                data = json.load(file)
+            file_size = os.path.getsize(self.path)
+            offset, size = int(data['offset']), int(data['size'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return 0, 0
+        if data.get('build_url') != self.build_url or size > file_size:
+            return 0, 0
+        return offset, size
+
+    def save(self, offset, size):
+        data = {'build_url': self.build_url, 'offset': offset, 'size': size}
+        write_private(self.marker, json.dumps(data))
+
+    def remove(self):
+        try:
+            os.remove(self.marker)
+        except OSError:
+            pass
+
+
+def validate_params(definitions, supplied):
+    """
+    Check the dict of supplied params against the list of allowed choices.
+    """
+    if not supplied:
+        return True
+
+    if supplied and not definitions:
+        raise ValueError('This build does not take any parameters')
+
+    nonexistent = [p for p in supplied if p not in definitions]
+    if nonexistent:
+        nonexistent = ', '.join(nonexistent)
+        raise ValueError('These parameters do not exist: ' + nonexistent)
+
+    for key, value in supplied.items():
+        choices = definitions[key]
+        if choices is None:
+            continue
+        if str(value) not in choices:
+            msg = "Invalid choice '{}' for parameter '{}'."
+            msg += "\n\nValid choices are {}"
+            raise ValueError(msg.format(value, key, choices))
+
+
+def url_endpoint(url):
+    """
+    Get the endpoint a url belongs to, for grouping requests in statistics.
+    This is its path with job names and numbers (of builds or queue items)
+    replaced by placeholders, e.g. /job/*/job/*/N/wfapi/describe.
+    """
+    path = urlsplit(url).path
+    path = re.sub(r'/job/[^/]+', '/job/*', path)
+    return re.sub(r'/\d+(?=/|$)', '/N', path)
+
+
+# What every endpoint is used for, to name the requests in traces
+TRACE_SPANS = [
+    (r'/crumbIssuer/', 'crumb fetch'),
+    (r'/queue/item/N/api/json$', 'queue poll'),
+    (r'/job/\*/(build|buildWithParameters)$', 'build request'),
+    (r'/job/\*/N/wfapi/describe$', 'status poll'),
+    (r'/job/\*/N/api/json$', 'build times'),
+    (r'/job/\*/api/json$', 'parameter discovery'),
+    (r'/(consoleText|logText/progressiveText)$', 'log download'),
+]
+
+
+def trace_span_name(endpoint):
+    """
+    Get the name of a request to `endpoint` (see `url_endpoint`) in traces.
+    """
+    for pattern, name in TRACE_SPANS:
+        if re.search(pattern, endpoint):
+            return name
+    return endpoint
+
+
+def api_url(url, tree):
+    """
+    Get the json API url of a Jenkins object, asking only for the fields in
+    `tree`.
+    """
+    return url.rstrip('/') + '/api/json?' + urlencode({'tree': tree})
+
+
+def basic_auth(auth):
+    """
+    Get the value of the Authorization header for a (user, token) tuple.
+    """
+    auth = ':'.join(auth)
+    if sys.version_info >= (3,):
+        basic = base64.b64encode(auth.encode('ascii')).decode('ascii')
+    else:
+        basic = base64.b64encode(auth)
+    return 'Basic {}'.format(basic)
+
+
+def parse_job_params(response):
+    """
+    Get the allowed parameters and their respective choices from the json
+    description of a job.
+    """
+    props = response.get('property', [])
+    definition_prop = 'hudson.model.ParametersDefinitionProperty'
+    defs = next(
+        (
+            p['parameterDefinitions']
+            for p in props
+            if p.get('_class', '') == definition_prop
+        ),
+        [],
+    )
+    if not defs:
+        return {}
+
+    params = {}
+    for definition in defs:
+        params[definition['name']] = definition.get('choices', None)
+    return params
+
+
+def parse_queue_status(response):
+    """
+    Get the build url from the json description of a queue item, or None if
+    it hasn't started building yet.
+    """
+    if response.get('cancelled', False):
+        raise RuntimeError('Build was cancelled')
+    if response.get('executable', False):
+        return response['executable']['url']
+    return None
+
+
+def parse_job_status(response):
+    """
+    Get the status of a build and its current stage from its pipeline
+    description (i.e. the output of wfapi/describe). See `Session.job_status`.
+    """
+    status = response.get('status', '')
+    stages = response.get('stages', [{}])
+    if status == 'NOT_EXECUTED':
+        if response.get('durationMillis', 0) == 0:
+            # Build has just been launched. Report it as in_progress
+            return None, {}
+        # Build finished as not_executed. Probably an in your Jenkinsfile
+        return False, stages[-1]
+    elif status == 'IN_PROGRESS':
+        in_progress = [
+            s for s in stages if s.get('status', '') == 'IN_PROGRESS'
+        ]
+        in_progress = in_progress or [{}]
+        return None, in_progress[0]
+    else:
+        # Jenkins returns false negatives in the 'status' field sometimes.
+        # Instead of trusting 'status', we will determine if the build
+        # failed by checking if any of the stages failed.
+        last = stages[-1]
+        status = all(
+            s.get('status', '') in ('SUCCESS', 'NOT_EXECUTED')
+            for s in stages
+        )
+        return status, last
+
+
+def parse_expected_end(response):
+    """
+    Get the time when a build is expected to end from its json description.
+    See `Session.get_expected_end`.
+    """
+    estimated = response.get('estimatedDuration', -1)
+    if estimated is None or estimated < 0:
+        return None
+    return response.get('timestamp', 0) + estimated
+
+
+class QueueWatcher(object):
+    """
+    Follows many queue items of a Jenkins instance with a single request to
+    /queue/api/json every `tick` seconds, instead of one request per item.
+    Only items that are no longer in the queue are looked up on their own,
+    to find the build they started or whether they were cancelled.
+
+    It can be shared by the threads waiting for those items: the ones that
+    ask within `tick` seconds of the last request reuse its answer. `items`
+    has the queue entries from that answer, by id.
+    """
+
+    def __init__(self, session, tick=1.0):
+        self.session = session
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.items = {}
+        self.fetched = None
+
+    def get_queue_status(self, location):
+        """
+        Same as `Session.get_queue_status`.
+        """
+        item_id = location.rstrip('/').rpartition('/')[2]
+        with self.lock:
+            if self.fetched is None or monotonic() - self.fetched >= self.tick:
+                self.refresh(location)
+            queued = item_id in self.items
+        if queued:
+            return None
+        return self.session.get_queue_status(location)
+
+    def refresh(self, location):
+        queue_url = location.rpartition('/queue/item/')[0] + '/queue'
+        response = self.session.get_url(api_url(queue_url, QUEUE_TREE))
+        items = json.loads(response.text).get('items', [])
+        self.items = {str(item.get('id')): item for item in items}
+        self.fetched = monotonic()
+
+
+class Session:
+    def __init__(
+        self,
+        base,
+        auth=None,
+        pool_size=4,
+        cache=None,
+        retry=None,
+        timeout=None,
+        hooks=None,
+    ):
+        self.auth = auth
+        self.hooks = list(hooks or [])
+        self.queue_watcher = None
+        self.headers = {
+            'User-Agent': 'foobar',
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        if timeout is None:
+            timeout = CONFIG['request_timeout']
+        self.pool = ConnectionPool(maxsize=pool_size, timeout=timeout)
+        self.retry = retry or RetryPolicy()
+        self.jar = cookiejar.LWPCookieJar()
+        split = urlsplit(base)
+        self.base = '{}://{}'.format(split.scheme, split.netloc)
+        self.crumb = ()
+        self.crumb_cache = None
+        self.crumb_cached = False
+        # the number of times the crumb was replaced, and the lock to do it
+        self.crumb_version = 0
+        self.crumb_lock = threading.RLock()
+
+        if self.auth:
+            self.headers['Authorization'] = basic_auth(self.auth)
+
+        if cache is None:
+            cache = CONFIG['cache']
+        self.params_cache = ParamsCache(
+            default_cache_dir() if cache else None, ttl=CONFIG['cache_ttl']
+        )
+        if cache:
+            user = self.auth[0] if self.auth else None
+            self.crumb_cache = CrumbCache(
+                self.base, user, ttl=CONFIG['cache_ttl']
+            )
+            self.crumb_cached = self._load_crumb()
+        if not self.crumb_cached:
+            self._get_crumb()
+
+    @property
+    def context(self):
+        """
+        The SSL context of this session's connections. It's only created when
+        it's needed, since loading the certificates takes a while.
+        """
+        if self.pool.context is None:
+            self.pool.context = init_ssl()
+        return self.pool.context
+
+    @context.setter
+    def context(self, context):
+        self.pool.context = context
+
+    def _get_crumb(self):
+        """
+        Get the necessary crumb header if our Jenkins instance is CSRF
+        protected, and automatically add it to this session's default headers.
+        """
+        try:
+            resp = self.get_url(self.base + CRUMB_URL)
+        except urllib_request.HTTPError as err:
+            # only ignore the error if it's a 404 (i.e. Jenkins is not CSRF
+            # protected)
+            if err.code != 404:
+                raise
+        else:
+            key, value = resp.text.split(':')
+            self.headers[key] = value
+            self.crumb = (key, value)
+        if self.crumb_cache:
+            self.crumb_cache.save(self.crumb, self.jar)
+
+    def _load_crumb(self):
         """
-        Get the build log and return it as a string.
+        Get the crumb and cookies from the cache. Returns whether they were
+        there.
+        """
+        crumb = self.crumb_cache.load(self.jar)
+        if crumb is None:
+            return False
+        if crumb:
+            key, value = crumb
+            self.headers[key] = value
+        self.crumb = crumb
+        return True
+
+    def get_url(
+        self,
+        url,
+        data=None,
+        stream=False,
+        retries=None,
+        idempotent=None,
+        method=None,
+    ):
+        """
+        Send a GET request, or a POST if there is `data`, and return the
+        response. Pass `method` to use any other method, like HEAD.
+
+        Failed requests are retried according to the session's `retry`
+        policy, up to `retries` attempts in total if given. POSTs are only
+        retried if they are marked as `idempotent`.
+        """
+        if idempotent is None:
+            idempotent = data is None
+        args = (url, data, stream, retries, idempotent, method)
+        version = self.crumb_version
+        try:
+            return self._request(*args)
+        except urllib_request.HTTPError as error:
+            if error.code != 403:
+                raise
+            forbidden = error
+
+        with self.crumb_lock:
+            # another thread may have replaced the crumb since we sent the
+            # request. Then we only have to send it again
+            if version == self.crumb_version:
+                if not self.crumb_cached:
+                    raise forbidden
+                # The crumb or cookies we got from the cache are no longer
+                # valid. Forget them and get new ones
+                self.crumb_cached = False
+                self.crumb_cache.clear()
+                self.jar.clear()
+                if self.crumb:
+                    self.headers.pop(self.crumb[0], None)
+                    self.crumb = ()
+                self._get_crumb()
+                self.crumb_version += 1
+        return self._request(*args)
+
+    def _request(self, url, data, stream, retries, idempotent, method):
+        headers = self.headers.copy()
+        if data is not None:
+            data = urlencode(data).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib_request.Request(url, data, headers=headers)
+        if method is not None:
+            # python 2's Request doesn't take a method
+            req.get_method = lambda: method
+        self.jar.add_cookie_header(req)
+
+        policy = self.retry
+        if retries is not None:
+            policy = copy.copy(policy)
+            policy.attempts = retries
+        start = monotonic()
+        attempt = 1
+        while True:
+            try:
+                response = self.pool.urlopen(req)
+                break
+            except Exception as error:
+                elapsed = monotonic() - start
+                delay = policy.next_delay(attempt, error, elapsed, idempotent)
+                if delay is None:
+                    self._emit(req, start, attempt - 1, error=error)
+                    raise
+                debug(
+                    'Request to %s failed (%s), retrying in %.1fs'
+                    % (url, error, delay)
+                )
+            time.sleep(delay)
+            attempt += 1
+        self.jar.extract_cookies(response, req)
+        if sys.version_info >= (3,):
+            response.headers = CaseInsensitiveDict(response.headers._headers)
+        else:
+            response.headers = CaseInsensitiveDict(response.headers.dict)
+        if stream:
+            blocks = stream_response(response)
+            if self.hooks:
+                blocks.callback = lambda blocks: self._emit(
+                    req, start, attempt - 1, response, blocks.wire_bytes
+                )
+            return blocks
+        else:
+            body = response.read()
+            response.release_conn()
+            self._emit(req, start, attempt - 1, response, len(body))
+            text = decode_content(body, response.headers)
+            debug_transfer(url, len(body), len(text))
+            response.text = text.decode('utf-8')
+            return response
+
+    def _emit(self, req, start, retries, response=None, size=0, error=None):
+        """
+        Pass a `RequestEvent` describing a request to the session's hooks.
+        `start` is when the request was first sent, and the timings of the
+        connection are those of its last attempt.
+        """
+        if not self.hooks:
+            return
+        total = monotonic() - start
+        timings = getattr(response, 'timings', None) or {}
+        status = getattr(response, 'status', None)
+        if status is None:
+            status = getattr(error, 'code', None)
+        url = req.get_full_url()
+        event = RequestEvent(
+            method=req.get_method(),
+            url=url,
+            endpoint=url_endpoint(url),
+            status=status,
+            bytes=size,
+            retries=retries,
+            start=start,
+            dns=timings.get('dns'),
+            connect=timings.get('connect'),
+            tls=timings.get('tls'),
+            first_byte=timings.get('first_byte'),
+            total=total,
+            error=error,
+        )
+        self._notify(event)
+
+    def _notify(self, event):
+        """
+        Pass an event to the session's hooks.
+        """
+        for hook in self.hooks:
+            hook(event)
+
+    def get_job_params(self, url):
+        """
+        Get the list of allowed parameters and their respective choices. The
+        result is saved to the parameters cache.
+        """
+        response = self.get_url(api_url(url, JOB_PARAMS_TREE))
+        job_params = parse_job_params(json.loads(response.text))
+        self.params_cache.set(url.rstrip('/') + '/', job_params)
+        return job_params
+
+    def launch_build(self, url, params=None):
+        """
+        Submit job and return the queue item location.
+        """
+        url = url.rstrip('/') + '/'
+        cached = self.params_cache.get(url)
+        job_params = cached
+        if cached is None:
+            job_params = self.get_job_params(url)
+        try:
+            validate_params(job_params, params)
+        except ValueError:
+            if cached is None:
+                raise
+            # the job might have changed since we cached its parameters
+            cached, job_params = None, self.get_job_params(url)
+            validate_params(job_params, params)
+
+        log('Sending build request')
+        try:
+            response = self._post_build(url, job_params, params)
+        except urllib_request.HTTPError:
+            if cached is None:
+                raise
+            # Jenkins may be rejecting the request because the job has gained
+            # or lost its parameters. If so, try again with the new ones
+            new_params = self.get_job_params(url)
+            if new_params == job_params:
+                raise
+            validate_params(new_params, params)
+            response = self._post_build(url, new_params, params)
+
+        assert (
+            'Location' in response.headers
+        ), 'Something went wrong with the Jenkins API'
+        location = response.headers['Location']
+
+        assert 'queue' in location, 'Something went wrong with the Jenkins API'
+        return location
+
+    def _post_build(self, url, job_params, params):
+        url += 'buildWithParameters' if job_params else 'build'
+        url += '?delay=0'
+        data = params or ""  # urllib will send a POST with an empty string
+        return self.get_url(url, data=data)
+
+    def get_queue_status(self, location):
+        """
+        Check the status of a queue item. Returns the build url if the job is
+        already executing, or None if it's still in the queue.
+        """
+        response = self.get_url(api_url(location, QUEUE_ITEM_TREE))
+        return parse_queue_status(json.loads(response.text))
+
+    @deprecate(instead='wait_queue')
+    def wait_queue_item(self, *args, **kwargs):
+        pass
+
+    def wait_queue(self, location, interval=None, deadline=None):
+        """
+        Wait until the item starts building, checking every `interval`
+        seconds (CONFIG['interval'] by default). Checks go through the
+        session's `queue_watcher` if it has one, for waiting for many items
+        at once.
+
+        Raises DeadlineExceeded if it's still in the queue at `deadline`, a
+        `monotonic` timestamp.
+        """
+        interval = interval or CONFIG['interval']
+        get_queue_status = self.get_queue_status
+        if self.queue_watcher is not None:
+            get_queue_status = self.queue_watcher.get_queue_status
+        schedule = PollSchedule()
+        with ProgressBar() as progress:
+            while True:
+                schedule.poll()
+                job_url = get_queue_status(location)
+                if job_url is not None:
+                    break
+                msg = 'Timed out waiting for the build to start'
+                delay = schedule.wait_time(interval)
+                delay = deadline_delay(delay, deadline, msg, location)
+                progress.show('Job queued', delay)
+        log('')
+        schedule.report(location)
+        return job_url
+
+    @deprecate(instead='job_status')
+    def get_job_status(self, *args, **kwargs):
+        pass
+
+    def job_status(self, build_url):
+        """
+        Check the status of a running build.
+
+        Returns a tuple with the status of the build and the current stage.
+        The status is True on successful exit, False on failure or None if the
+        build is still running.
+        """
+        poll_url = build_url.rstrip('/') + '/wfapi/describe'
+        try:
+            response = self.get_url(poll_url)
+        except urllib_request.HTTPError as error:
+            if error.code == 404:
+                build_number = build_url.rstrip('/').rpartition('/')[2]
+                error.msg = 'Build #%s does not exist' % build_number
+            raise
+        description = json.loads(response.text)
+        if self.hooks and description.get('stages'):
+            self._notify(StageEvent(build_url, description['stages']))
+        return parse_job_status(description)
+
+    def cancel_queue_item(self, location):
+        """
+        Remove an item from the build queue.
+        """
+        item_id = location.rstrip('/').rpartition('/')[2]
+        url = self.base + '/queue/cancelItem?' + urlencode({'id': item_id})
+        try:
+            self.get_url(url, data='', idempotent=True)
+        except urllib_request.HTTPError as error:
+            # some versions of Jenkins answer 404 after cancelling the item
+            if error.code != 404:
+                raise
+
+    def stop_build(self, build_url):
+        """
+        Abort a running build.
+        """
+        self.get_url(build_url.rstrip('/') + '/stop', data='', idempotent=True)
+
+    def wait_many(
+        self,
+        items,
+        interval=None,
+        max_rate=None,
+        deadline=None,
+        queue_deadlines=None,
+        outputs=None,
+        on_start=None,
+        until_started=False,
+    ):
+        """
+        Wait for many queue items or builds at once, from a single thread.
+
+        `items` can be queue item locations (as returned by `launch_build`)
+        or build urls. Every item is polled once per `interval` seconds
+        (CONFIG['interval'] by default), never sending more than `max_rate`
+        requests per second overall.
+
+        Queue items are checked through the session's `queue_watcher` if it
+        has one, like in `wait_queue`. When one starts building, `on_start`
+        is called with the item and its build url. With `until_started`, the
+        item is done at that point, and its build isn't followed.
+
+        The log of every item in `outputs` (a dict of items to files, which
+        `on_start` can fill in) is written to its file as it comes in, like
+        in `wait_job`.
+
+        Items that aren't done by `deadline`, or queue items that are still
+        in the queue at their time in `queue_deadlines` (both `monotonic`
+        timestamps), fail with a DeadlineExceeded error.
+
+        This is a generator that yields a `WaitResult` for every item as soon
+        as it finishes. The result's `status` is the same as in `job_status`.
+        Errors while polling an item don't stop the others. They are reported
+        in the `error` field of that item's result instead.
+        """
+        if interval is None:
+            interval = CONFIG['interval']
+        queue_deadlines = queue_deadlines or {}
+        if outputs is None:
+            outputs = {}
+        logs = {}  # offset and decoder of the logs that are being followed
+        # heap of (next poll, sequence number, original item, url to poll)
+        now = monotonic()
+        pending = [(now, seq, item, item) for seq, item in enumerate(items)]
+        heapq.heapify(pending)
+        spacing = 1.0 / max_rate if max_rate else 0
+        last = None
+        get_queue_status = self.get_queue_status
+        if self.queue_watcher is not None:
+            get_queue_status = self.queue_watcher.get_queue_status
+        while pending:
+            due, seq, item, url = heapq.heappop(pending)
+            if last is not None:
+                due = max(due, last + spacing)
+            delay = due - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            last = monotonic()
+
+            is_queue = '/queue/item/' in url
+            try:
+                if is_queue:
+                    build_url = get_queue_status(url)
+                    status = None
+                else:
+                    status, _ = self.job_status(url)
+                    if item in outputs:
+                        offset, decoder = logs.get(item, (0, log_decoder()))
+                        offset, more = self.follow_log(
+                            url, outputs[item], offset, decoder
+                        )
+                        while status is not None and more:
+                            # see wait_job
+                            time.sleep(interval / 5)
+                            offset, more = self.follow_log(
+                                url, outputs[item], offset, decoder
+                            )
+                        logs[item] = (offset, decoder)
+            except Exception as error:
+                build_url = None if is_queue else url
+                yield WaitResult(item, build_url, False, error)
+                continue
+
+            if is_queue and build_url is not None:
+                # started building. Start polling the build itself
+                if on_start is not None:
+                    on_start(item, build_url)
+                if until_started:
+                    yield WaitResult(item, build_url, None, None)
+                else:
+                    heapq.heappush(pending, (last, seq, item, build_url))
+                continue
+            if status is not None:
+                yield WaitResult(item, url, status, None)
+                continue
+
+            # fixed rate: the next check is due an interval after this one
+            # was due, unless we're already late for it
+            due = max(due + interval, monotonic())
+            item_deadline = deadline
+            if is_queue:
+                item_deadline = queue_deadlines.get(item, deadline)
+            if item_deadline is not None:
+                if monotonic() >= item_deadline:
+                    what = 'start' if is_queue else 'finish'
+                    msg = 'Timed out waiting for %s to %s' % (url, what)
+                    error = DeadlineExceeded(msg, url)
+                    build_url = None if is_queue else url
+                    yield WaitResult(item, build_url, False, error)
+                    continue
+                due = min(due, item_deadline)
+            heapq.heappush(pending, (due, seq, item, url))
+
+    @deprecate(instead='wait_job')
+    def wait_for_job(self, *args, **kwargs):
+        pass
+
+    def get_expected_end(self, build_url):
+        """
+        Get the time (in millis, by the Jenkins clock) when a build is
+        expected to end, based on the duration of the previous builds. Returns
+        None if Jenkins can't tell.
+        """
+        response = self.get_url(api_url(build_url, BUILD_TIMES_TREE))
+        return parse_expected_end(json.loads(response.text))
+
+    def wait_job(
+        self,
+        build_url,
+        interval=None,
+        output=None,
+        max_interval=None,
+        deadline=None,
+    ):
+        """
+        Wait until the build finishes, checking its status every `interval`
+        seconds. Raises DeadlineExceeded if it's still running at `deadline`,
+        a `monotonic` timestamp.
+
+        If `max_interval` is set, the time between checks adapts to the
+        estimated duration of the build instead, from `interval` up to
+        `max_interval` seconds. See `adaptive_interval`. They default to
+        CONFIG['interval'] and CONFIG['max_interval'].
+
+        If `output` is a file, the build log will be written to it as it comes
+        in, instead of having to download it in one go at the end.
+        """
+        interval = interval or CONFIG['interval']
+        max_interval = max_interval or CONFIG['max_interval']
+        expected_end = None
+        if max_interval:
+            expected_end = self.get_expected_end(build_url)
+        name = '#' + build_url.rstrip('/').split('/')[-1]
+        last_stage = None
+        offset, decoder = 0, None
+        if output is not None:
+            decoder = log_decoder()
+        schedule = PollSchedule()
+        with ProgressBar() as progress:
+            while True:
+                schedule.poll()
+                status, stage = self.job_status(build_url)
+                if output is not None:
+                    offset, more = self.follow_log(
+                        build_url, output, offset, decoder
+                    )
+                    while status is not None and more:
+                        # the build is over, but jenkins may still be
+                        # flushing the end of the log
+                        time.sleep(interval / 5)
+                        offset, more = self.follow_log(
+                            build_url, output, offset, decoder
+                        )
+                if status is not None:
+                    break
+
+                stage_name = stage.get('name', '')
+                msg = stage_name or 'Build %s in progress' % name
+                millis = stage.get('durationMillis', None)
+                if stage_name != last_stage:
+                    last_stage = stage_name
+                    msg = '\n' + msg
+                delay = interval
+                if max_interval:
+                    delay = adaptive_interval(
+                        expected_end, stage, interval, max_interval
+                    )
+                timeout_msg = 'Timed out waiting for build %s to finish' % name
+                delay = schedule.wait_time(delay)
+                delay = deadline_delay(delay, deadline, timeout_msg, build_url)
+                progress.show(msg, delay, millis=millis)
+        status_name = 'SUCCESS' if status else 'FAILURE'
+        log('\nJob', name, 'ended in', status_name)
+        schedule.report(build_url)
+        return status
+
+    def iter_log(self, build_url, line_filter=None):
+        """
+        Download the build log and yield it as a series of strings, one for
+        every block read from the network.
+
+        With a `LineFilter`, only the lines it keeps are yielded, and the
+        download stops as soon as the filter is done.
         """
         build_url = build_url.rstrip('/') + '/'
         url = build_url + 'consoleText'
-        log = ''.join(
-            block.text.decode('utf-8', errors='ignore')
-            for block in self.get_url(url, stream=True)
-        )
-        return log
+        blocks = self.get_url(url, stream=True)
+        if line_filter is None:
+            decoder = log_decoder()
+            for block in blocks:
+                yield decoder.decode(block.text)
+            yield decoder.decode(b'', True)
+            return
+
+        for block in blocks:
+            lines = line_filter.feed(block.text)
+            if lines:
+                yield lines.decode('utf-8', 'ignore')
+            if line_filter.done:
+                blocks.close()
+                return
+        yield line_filter.flush().decode('utf-8', 'ignore')
+
+    def retrieve_log(self, build_url):
+        """
+        Get the build log and return it as a string.
+        """
+        return ''.join(self.iter_log(build_url))
+
+    def tail_log(self, build_url, lines):
+        """
+        Get the last `lines` lines of the build log as a string, without
+        downloading the whole log.
+
+        The size of the log is read from the headers of the progressive log,
+        with a HEAD request, and then bigger and bigger windows at the end of
+        it are downloaded until one of them has enough lines.
+        """
+        if lines <= 0:
+            return ''
+        url = build_url.rstrip('/') + '/logText/progressiveText?start=%d'
+        response = self.get_url(url % 0, method='HEAD')
+        size = int(response.headers.get('X-Text-Size', 0))
+
+        window = TAIL_WINDOW
+        while True:
+            start = max(0, size - window)
+            # ask for the byte before the window too, to know whether the
+            # window starts at the beginning of a line
+            blocks = self.get_url(url % max(0, start - 1), stream=True)
+            data = b''.join(block.text for block in blocks)
+            cut = False
+            if start > 0:
+                cut = not data.startswith(b'\n')
+                data = data[1:]
+            text = data.decode('utf-8', 'ignore').splitlines(True)
+            if cut:
+                text = text[1:]
+            if start == 0 or len(text) >= lines:
+                return ''.join(text[-lines:])
+            window *= 4
+
+    def follow_log(self, build_url, file, start=0, decoder=None):
+        """
+        Write the part of the build log that comes after byte `start` to a
+        file.
+
+        Returns a tuple with the offset to continue from on the next call and
+        a boolean that tells whether Jenkins has more output coming. Pass the
+        same incremental `decoder` on every call so that characters split
+        between two calls are decoded properly.
+        """
+        url = build_url.rstrip('/') + '/logText/progressiveText?start=%d'
+        blocks = self.get_url(url % start, stream=True)
+        decoder = decoder or log_decoder()
+        for block in blocks:
+            file.write(decoder.decode(block.text))
+        file.flush()
+
+        offset = int(blocks.headers.get('X-Text-Size', start))
+        more = blocks.headers.get('X-More-Data', '').lower() == 'true'
+        return offset, more
 
     @deprecate(instead='dump_log')
     def save_log_to_file(self, *args, **kwargs):
         pass
 
-    def dump_log(self, build_url, filename=None):
+    def dump_log(self, build_url, filename=None, lines=None, line_filter=None):
         """
-        Save the build log to a file.
-        """
-        build_url = build_url.rstrip('/') + '/'
-        if filename:
-            file = filename
-        elif CONFIG['output'] and CONFIG['output'] is not True:
-            file = CONFIG['output']
-        else:
-            job_name = build_url[build_url.find('/job/') :]
-            job_name = (
-                job_name.replace('/', '_').replace('_job_', '_').strip('_')
-            )
-            file = job_name + '.txt'
+        Save the build log to a file. Pass `lines` to save only the last lines
+        of the log, or a `LineFilter` to save only the lines it keeps.
 
-        isfile = hasattr(file, 'write')
-        if not isfile:
-            file = io.open(file, 'w', encoding='utf-8')
-        file.write(self.retrieve_log(build_url))
+        Downloads of the whole log to a named file can be resumed: if a
+        previous download of the same build was interrupted, only the rest of
+        the log is requested (see `PartialLog`).
+        """
+        if lines is not None:
+            with open_output(build_url, filename) as file:
+                file.write(self.tail_log(build_url, lines))
+            return
+        if line_filter is not None:
+            with open_output(build_url, filename) as file:
+                for text in self.iter_log(build_url, line_filter):
+                    file.write(text)
+            return
+
+        file = output_file(build_url, filename)
+        if hasattr(file, 'write'):
+            for text in self.iter_log(build_url):
+                file.write(text)
+            return
+
+        partial = PartialLog(file, self.resolve_build(build_url))
+        offset, size = partial.load()
+        if offset:
+            log('Resuming download of', file, 'from byte', offset)
+        self.download_log(partial, offset, size)
+        partial.remove()
+        log('Job output saved to', file)
+
+    def resolve_build(self, build_url):
+        """
+        Get the url of the build that a permalink like .../lastBuild points
+        to. Any other url is returned as it is.
+        """
+        if not re.search(r'/last\w*Build/?$', build_url):
+            return build_url
+        response = self.get_url(api_url(build_url, 'url'))
+        return json.loads(response.text)['url']
 
-        if not isfile:
-            file.close()
-            log('Job output saved to', file)
+    def download_log(self, partial, offset=0, size=0):
+        """
+        Download the build log to the file of a `PartialLog`, starting from
+        byte `offset` of the log, which has been saved up to byte `size` of
+        the file.
+
+        Jenkins counts offsets in its raw log, which has console notes that
+        are left out of the text it sends, so they can't be worked out from
+        the text itself. The marker is only updated with the offset that
+        Jenkins gives (X-Text-Size) once all the text up to it is saved.
+        """
+        url = partial.build_url + 'logText/progressiveText?start=%d'
+        decoder = log_decoder()
+        partial.save(offset, size)
+        with io.open(partial.path, 'r+b' if size else 'wb') as file:
+            file.seek(size)
+            file.truncate()
+            while True:
+                blocks = self.get_url(url % offset, stream=True)
+                total = int(blocks.headers.get('X-Text-Size', offset))
+                if total < offset:
+                    # the log got shorter, so Jenkins sends all of it
+                    file.seek(0)
+                    file.truncate()
+                    size = 0
+                    decoder = log_decoder()
+                for block in blocks:
+                    data = decoder.decode(block.text).encode('utf-8')
+                    file.write(data)
+                    size += len(data)
+                offset = total
+                more = blocks.headers.get('X-More-Data', '').lower()
+                if more != 'true':
+                    break
+                if not decoder.getstate()[0]:
+                    file.flush()
+                    partial.save(offset, size)
+                time.sleep(CONFIG['interval'])
+            file.write(decoder.decode(b'', True).encode('utf-8'))
 
 
 def launch_build(url, auth, *args, **kwargs):
@@ -713,25 +2830,709 @@ def dump_log(url, auth, *args, **kwargs):
     return Session(url, auth).save_log_to_file(url, *args, **kwargs)
 
 
+def load_batch(filename, has_number=False):
+    """
+    Read the list of builds to launch from a batch file, and return it as a
+    list of (url, params) tuples.
+
+    CSV files need a header row with a `job` column. Every other column is
+    taken as a build parameter, and empty cells are left out. Rows with more
+    cells than the header are rejected. Any other file is parsed as JSON, and
+    should contain a list where every item is either a job url or an object
+    with `job` and (optionally) `params` keys. Both are read as UTF-8.
+    """
+    if filename.lower().endswith('.csv'):
+        if sys.version_info >= (3,):
+            file = io.open(filename, newline='', encoding='utf-8')
+        else:
+            # python 2's csv module only reads bytes
+            file = open(filename, 'rb')
+        with file:
+            rows = list(csv.DictReader(file))
+        builds = []
+        for row in rows:
+            if None in row:
+                raise ValueError(
+                    'Row for %s in batch file has more cells than the header'
+                    % row.get('job')
+                )
+            if sys.version_info < (3,):
+                row = {
+                    k.decode('utf-8'): v and v.decode('utf-8')
+                    for k, v in row.items()
+                }
+            job = row.pop('job', None)
+            params = {k: v for k, v in row.items() if v}
+            builds.append({'job': job, 'params': params})
+    else:
+        with io.open(filename, encoding='utf-8') as file:
+            builds = json.load(file)
+        if not isinstance(builds, list):
+            raise ValueError('Batch file must contain a list of builds')
+
+    parsed = []
+    for build in builds:
+        if not isinstance(build, Mapping):
+            build = {'job': build}
+        if not build.get('job'):
+            raise ValueError('Missing job url in batch file: %s' % build)
+        job = parse_job_url(build['job'], has_number=has_number)
+        parsed.append((job, build.get('params') or {}))
+    return parsed
+
+
+def format_table(header, rows):
+    """
+    Format a list of rows as a plain text table with aligned columns.
+    """
+    rows = [header] + [[str(c) for c in row] for row in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = [
+        '  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip()
+        for row in rows
+    ]
+    lines.insert(1, '  '.join('-' * w for w in widths))
+    return '\n'.join(lines)
+
+
+def percentile(values, percent):
+    """
+    Get the `percent` percentile of a sorted list of values, using the
+    nearest rank method.
+    """
+    rank = (percent * len(values) + 99) // 100
+    return values[max(0, rank - 1)]
+
+
+def escape_label(value):
+    """
+    Escape a label value for the OpenMetrics text format.
+    """
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ['%s="%s"' % (k, escape_label(str(v))) for k, v in labels]
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_histogram(name, buckets, series):
+    """
+    Get the samples of an OpenMetrics histogram. `series` maps tuples of
+    (label, value) pairs to the list of values observed with those labels.
+    """
+    lines = []
+    for labels, values in series.items():
+        for bucket in list(buckets) + [float('inf')]:
+            count = sum(1 for value in values if value <= bucket)
+            le = '+Inf' if bucket == float('inf') else repr(float(bucket))
+            lines.append(
+                '%s_bucket%s %d'
+                % (name, format_labels(labels + (('le', le),)), count)
+            )
+        labels = format_labels(labels)
+        lines.append('%s_count%s %d' % (name, labels, len(values)))
+        lines.append('%s_sum%s %r' % (name, labels, float(sum(values))))
+    return lines
+
+
+class LaunchStats:
+    """
+    Keeps the requests sent by the sessions it's hooked to (see
+    `Session.hooks`), and how long every phase of the launch takes, to print
+    a summary with --stats or export them with --metrics-file and --trace.
+    """
+
+    phase_names = [
+        ('launch', 'launch'),
+        ('queue', 'queue wait'),
+        ('build', 'build run'),
+        ('log', 'log download'),
+    ]
+    request_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+    queue_buckets = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+    build_buckets = (10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400)
+
+    def __init__(self):
+        self.events = []
+        self.phases = []
+        self.phase_requests = {}
+        self.phase_bytes = {}
+        self.spans = []
+        self.stages = OrderedDict()
+        self.current = threading.local()
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        if isinstance(event, StageEvent):
+            # polls see the same stages again, keep their latest state
+            with self.lock:
+                for stage in event.stages:
+                    key = (event.build_url, stage.get('id', stage.get('name')))
+                    self.stages[key] = stage
+            return
+        phase = getattr(self.current, 'phase', None)
+        if phase == 'poll':
+            phase = 'queue' if '/queue/' in event.endpoint else 'build'
+        span = (
+            threading.current_thread().name,
+            'request',
+            trace_span_name(event.endpoint),
+            event.start,
+            event.total,
+            {'url': event.url, 'status': event.status, 'bytes': event.bytes},
+        )
+        with self.lock:
+            self.events.append(event)
+            self.spans.append(span)
+            requests = self.phase_requests.get(phase, 0)
+            self.phase_requests[phase] = requests + 1
+            size = self.phase_bytes.get(phase, 0)
+            self.phase_bytes[phase] = size + event.bytes
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the launch, one of those in `phase_names`. Requests
+        sent from this thread meanwhile are counted as part of it.
+        """
+        previous = getattr(self.current, 'phase', None)
+        self.current.phase = name
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.current.phase = previous
+            self.add_phase(name, start, monotonic())
+
+    def add_phase(self, name, start, end, track=None):
+        """
+        Record a phase of the launch that went from `start` to `end`. It's
+        shown in the `track` of the trace, or in the one of this thread.
+        """
+        label = dict(self.phase_names)[name]
+        track = track or threading.current_thread().name
+        with self.lock:
+            self.phases.append((name, start, end))
+            self.spans.append(
+                (track, 'phase', label, start, end - start, None)
+            )
+
+    @contextlib.contextmanager
+    def polling(self):
+        """
+        Count the requests sent from this thread meanwhile as part of the
+        queue or build phase, depending on what they check. For threads that
+        wait for many builds at once (see `Session.wait_many`).
+        """
+        previous = getattr(self.current, 'phase', None)
+        self.current.phase = 'poll'
+        try:
+            yield
+        finally:
+            self.current.phase = previous
+
+    def phase_time(self, name):
+        """
+        Get the time spent in a phase, added up for all the builds.
+        """
+        return sum(end - start for n, start, end in self.phases if n == name)
+
+    def summary(self):
+        """
+        Get a summary of the requests per endpoint, with their latency
+        percentiles, and of the time spent in every phase.
+        """
+        endpoints = OrderedDict()
+        for event in self.events:
+            key = (event.method, event.endpoint)
+            endpoints.setdefault(key, []).append(event)
+
+        rows = []
+        for (method, endpoint), events in endpoints.items():
+            millis = sorted(event.total * 1000 for event in events)
+            rows.append(
+                [method, endpoint, len(events)]
+                + ['%.1f' % percentile(millis, p) for p in (50, 90, 99, 100)]
+                + [sum(event.bytes for event in events)]
+            )
+        header = ['METHOD', 'ENDPOINT', 'REQUESTS', 'P50 MS', 'P90 MS']
+        header += ['P99 MS', 'MAX MS', 'BYTES']
+        lines = [format_table(header, rows), '']
+
+        retries = sum(event.retries for event in self.events)
+        received = sum(event.bytes for event in self.events)
+        lines.append(
+            '%d requests, %d retries, %d bytes received'
+            % (len(self.events), retries, received)
+        )
+        phases = [
+            '%s %.1fs' % (label, self.phase_time(name))
+            for name, label in self.phase_names
+            if any(phase[0] == name for phase in self.phases)
+        ]
+        if phases:
+            lines.append('Time spent: ' + ', '.join(phases))
+        return '\n'.join(lines)
+
+    def openmetrics(self):
+        """
+        Export the requests and timings in the OpenMetrics text format.
+        """
+        prefix = 'launch_jenkins_'
+        requests, retries, received, latency = {}, {}, {}, {}
+        for event in self.events:
+            key = (('method', event.method), ('endpoint', event.endpoint))
+            requests[key] = requests.get(key, 0) + 1
+            retries[key] = retries.get(key, 0) + event.retries
+            received[key] = received.get(key, 0) + event.bytes
+            latency.setdefault(key, []).append(event.total)
+
+        lines = []
+
+        def family(name, kind, help_text, unit=None):
+            lines.append('# TYPE %s%s %s' % (prefix, name, kind))
+            if unit:
+                lines.append('# UNIT %s%s %s' % (prefix, name, unit))
+            lines.append('# HELP %s%s %s' % (prefix, name, help_text))
+
+        def counter(name, help_text, values, unit=None):
+            family(name, 'counter', help_text, unit)
+            for labels, value in sorted(values.items()):
+                lines.append(
+                    '%s%s_total%s %s'
+                    % (prefix, name, format_labels(labels), value)
+                )
+
+        counter('requests', 'Requests sent to Jenkins.', requests)
+        counter(
+            'request_retries',
+            'Attempts to send a request again after the first one failed.',
+            retries,
+        )
+        counter(
+            'received_bytes', 'Bytes received from Jenkins.', received, 'bytes'
+        )
+        family(
+            'request_duration_seconds',
+            'histogram',
+            'Time to send a request and read its response, with retries.',
+            'seconds',
+        )
+        lines.extend(
+            format_histogram(
+                prefix + 'request_duration_seconds',
+                self.request_buckets,
+                OrderedDict(sorted(latency.items())),
+            )
+        )
+
+        durations = {}
+        for name, start, end in self.phases:
+            durations.setdefault(name, []).append(end - start)
+        for name, buckets, help_text in [
+            ('queue', self.queue_buckets, 'Time builds spent in the queue.'),
+            ('build', self.build_buckets, 'Time builds took to run.'),
+        ]:
+            metric = '%s_duration_seconds' % name
+            family(metric, 'histogram', help_text, 'seconds')
+            lines.extend(
+                format_histogram(
+                    prefix + metric, buckets, {(): durations.get(name, [])}
+                )
+            )
+
+        polls = {}
+        for name in ('queue', 'build'):
+            polls[(('phase', name),)] = self.phase_requests.get(name, 0)
+        counter('polls', 'Status checks of queued and running builds.', polls)
+        counter(
+            'log_download_bytes',
+            'Bytes of build logs downloaded.',
+            {(): self.phase_bytes.get('log', 0)},
+            'bytes',
+        )
+        counter(
+            'log_download_seconds',
+            'Time spent downloading build logs.',
+            {(): repr(sum(durations.get('log', [])))},
+            'seconds',
+        )
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def chrome_trace(self):
+        """
+        Export the phases and requests of the launch, and the stages of the
+        builds, in the Chrome trace event format, which can be opened with
+        chrome://tracing or https://ui.perfetto.dev. Every thread gets its own
+        track, and every build another one for its stages. Stage times come
+        from the clock of the Jenkins server.
+        """
+        offset = time.time() - monotonic()  # to turn monotonic times to UTC
+        tracks = OrderedDict()
+        events = []
+
+        def track(name):
+            if name not in tracks:
+                tracks[name] = len(tracks) + 1
+                events.append(
+                    {
+                        'name': 'thread_name',
+                        'ph': 'M',
+                        'pid': 1,
+                        'tid': tracks[name],
+                        'args': {'name': name},
+                    }
+                )
+            return tracks[name]
+
+        def span(tid, category, name, start, duration, args=None):
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1e6),
+                'dur': int(duration * 1e6),
+                'pid': 1,
+                'tid': tid,
+            }
+            if args:
+                event['args'] = args
+            events.append(event)
+
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: (s[0], s[3], -s[4]))
+            stages = list(self.stages.items())
+        for thread, category, name, start, duration, args in spans:
+            span(track(thread), category, name, start + offset, duration, args)
+        for (build_url, _), stage in stages:
+            if 'startTimeMillis' not in stage:
+                continue
+            span(
+                track('Stages of ' + build_url),
+                'stage',
+                stage.get('name', '?'),
+                stage['startTimeMillis'] / 1000.0,
+                stage.get('durationMillis', 0) / 1000.0,
+                {'status': stage.get('status')},
+            )
+        return json.dumps(
+            {'traceEvents': events, 'displayTimeUnit': 'ms'}, indent=1
+        )
+
+
+def run_batch(builds, auth, workers=4, stats=None):
+    """
+    Launch a list of (url, params) builds and wait for all of them to finish.
+
+    Up to `workers` builds are launched at the same time. Then all of them
+    are waited for at once, from a single thread for every Jenkins instance
+    (see `Session.wait_many`), and `workers` threads download their logs as
+    they finish. Builds that go to the same Jenkins instance share a single
+    Session. Requests and timings are recorded in `stats`, a `LaunchStats`,
+    if given.
+
+    Prints a summary table to stdout and returns the exit code: 0 if all the
+    builds succeeded, TIMEOUT_EXIT_CODE if any of them timed out (see
+    CONFIG['timeout'] and CONFIG['queue_timeout']) or 1 otherwise. Builds
+    that couldn't be launched before CONFIG['timeout'] are skipped, and count
+    as timed out.
+    """
+    from multiprocessing.pool import ThreadPool  # slow to import
+
+    hooks = [stats] if stats is not None else None
+    stats = stats or LaunchStats()
+    sessions = {}
+    lock = threading.Lock()
+    quiet = CONFIG['quiet']
+    mode = CONFIG['mode']
+    deadline = None
+    if CONFIG['timeout']:
+        deadline = monotonic() + CONFIG['timeout']
+    # (job url, build url, result) of every build, in the same order
+    results = [(url, url if mode == 'wait' else '-', '') for url, _ in builds]
+    downloads = []
+
+    def report(*args):
+        if not quiet:
+            errlog(*args)
+
+    def get_session(url):
+        split = urlsplit(url)
+        base = '{}://{}'.format(split.scheme, split.netloc)
+        with lock:
+            if base not in sessions:
+                session = Session(base, auth, pool_size=workers, hooks=hooks)
+                if len(builds) > 1:
+                    # builds are queued at about the same time, so they
+                    # check the queue at about the same time too
+                    session.queue_watcher = QueueWatcher(
+                        session, tick=CONFIG['interval'] / 2.0
+                    )
+                sessions[base] = session
+            return sessions[base]
+
+    def finish(indexes, result, build_url=None):
+        for index in indexes:
+            url, old_build_url, _ = results[index]
+            results[index] = (url, build_url or old_build_url, result)
+            report('Build finished:', url, result)
+
+    def launch(index):
+        """
+        Launch a build. Returns its session, what to wait for (a queue item,
+        or the build itself in wait mode), when it was launched and when it
+        has to leave the queue. Returns None if it wasn't launched.
+        """
+        url, params = builds[index]
+        try:
+            session = get_session(url)
+            if mode == 'wait':
+                return session, url, monotonic(), None
+            if deadline is not None and monotonic() >= deadline:
+                report('Build skipped:', url)
+                results[index] = (url, '-', 'SKIPPED')
+                return None
+            with stats.phase('launch'):
+                location = session.launch_build(url, params)
+            return session, location, monotonic(), queue_deadline(deadline)
+        except Exception as error:
+            if CONFIG['debug']:
+                raise
+            finish([index], 'ERROR: %s' % error)
+            return None
+
+    def download(session, build_url, indexes, result):
+        try:
+            with stats.phase('log'):
+                session.dump_log(
+                    build_url, lines=CONFIG['tail'], line_filter=grep_filter()
+                )
+        except Exception as error:
+            if CONFIG['debug']:
+                raise
+            result = 'ERROR: %s' % error
+        finish(indexes, result, build_url)
+
+    def watch(session, items):
+        """
+        Wait for the builds of a session. `items` maps every item to wait for
+        to a tuple with the indexes of its builds, when it was launched and
+        when it has to leave the queue.
+        """
+        started = {}
+        outputs = {}
+        opened = {}
+
+        def follow(item, build_url):
+            started[item] = monotonic()
+            if CONFIG['follow'] and mode != 'launch':
+                opened[item] = open_output(build_url)
+                outputs[item] = opened[item].__enter__()
+
+        def on_start(item, build_url):
+            follow(item, build_url)
+            stats.add_phase('queue', items[item][1], started[item], item)
+            for index in items[item][0]:
+                results[index] = (results[index][0], build_url, '')
+            report('Build started:', build_url)
+
+        if mode == 'wait':
+            for item in items:
+                follow(item, item)
+
+        def done(result):
+            item = result.item
+            indexes = items[item][0]
+            if item in opened:
+                opened.pop(item).__exit__(None, None, None)
+            if item in started and mode != 'launch':
+                stats.add_phase('build', started[item], monotonic(), item)
+
+            if isinstance(result.error, DeadlineExceeded):
+                outcome = 'TIMEOUT'
+                try:
+                    abort_timed_out(session, result.error)
+                except Exception as abort_error:
+                    outcome = 'TIMEOUT (abort failed: %s)' % abort_error
+            elif result.error is not None:
+                if CONFIG['debug']:
+                    raise result.error
+                outcome = 'ERROR: %s' % result.error
+            elif mode == 'launch':
+                outcome = 'STARTED'
+            else:
+                outcome = 'SUCCESS' if result.status else 'FAILURE'
+                if CONFIG['output'] and not CONFIG['follow']:
+                    args = (session, result.build_url, indexes, outcome)
+                    downloads.append(pool.apply_async(download, args))
+                    return
+            finish(indexes, outcome, result.build_url)
+
+        waiting = session.wait_many(
+            items,
+            deadline=deadline,
+            queue_deadlines={item: items[item][2] for item in items},
+            outputs=outputs,
+            on_start=on_start,
+            until_started=mode == 'launch',
+        )
+        try:
+            with stats.polling():
+                for result in waiting:
+                    done(result)
+        finally:
+            for output in opened.values():
+                output.__exit__(None, None, None)
+
+    # progress bars from several threads would garble each other, so we turn
+    # off the regular messages and only report when each build is done
+    CONFIG['quiet'] = True
+    pool = ThreadPool(max(1, workers))
+    try:
+        launched = pool.map(launch, range(len(builds)))
+        # what every session has to wait for, see `watch`
+        groups = OrderedDict()
+        for index, entry in enumerate(launched):
+            if entry is None:
+                continue
+            session, item, start, item_deadline = entry
+            items = groups.setdefault(session, OrderedDict())
+            indexes = (index,)
+            if item in items:
+                # the same build given twice, in wait mode
+                indexes = items[item][0] + indexes
+            items[item] = (indexes, start, item_deadline)
+
+        watchers = ThreadPool(max(1, len(groups)))
+        try:
+            watchers.map(lambda group: watch(*group), groups.items())
+        finally:
+            watchers.close()
+        for result in downloads:
+            result.get()
+    finally:
+        pool.close()
+        CONFIG['quiet'] = quiet
+
+    print(format_table(['JOB', 'BUILD', 'RESULT'], results))
+    timed_out = ('TIMEOUT', 'SKIPPED')
+    if any(result.startswith(timed_out) for _, _, result in results):
+        return TIMEOUT_EXIT_CODE
+    ok = ('SUCCESS', 'STARTED')
+    return int(not all(result in ok for _, _, result in results))
+
+
+def queue_deadline(deadline):
+    """
+    Get the deadline for a build that was just launched to leave the queue,
+    given the overall `deadline`.
+    """
+    if not CONFIG['queue_timeout']:
+        return deadline
+    queue_deadline = monotonic() + CONFIG['queue_timeout']
+    if deadline is None:
+        return queue_deadline
+    return min(deadline, queue_deadline)
+
+
+def abort_timed_out(session, error):
+    """
+    Cancel the queue item or stop the build that raised a DeadlineExceeded
+    error, if we were asked to.
+    """
+    if not CONFIG['abort_on_timeout']:
+        return
+    if '/queue/item/' in error.url:
+        session.cancel_queue_item(error.url)
+        log('Queue item cancelled')
+    else:
+        session.stop_build(error.url)
+        log('Build stopped')
+
+
 def main():
     """
     Launch a Jenkins build and wait for it to finish.
     """
     launch_params = parse_args()
     build_url, auth, params = launch_params
-    session = Session(build_url, auth)
+    stats = None
+    if CONFIG['stats'] or CONFIG['metrics_file'] or CONFIG['trace']:
+        stats = LaunchStats()
+    try:
+        if CONFIG['batch']:
+            wait_only = CONFIG['mode'] == 'wait'
+            builds = load_batch(CONFIG['batch'], has_number=wait_only)
+            return run_batch(builds, auth, CONFIG['workers'], stats)
+        return run_build(build_url, auth, params, stats)
+    finally:
+        if CONFIG['stats']:
+            errlog(stats.summary())
+        # failing to save these shouldn't hide how the build went
+        exports = [
+            (CONFIG['metrics_file'], 'openmetrics'),
+            (CONFIG['trace'], 'chrome_trace'),
+        ]
+        for path, export in exports:
+            if not path:
+                continue
+            try:
+                write_atomic(path, getattr(stats, export)())
+            except (IOError, OSError) as error:
+                errlog('Could not write %s: %s' % (path, error))
 
-    if CONFIG['mode'] != 'wait':
-        location = session.launch_build(build_url, params)
-        build_url = session.wait_queue(location)
 
-    if CONFIG['mode'] == 'launch':
-        print(build_url)
-        return 0
+def run_build(build_url, auth, params, stats=None):
+    """
+    Launch a build, or wait for it, depending on CONFIG['mode'], and return
+    the exit code. Requests and timings are recorded in `stats`, a
+    `LaunchStats`, if given.
+    """
+    hooks = [stats] if stats is not None else None
+    stats = stats or LaunchStats()
+    deadline = None
+    if CONFIG['timeout']:
+        deadline = monotonic() + CONFIG['timeout']
+    session = Session(build_url, auth, hooks=hooks)
+
+    try:
+        if CONFIG['mode'] != 'wait':
+            with stats.phase('launch'):
+                location = session.launch_build(build_url, params)
+            with stats.phase('queue'):
+                build_url = session.wait_queue(
+                    location, deadline=queue_deadline(deadline)
+                )
+
+        if CONFIG['mode'] == 'launch':
+            print(build_url)
+            return 0
+
+        if CONFIG['follow']:
+            with open_output(build_url) as output, stats.phase('build'):
+                result = session.wait_job(
+                    build_url, output=output, deadline=deadline
+                )
+            return int(not result)
+
+        with stats.phase('build'):
+            result = session.wait_job(build_url, deadline=deadline)
+    except DeadlineExceeded as error:
+        log('')
+        errlog('Err:', error)
+        abort_timed_out(session, error)
+        return TIMEOUT_EXIT_CODE
 
-    result = session.wait_job(build_url)
     if CONFIG['output']:
-        session.dump_log(build_url)
+        with stats.phase('log'):
+            session.dump_log(
+                build_url, lines=CONFIG['tail'], line_filter=grep_filter()
+            )
     return int(not result)
 
 
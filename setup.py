@@ -1,6 +1,25 @@
+import sys
+
 from setuptools import setup
+from setuptools.command.build_py import build_py
 from launch_jenkins import __version__
 
+
+class BuildPy(build_py):
+    """
+    Leave out the modules that need a newer python than the one we're being
+    installed for, so that byte-compiling them doesn't fail.
+    """
+
+    py3_modules = ['aio']
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 5):
+            modules = [m for m in modules if m[1] not in self.py3_modules]
+        return modules
+
+
 setup(
     name="launch_jenkins",
     description="Launch a jenkins job and wait for it to finish",
@@ -23,6 +42,7 @@ setup(
         'Programming Language :: Python :: Implementation :: CPython',
     ],
     packages=['launch_jenkins'],
+    cmdclass={'build_py': BuildPy},
     entry_points={
         'console_scripts': [
             'launch_jenkins=launch_jenkins.launch_jenkins:main'
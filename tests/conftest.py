@@ -1,13 +1,22 @@
 import os
 import sys
 from collections import namedtuple
+from threading import Thread
 
 import pytest
 
+if sys.version_info >= (3,):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
 from launch_jenkins import launch_jenkins
 from launch_jenkins import HTTPError
 from launch_jenkins import CaseInsensitiveDict
 from launch_jenkins import Session
+from launch_jenkins import RetryPolicy
 
 
 g_url = "http://example.com/job/thing/job/other/job/master"
@@ -15,6 +24,9 @@ g_auth = ('user', 'pwd')
 g_auth_b64 = 'Basic dXNlcjpwd2Q='
 g_params = ['-j', g_url, '-u', g_auth[0], '-t', g_auth[1]]
 
+if sys.version_info < (3, 5):
+    collect_ignore = ['test_aio.py']
+
 
 class Dummy:
     def __init__(self, **kwargs):
@@ -40,6 +52,9 @@ class FakeResponse:
             self.headers.dict = self.headers
         self.status_code = status_code
 
+    def release_conn(self):
+        pass
+
     def __iter__(self):
         while True:
             self.text = self.read(8192)
@@ -58,6 +73,17 @@ class FakeResponse:
         return text
 
 
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch, tmp_path):
+    """
+    Keep the tests from using the cache in the user's home directory, or
+    sharing cached data between them. Tests for the cache enable it
+    explicitly.
+    """
+    launch_jenkins.CONFIG['cache'] = False
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+
+
 @pytest.fixture
 def config():
     """
@@ -71,8 +97,17 @@ def config():
 
 
 @pytest.fixture(scope='session')
-def session():
-    return Session(g_url, g_auth)
+def shared_session():
+    # retry as usual, but without waiting
+    retry = RetryPolicy(backoff=0)
+    return Session(g_url, g_auth, cache=False, retry=retry)
+
+
+@pytest.fixture
+def session(shared_session):
+    # don't let the job parameters cached by one test leak into the next
+    shared_session.params_cache.entries.clear()
+    return shared_session
 
 
 @pytest.fixture(scope='function')
@@ -95,7 +130,7 @@ def mock_url(monkeypatch):
             for p in mock_pairs
         }
 
-        def mock(request, *args, **kwargs):
+        def mock(pool, request, *args, **kwargs):
             url = request.get_full_url().split('?')[0]
             method = request.get_method()
             resp = mock_pairs.get((url, method), None)
@@ -117,7 +152,7 @@ def mock_url(monkeypatch):
                 )
             return FakeResponse(**resp)
 
-        monkeypatch.setattr(launch_jenkins, 'urlopen', mock)
+        monkeypatch.setattr(launch_jenkins.ConnectionPool, 'urlopen', mock)
 
     return ret
 
@@ -149,3 +184,75 @@ def tty(monkeypatch, terminal_size):
     Set up environment so it looks like a valid TTY.
     """
     monkeypatch.setattr(launch_jenkins, 'is_progressbar_capable', lambda: True)
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    """
+    Minimal HTTP/1.1 server to test the actual network code against.
+
+    Add canned responses to `routes` as `path: (status, headers, body)`, or
+    `path: callable` to build a response from the request handler (or return
+    None to close the connection without answering). The body
+    is sent as it is if there is a `Transfer-Encoding` header. Every
+    request is recorded in `requests` as a `(client_address, method, path)`
+    tuple. The crumb issuer is set up by default.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), LocalHandler)
+        self.routes = {'/crumbIssuer/api/xml': (200, {}, 'crumb:value')}
+        self.requests = []
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length)
+        self.server.requests.append(
+            (self.client_address, self.command, self.path)
+        )
+        route = self.server.routes.get(self.path.split('?')[0])
+        if route is None:
+            route = (404, {}, b'')
+        elif callable(route):
+            route = route(self)
+            if route is None:
+                self.close_connection = True
+                return
+        status, headers, body = route
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if 'Transfer-Encoding' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_HEAD = respond
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def local_server():
+    """
+    Run a `LocalServer` in a background thread for the duration of the test.
+    """
+    server = LocalServer()
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
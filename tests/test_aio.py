@@ -0,0 +1,202 @@
+import io
+import json
+import socket
+import asyncio
+import threading
+
+import pytest
+
+from launch_jenkins.aio import AsyncSession
+from launch_jenkins.aio import AsyncConnectionPool
+from launch_jenkins import HTTPError
+from launch_jenkins import Request
+from launch_jenkins import RetryPolicy
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def add_build(server, job, number, status='SUCCESS', log='build output'):
+    """
+    Set up the routes to launch a build of `job` and poll it until it ends.
+    """
+    queue = '/queue/item/%d/' % number
+    build = '%s/%d/' % (job, number)
+    server.routes[job + '/api/json'] = (200, {}, '{}')
+    server.routes[job + '/build'] = (201, {'Location': server.url + queue}, '')
+    server.routes[queue + 'api/json'] = (
+        200,
+        {},
+        json.dumps({'executable': {'url': server.url + build}}),
+    )
+    server.routes[build + 'wfapi/describe'] = (
+        200,
+        {},
+        json.dumps({'status': status, 'stages': [{'status': status}]}),
+    )
+    server.routes[build + 'consoleText'] = (200, {}, log)
+    return server.url + job, server.url + build
+
+
+async def launch_and_wait(session, job):
+    location = await session.launch_build(job)
+    build_url = await session.wait_queue(location, 0.01)
+    return build_url, await session.wait_job(build_url, 0.01)
+
+
+def test_async_launch(local_server):
+    """
+    Launch a build, wait for it to finish and get its log, reusing a single
+    connection for everything.
+    """
+    job, build = add_build(local_server, '/job/thing', 1)
+
+    async def main():
+        async with AsyncSession(job, ('user', 'pwd')) as session:
+            result = await launch_and_wait(session, job)
+            log = await session.retrieve_log(build)
+            return session, result, log
+
+    session, result, log = run(main())
+    assert result == (build, True)
+    assert log == 'build output'
+    assert session.headers['crumb'] == 'value'
+    assert len(set(r[0] for r in local_server.requests)) == 1
+
+
+def test_async_many_builds(local_server):
+    """
+    Check that many builds can be supervised concurrently from the same
+    event loop.
+    """
+    builds = [
+        add_build(local_server, '/job/thing%d' % i, i, status)
+        for i, status in enumerate(['SUCCESS', 'FAILED'] * 10)
+    ]
+
+    async def main():
+        async with AsyncSession(local_server.url, pool_size=20) as session:
+            return await asyncio.gather(
+                *[launch_and_wait(session, job) for job, _ in builds]
+            )
+
+    results = run(main())
+    assert results == [
+        (build, i % 2 == 0) for i, (_, build) in enumerate(builds)
+    ]
+
+
+def test_async_chunked_log(local_server):
+    """
+    Check that chunked responses are read properly, and that split multibyte
+    characters are kept in one piece.
+    """
+    body = b'4\r\ncaf\xc3\r\n3\r\n\xa9!\n\r\n0\r\n\r\n'
+    headers = {'Transfer-Encoding': 'chunked'}
+    local_server.routes['/job/thing/1/consoleText'] = (200, headers, body)
+    build = local_server.url + '/job/thing/1'
+
+    async def main():
+        async with AsyncSession(local_server.url) as session:
+            output = io.StringIO()
+            await session.dump_log(build, output)
+            return output.getvalue()
+
+    assert run(main()) == 'caf\xe9!\n'
+
+
+def test_async_follow_log(local_server):
+    """
+    Check that follow_log reads the progressive log headers.
+    """
+    url = '/job/thing/1/logText/progressiveText'
+    headers = {'X-Text-Size': '10', 'X-More-Data': 'true'}
+    local_server.routes[url] = (200, headers, 'new stuff')
+
+    async def main():
+        async with AsyncSession(local_server.url) as session:
+            output = io.StringIO()
+            build = local_server.url + '/job/thing/1'
+            result = await session.follow_log(build, output, 1)
+            return result, output.getvalue()
+
+    assert run(main()) == ((10, True), 'new stuff')
+    assert local_server.requests[-1][2].endswith('?start=1')
+
+
+def test_async_errors(local_server):
+    """
+    Check that HTTP errors are raised like in the regular Session.
+    """
+
+    async def main():
+        async with AsyncSession(local_server.url) as session:
+            await session.job_status(local_server.url + '/job/thing/42')
+
+    with pytest.raises(HTTPError) as error:
+        run(main())
+    assert error.value.code == 404
+    assert error.value.msg == 'Build #42 does not exist'
+
+
+@pytest.mark.parametrize('method', ['GET', 'POST'])
+def test_async_pool_stale_connection(local_server, method):
+    """
+    Check that a request is sent again when the server closes a reused
+    connection without answering, unless it's a POST, which the server may
+    have processed already.
+    """
+    answers = [None, (200, {}, 'hello')]
+    local_server.routes['/thing'] = (200, {}, 'hello')
+    local_server.routes['/close'] = lambda handler: answers.pop(0)
+    data = b'x' if method == 'POST' else None
+
+    async def main():
+        pool = AsyncConnectionPool()
+        try:
+            response = await pool.send(Request(local_server.url + '/thing'))
+            await response.read()
+            url = local_server.url + '/close'
+            response = await pool.send(Request(url, data=data))
+            return await response.read()
+        finally:
+            pool.clear()
+
+    if method == 'GET':
+        assert run(main()) == b'hello'
+    else:
+        with pytest.raises(ConnectionError):
+            run(main())
+    paths = [r[2] for r in local_server.requests]
+    assert paths == ['/thing'] + ['/close'] * (2 if method == 'GET' else 1)
+
+
+def test_async_timeout(local_server):
+    """
+    Check that requests that take too long raise socket.timeout, like they
+    do in the regular Session.
+    """
+    done = threading.Event()
+
+    def slow(handler):
+        done.wait(1)
+        return 200, {}, 'late'
+
+    local_server.routes['/slow'] = slow
+    retry = RetryPolicy(attempts=1)
+    session = AsyncSession(local_server.url, timeout=0.1, retry=retry)
+
+    async def main():
+        try:
+            await session.get_url(local_server.url + '/slow')
+        finally:
+            done.set()
+
+    with pytest.raises(socket.timeout):
+        run(main())
+    assert not any(session.pool.idle.values())
@@ -149,3 +149,156 @@ def test_launch_wait_only(arg, url, mode, monkeypatch, config):
     monkeypatch.setattr(sys, 'argv', new_argv)
     parse_args()
     assert launch_jenkins.CONFIG['mode'] == mode
+
+
+def test_follow_flag(monkeypatch, config):
+    """
+    Test that --follow implies --output, but doesn't override its argument.
+    """
+    new_argv = ['python'] + g_params + ['--follow']
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['follow']
+    assert launch_jenkins.CONFIG['output'] is True
+
+    new_argv += ['-o', '-']
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['follow']
+    assert launch_jenkins.CONFIG['output'] is sys.stdout
+
+
+def test_batch_flag(monkeypatch, config):
+    """
+    Test that --batch replaces -j and sets the batch mode options.
+    """
+    new_argv = ['python', '-u', 'user', '-t', 'pwd', '--batch', 'builds.json']
+    monkeypatch.setattr(sys, 'argv', new_argv + ['--workers', '8'])
+    assert parse_args() == (None, ('user', 'pwd'), {})
+    assert launch_jenkins.CONFIG['batch'] == 'builds.json'
+    assert launch_jenkins.CONFIG['workers'] == 8
+
+
+@pytest.mark.parametrize(
+    'args',
+    [['-j', g_url], ['key=value'], ['-o', 'file.txt']],
+    ids=['with -j', 'with parameters', 'with output file'],
+)
+def test_batch_flag_error(args, monkeypatch, config):
+    new_argv = ['python', '-u', 'user', '-t', 'pwd', '--batch', 'builds.json']
+    monkeypatch.setattr(sys, 'argv', new_argv + args)
+    with pytest.raises(SystemExit):
+        parse_args()
+
+
+def test_interval_flags(monkeypatch, config):
+    new_argv = ['python'] + g_params
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['interval'] == 5
+    assert launch_jenkins.CONFIG['max_interval'] is None
+
+    new_argv += ['--interval', '0.5', '--max-interval', '60']
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['interval'] == 0.5
+    assert launch_jenkins.CONFIG['max_interval'] == 60
+
+
+def test_no_cache(monkeypatch, config):
+    new_argv = ['python'] + g_params
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['cache']
+
+    monkeypatch.setattr(sys, 'argv', new_argv + ['--no-cache'])
+    parse_args()
+    assert not launch_jenkins.CONFIG['cache']
+
+
+def test_timeout_flags(monkeypatch, config):
+    new_argv = ['python'] + g_params
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['timeout'] is None
+    assert launch_jenkins.CONFIG['queue_timeout'] is None
+    assert not launch_jenkins.CONFIG['abort_on_timeout']
+
+    new_argv += ['--timeout', '3600', '--queue-timeout', '600']
+    new_argv += ['--abort-on-timeout']
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['timeout'] == 3600
+    assert launch_jenkins.CONFIG['queue_timeout'] == 600
+    assert launch_jenkins.CONFIG['abort_on_timeout']
+
+
+def test_tail_flag(monkeypatch, config):
+    """
+    Test that --tail implies --output, and that it can't be used with
+    --follow.
+    """
+    new_argv = ['python'] + g_params + ['--tail', '200']
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['tail'] == 200
+    assert launch_jenkins.CONFIG['output'] is True
+
+    monkeypatch.setattr(sys, 'argv', new_argv + ['--follow'])
+    with pytest.raises(SystemExit):
+        parse_args()
+
+
+def test_grep_flags(monkeypatch, config):
+    """
+    Test that --grep can be repeated and implies --output.
+    """
+    new_argv = ['python'] + g_params + ['--grep', 'error', '--grep', 'fail']
+    new_argv += ['-A', '2', '-B', '1', '-m', '10']
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['grep'] == ['error', 'fail']
+    assert launch_jenkins.CONFIG['after_context'] == 2
+    assert launch_jenkins.CONFIG['before_context'] == 1
+    assert launch_jenkins.CONFIG['max_count'] == 10
+    assert launch_jenkins.CONFIG['output'] is True
+
+    monkeypatch.setattr(sys, 'argv', new_argv + ['--tail', '10'])
+    with pytest.raises(SystemExit):
+        parse_args()
+
+
+def test_grep_invalid(monkeypatch, capsys, config):
+    """
+    Check that invalid --grep patterns are rejected before launching.
+    """
+    new_argv = ['python'] + g_params + ['--grep', 'ok', '--grep', '[']
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    with pytest.raises(SystemExit):
+        parse_args()
+    assert 'invalid --grep pattern' in capsys.readouterr().err
+
+
+def test_stats_flag(monkeypatch, config):
+    new_argv = ['python'] + g_params
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert not launch_jenkins.CONFIG['stats']
+
+    monkeypatch.setattr(sys, 'argv', new_argv + ['--stats'])
+    parse_args()
+    assert launch_jenkins.CONFIG['stats']
+
+
+def test_metrics_file_flag(monkeypatch, config):
+    new_argv = ['python'] + g_params + ['--metrics-file', '/tmp/x.prom']
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['metrics_file'] == '/tmp/x.prom'
+
+
+def test_trace_flag(monkeypatch, config):
+    new_argv = ['python'] + g_params + ['--trace', '/tmp/trace.json']
+    monkeypatch.setattr(sys, 'argv', new_argv)
+    parse_args()
+    assert launch_jenkins.CONFIG['trace'] == '/tmp/trace.json'
@@ -0,0 +1,300 @@
+import json
+import time
+import threading
+
+import pytest
+
+from launch_jenkins import launch_jenkins
+from launch_jenkins import load_batch
+from launch_jenkins import run_batch
+from launch_jenkins import format_table
+from launch_jenkins import Session
+
+from .conftest import Dummy
+from .conftest import g_url, g_auth
+
+
+other_url = 'http://other.example.com/job/thing'
+
+
+def test_load_batch_json(tmp_path):
+    builds = [
+        g_url,
+        {'job': g_url + '/build', 'params': {'key': 'value'}},
+        {'job': other_url},
+    ]
+    file = tmp_path / 'builds.json'
+    file.write_text(json.dumps(builds))
+    assert load_batch(str(file)) == [
+        (g_url, {}),
+        (g_url, {'key': 'value'}),
+        (other_url, {}),
+    ]
+
+
+def test_load_batch_csv(tmp_path):
+    file = tmp_path / 'builds.csv'
+    file.write_text(
+        u'job,key,other\n'
+        u'{0},value,\n'
+        u'{0}/,,caf\xe9\n'.format(g_url),
+        encoding='utf-8',
+    )
+    assert load_batch(str(file)) == [
+        (g_url, {'key': 'value'}),
+        (g_url, {'other': u'caf\xe9'}),
+    ]
+
+
+def test_load_batch_csv_extra_cells(tmp_path):
+    file = tmp_path / 'builds.csv'
+    file.write_text(u'job,key\n{0},value,extra\n'.format(g_url))
+    with pytest.raises(ValueError):
+        load_batch(str(file))
+
+
+@pytest.mark.parametrize(
+    'content',
+    ['{"job": "x"}', '[{"params": {}}]', '["http://example.com/nojob"]'],
+    ids=['not a list', 'no job url', 'invalid url'],
+)
+def test_load_batch_error(content, tmp_path):
+    file = tmp_path / 'builds.json'
+    file.write_text(content)
+    with pytest.raises(ValueError):
+        load_batch(str(file))
+
+
+def test_format_table():
+    table = format_table(['A', 'BB'], [['xyz', 1], ['w', 22]])
+    assert table.splitlines() == [
+        'A    BB',
+        '---  --',
+        'xyz  1',
+        'w    22',
+    ]
+
+
+class FakeSession:
+    """
+    Session replacement that records the instances that have been created,
+    and reports builds with 'fail' in their url as failed. Builds start as
+    soon as they are launched.
+    """
+
+    created = []
+    queue_watcher = None
+    wait_many = Session.__dict__['wait_many']
+
+    def __init__(self, base, auth, pool_size=4, hooks=None):
+        self.base = base
+        self.created.append(base)
+
+    def launch_build(self, url, params):
+        if 'error' in url:
+            raise RuntimeError('launch failed')
+        return url + '/queue/item/1/'
+
+    def get_url(self, url):
+        # the whole queue, for the QueueWatcher. It's always empty
+        return Dummy(text='{"items": []}')
+
+    def get_queue_status(self, location):
+        return location.replace('/queue/item/1/', '/1')
+
+    def job_status(self, build_url):
+        return 'fail' not in build_url, {}
+
+
+def test_run_batch(monkeypatch, capsys, config):
+    del FakeSession.created[:]
+    monkeypatch.setattr(launch_jenkins, 'Session', FakeSession)
+    builds = [(g_url, {}), (g_url + '2', {}), (other_url, {})]
+    assert run_batch(builds, g_auth, workers=2) == 0
+
+    # one session per jenkins instance
+    assert sorted(FakeSession.created) == [
+        'http://example.com',
+        'http://other.example.com',
+    ]
+    out = capsys.readouterr().out.splitlines()
+    assert out[0].split() == ['JOB', 'BUILD', 'RESULT']
+    assert out[2].split() == [g_url, g_url + '/1', 'SUCCESS']
+    assert out[4].split() == [other_url, other_url + '/1', 'SUCCESS']
+
+
+def test_run_batch_failure(monkeypatch, capsys, config):
+    monkeypatch.setattr(launch_jenkins, 'Session', FakeSession)
+    builds = [(g_url, {}), (g_url + 'fail', {}), (g_url + 'error', {})]
+    assert run_batch(builds, g_auth) == 1
+
+    out = capsys.readouterr().out.splitlines()
+    assert out[2].split()[-1] == 'SUCCESS'
+    assert out[3].split()[-1] == 'FAILURE'
+    assert out[4].split()[1:] == ['-', 'ERROR:', 'launch', 'failed']
+
+
+def test_run_batch_launch_only(monkeypatch, capsys, config):
+    monkeypatch.setattr(launch_jenkins, 'Session', FakeSession)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'mode', 'launch')
+    monkeypatch.setattr(FakeSession, 'job_status', None)
+    assert run_batch([(g_url, {})], g_auth) == 0
+
+    out = capsys.readouterr().out.splitlines()
+    assert out[2].split() == [g_url, g_url + '/1', 'STARTED']
+
+
+def test_run_batch_timeout(monkeypatch, capsys, config):
+    def job_status(self, build_url):
+        return (None if 'slow' in build_url else True), {}
+
+    monkeypatch.setattr(launch_jenkins, 'Session', FakeSession)
+    monkeypatch.setattr(FakeSession, 'job_status', job_status)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'timeout', 0.2)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'interval', 0.05)
+    builds = [(g_url, {}), (g_url + 'slow', {})]
+    assert run_batch(builds, g_auth) == launch_jenkins.TIMEOUT_EXIT_CODE
+
+    out = capsys.readouterr().out.splitlines()
+    assert out[2].split()[-1] == 'SUCCESS'
+    assert out[3].split()[-1] == 'TIMEOUT'
+
+
+def test_run_batch_queue_timeout(monkeypatch, capsys, config):
+    """
+    Check that builds that stay in the queue for too long time out, and are
+    cancelled if asked to.
+    """
+    cancelled = []
+
+    def get_queue_status(self, location):
+        if 'stuck' in location:
+            return None
+        return location.replace('/queue/item/1/', '/1')
+
+    monkeypatch.setattr(launch_jenkins, 'Session', FakeSession)
+    monkeypatch.setattr(FakeSession, 'get_queue_status', get_queue_status)
+    monkeypatch.setattr(
+        FakeSession, 'cancel_queue_item', cancelled.append, raising=False
+    )
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'queue_timeout', 0.2)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'abort_on_timeout', True)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'interval', 0.05)
+    builds = [(g_url, {}), (g_url + 'stuck', {})]
+    assert run_batch(builds, g_auth) == launch_jenkins.TIMEOUT_EXIT_CODE
+
+    out = capsys.readouterr().out.splitlines()
+    assert out[2].split()[-1] == 'SUCCESS'
+    assert out[3].split()[1:] == ['-', 'TIMEOUT']
+    assert cancelled == [g_url + 'stuck/queue/item/1/']
+
+
+def test_run_batch_timeout_skip(monkeypatch, capsys, config):
+    """
+    Check that builds are not launched once the deadline has passed.
+    """
+    launched = []
+
+    def launch_build(self, url, params):
+        launched.append(url)
+        time.sleep(0.3)  # slow Jenkins
+        return url + '/queue/item/1/'
+
+    def job_status(self, build_url):
+        return None, {}
+
+    monkeypatch.setattr(launch_jenkins, 'Session', FakeSession)
+    monkeypatch.setattr(FakeSession, 'launch_build', launch_build)
+    monkeypatch.setattr(FakeSession, 'job_status', job_status)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'timeout', 0.2)
+    builds = [(g_url, {}), (g_url + '2', {}), (g_url + '3', {})]
+    assert run_batch(builds, g_auth, workers=1) == (
+        launch_jenkins.TIMEOUT_EXIT_CODE
+    )
+
+    assert launched == [g_url]
+    out = capsys.readouterr().out.splitlines()
+    assert out[2].split()[-1] == 'TIMEOUT'
+    assert out[3].split()[1:] == ['-', 'SKIPPED']
+    assert out[4].split()[1:] == ['-', 'SKIPPED']
+
+
+def test_run_batch_wait_all(monkeypatch, capsys, config):
+    """
+    Check that workers only limit how many builds are launched at once, and
+    that all the builds are then waited for from a single thread.
+    """
+    launching = []
+    polls = []
+    threads = set()
+
+    def launch_build(self, url, params):
+        launching.append(url)
+        assert len(launching) == 1
+        time.sleep(0.05)
+        launching.remove(url)
+        return url + '/queue/item/1/'
+
+    def job_status(self, build_url):
+        threads.add(threading.current_thread())
+        polls.append(build_url)
+        # every build takes two polls to finish
+        return (polls.count(build_url) == 2 or None), {}
+
+    monkeypatch.setattr(launch_jenkins, 'Session', FakeSession)
+    monkeypatch.setattr(FakeSession, 'launch_build', launch_build)
+    monkeypatch.setattr(FakeSession, 'job_status', job_status)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'interval', 0.01)
+    builds = [(g_url + str(i), {}) for i in range(3)]
+    assert run_batch(builds, g_auth, workers=1) == 0
+    out = capsys.readouterr().out.splitlines()
+    assert [line.split()[-1] for line in out[2:]] == ['SUCCESS'] * 3
+    assert len(threads) == 1
+    assert sorted(polls[:3]) == [url + '/1' for url, _ in builds]
+
+
+def test_run_batch_follow(monkeypatch, tmp_path, capsys, config):
+    """
+    Check that the logs of all the builds are followed while they run, and
+    saved to the output file of every build.
+    """
+
+    def follow_log(self, build_url, file, start=0, decoder=None):
+        file.write('%s %d\n' % (build_url.rpartition('/')[0], start))
+        return start + 1, start < 1
+
+    monkeypatch.setattr(launch_jenkins, 'Session', FakeSession)
+    monkeypatch.setattr(FakeSession, 'follow_log', follow_log, raising=False)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'follow', True)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'interval', 0.01)
+    monkeypatch.chdir(tmp_path)
+    builds = [(g_url, {}), (other_url, {})]
+    assert run_batch(builds, g_auth) == 0
+
+    for url, _ in builds:
+        log = tmp_path / launch_jenkins.output_file(url + '/1')
+        assert log.read_text() == '%s 0\n%s 1\n' % (url, url)
+
+
+def test_run_batch_output(monkeypatch, capsys, config):
+    """
+    Check that the logs of the builds are downloaded once they finish, and
+    that failed downloads are reported.
+    """
+    saved = []
+
+    def dump_log(self, build_url, lines=None, line_filter=None):
+        if 'full' in build_url:
+            raise IOError('disk full')
+        saved.append(build_url)
+
+    monkeypatch.setattr(launch_jenkins, 'Session', FakeSession)
+    monkeypatch.setattr(FakeSession, 'dump_log', dump_log, raising=False)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'output', True)
+    builds = [(g_url, {}), (other_url + 'full', {})]
+    assert run_batch(builds, g_auth) == 1
+
+    assert saved == [g_url + '/1']
+    out = capsys.readouterr().out.splitlines()
+    assert out[2].split()[-1] == 'SUCCESS'
+    assert out[3].split()[-3:] == ['ERROR:', 'disk', 'full']
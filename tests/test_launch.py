@@ -3,8 +3,10 @@ from __future__ import unicode_literals
 import os
 import sys
 import json
+import codecs
 import time
 import ssl
+import signal
 from io import StringIO
 from threading import Thread
 
@@ -22,6 +24,7 @@ from launch_jenkins import launch_jenkins
 from launch_jenkins import parse_job_url
 from launch_jenkins import get_stderr_size_unix
 from launch_jenkins import is_progressbar_capable
+from launch_jenkins import ProgressBar
 from launch_jenkins import init_ssl
 from launch_jenkins import Session
 from launch_jenkins import launch_build
@@ -29,8 +32,10 @@ from launch_jenkins import wait_queue
 from launch_jenkins import wait_job
 from launch_jenkins import dump_log
 from launch_jenkins import HTTPError
+from launch_jenkins import DeadlineExceeded
 
 from .conftest import FakeResponse
+from .conftest import Dummy
 from .conftest import g_url, g_auth, g_auth_b64
 from .test_helper import assert_show_empty_progress
 from .test_helper import assert_show_no_progressbar
@@ -112,6 +117,32 @@ def test_get_job_params(mock_url, session, response, expect):
     assert session.get_job_params(g_url) == expect
 
 
+@pytest.mark.parametrize(
+    'method, tree',
+    [
+        ('get_job_params', launch_jenkins.JOB_PARAMS_TREE),
+        ('get_queue_status', launch_jenkins.QUEUE_ITEM_TREE),
+    ],
+)
+def test_json_tree_filter(method, tree, monkeypatch, session):
+    """
+    Check that we only ask Jenkins for the fields we need from its json API.
+    """
+    requested = []
+
+    def fake_response(pool, request, *args, **kwargs):
+        requested.append(request.get_full_url())
+        return FakeResponse('{}')
+
+    monkeypatch.setattr(
+        launch_jenkins.ConnectionPool, 'urlopen', fake_response
+    )
+    getattr(session, method)(g_url + '/')
+    url, _, query = requested[0].partition('?')
+    assert url == g_url + '/api/json'
+    assert parse_qs(query) == {'tree': [tree]}
+
+
 @pytest.mark.parametrize(
     'definitions,supplied',
     [
@@ -248,11 +279,13 @@ def test_get_url(monkeypatch, session):
     resp_headers = dict(location='here')
     url = 'http://example.com'
 
-    def fake_response(r, *args, **kwargs):
+    def fake_response(pool, r, *args, **kwargs):
         requests.append(r)
         return FakeResponse(text, headers=resp_headers)
 
-    monkeypatch.setattr(launch_jenkins, 'urlopen', fake_response)
+    monkeypatch.setattr(
+        launch_jenkins.ConnectionPool, 'urlopen', fake_response
+    )
     resp = session.get_url(url)
     assert resp.text == text
     assert resp.headers['location'] == 'here'
@@ -282,11 +315,13 @@ def test_get_url_data(monkeypatch, session):
     url = 'http://example.com'
     data = {'simple': 'hello', 'space': 'hello world', 'weird': 'jk34$"/ &aks'}
 
-    def fake_response(r, *args, **kwargs):
+    def fake_response(pool, r, *args, **kwargs):
         requests.append(r)
         return FakeResponse()
 
-    monkeypatch.setattr(launch_jenkins, 'urlopen', fake_response)
+    monkeypatch.setattr(
+        launch_jenkins.ConnectionPool, 'urlopen', fake_response
+    )
     session.get_url(url, data=data)
 
     req = requests[0]
@@ -306,11 +341,13 @@ def test_get_url_stream(monkeypatch, session):
     text = 'a' * 8192 + 'b' * 100
     url = 'http://example.com'
 
-    def fake_response(r, *args, **kwargs):
+    def fake_response(pool, r, *args, **kwargs):
         requests.append(r)
         return FakeResponse(text)
 
-    monkeypatch.setattr(launch_jenkins, 'urlopen', fake_response)
+    monkeypatch.setattr(
+        launch_jenkins.ConnectionPool, 'urlopen', fake_response
+    )
     resp = session.get_url(url, stream=True)
     assert not hasattr(resp, 'text')
     assert next(resp).text.decode('utf-8') == 'a' * 8192
@@ -350,16 +387,22 @@ def test_get_url_retry(monkeypatch, session):
         raise HTTPError(url, 500, 'Internal Server Error', {}, None)
 
     # raise an error every time
-    monkeypatch.setattr(launch_jenkins, 'urlopen', raise_httperror)
+    monkeypatch.setattr(
+        launch_jenkins.ConnectionPool, 'urlopen', raise_httperror
+    )
     with pytest.raises(HTTPError):
         session.get_url(url, retries=5)
 
     # raise an error the first time and succeed the second
-    monkeypatch.setattr(launch_jenkins, 'urlopen', undo_and_raise)
+    monkeypatch.setattr(
+        launch_jenkins.ConnectionPool, 'urlopen', undo_and_raise
+    )
     assert session.get_url(url, retries=2)
 
     # no retries for posts
-    monkeypatch.setattr(launch_jenkins, 'urlopen', undo_and_raise)
+    monkeypatch.setattr(
+        launch_jenkins.ConnectionPool, 'urlopen', undo_and_raise
+    )
     with pytest.raises(HTTPError):
         session.get_url(url, data={'hello': 'world'}, retries=2)
 
@@ -550,6 +593,127 @@ def test_wait_job(mock_url, status, success, session):
     assert time.time() - t0 >= 0.5
 
 
+@pytest.mark.parametrize(
+    'response, expect',
+    [
+        ({'timestamp': 1000, 'estimatedDuration': 5000}, 6000),
+        ({'timestamp': 1000, 'estimatedDuration': -1}, None),
+        ({}, None),
+    ],
+)
+def test_get_expected_end(response, expect, mock_url, session):
+    mock_url(dict(url=g_url + '/1/api/json', text=json.dumps(response)))
+    assert session.get_expected_end(g_url + '/1/') == expect
+
+
+def test_wait_job_adaptive(monkeypatch, session):
+    """
+    Check that wait_job waits longer between checks when the build has a lot
+    of time left.
+    """
+    delays = []
+    statuses = [
+        (None, {'startTimeMillis': 0, 'durationMillis': 0}),
+        (None, {'startTimeMillis': 0, 'durationMillis': 80000}),
+        (None, {'startTimeMillis': 0, 'durationMillis': 99000}),
+        (True, {}),
+    ]
+    monkeypatch.setattr(session, 'job_status', lambda u: statuses.pop(0))
+    monkeypatch.setattr(session, 'get_expected_end', lambda u: 100000)
+    clock = [0]
+
+    def show(self, msg, delay, millis=None):
+        delays.append(delay)
+        clock[0] += delay
+
+    monkeypatch.setattr(launch_jenkins.ProgressBar, 'show', show)
+    monkeypatch.setattr(launch_jenkins, 'monotonic', lambda: clock[0])
+    assert session.wait_job(g_url, interval=0.5, max_interval=10)
+    assert delays == [10, 5, 0.5]
+
+
+def test_wait_job_fixed_rate(monkeypatch, capsys, session):
+    """
+    Check that the time spent checking the status of a build doesn't stretch
+    the interval between checks, and that their jitter is reported with
+    --debug.
+    """
+    starts = []
+    statuses = [(None, {})] * 4 + [(True, {})]
+
+    def job_status(url):
+        starts.append(time.time())
+        time.sleep(0.1)  # slow Jenkins
+        return statuses.pop(0)
+
+    monkeypatch.setattr(session, 'job_status', job_status)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'debug', True)
+    assert session.wait_job(g_url, interval=0.25)
+    periods = [b - a for a, b in zip(starts, starts[1:])]
+    assert periods == pytest.approx([0.25] * 4, abs=0.05)
+    err = capsys.readouterr().err
+    assert 'Checked %s 5 times, every 0.2' % g_url in err
+    assert 'Jitter: ' in err
+
+
+def test_wait_many(monkeypatch, session):
+    """
+    Check that wait_many follows queue items until they become builds, and
+    yields every build as soon as it finishes.
+    """
+    queue = g_url + '/queue/item/%d/'
+    polls = {}
+
+    def get_queue_status(location):
+        polls[location] = polls.get(location, 0) + 1
+        if location.endswith('/3/'):
+            raise RuntimeError('Build was cancelled')
+        return location.replace('/queue/item', '')
+
+    def job_status(build_url):
+        polls[build_url] = polls.get(build_url, 0) + 1
+        number = int(build_url.rstrip('/').split('/')[-1])
+        # build N finishes after N polls. Odd builds fail
+        if polls[build_url] < number:
+            return None, {}
+        return bool(number % 2), {}
+
+    monkeypatch.setattr(session, 'get_queue_status', get_queue_status)
+    monkeypatch.setattr(session, 'job_status', job_status)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'interval', 0.01)
+    items = [g_url + '/2/', queue % 1, queue % 3]
+    results = list(session.wait_many(items))
+
+    assert [r.item for r in results] == [queue % 3, queue % 1, g_url + '/2/']
+    assert isinstance(results[0].error, RuntimeError)
+    assert results[0].build_url is None
+    assert results[1][1:] == (g_url + '/1/', True, None)
+    assert results[2][1:] == (g_url + '/2/', False, None)
+    assert polls == {
+        queue % 1: 1,
+        queue % 3: 1,
+        g_url + '/1/': 1,
+        g_url + '/2/': 2,
+    }
+
+
+def test_wait_many_rate(monkeypatch, session):
+    """
+    Check that wait_many doesn't poll faster than the given max rate.
+    """
+    times = []
+
+    def job_status(build_url):
+        times.append(time.time())
+        return (True, {}) if len(times) > 4 else (None, {})
+
+    monkeypatch.setattr(session, 'job_status', job_status)
+    items = [g_url + '/%d/' % i for i in range(3)]
+    results = list(session.wait_many(items, interval=0, max_rate=20))
+    assert len(results) == 3
+    assert all(b - a >= 0.04 for a, b in zip(times, times[1:]))
+
+
 def test_wait_job_nonexistent(monkeypatch, session):
     status_code = 400
     build_number = 65
@@ -615,7 +779,95 @@ def test_retrieve_log(mock_url, session):
     assert session.retrieve_log(g_url) == content
 
 
-def test_dump_log(monkeypatch, session):
+def test_follow_log(mock_url, session):
+    """
+    Check that follow_log writes the new part of the log and returns the
+    offset and the X-More-Data flag reported by Jenkins.
+    """
+    output = StringIO()
+    headers = {'X-Text-Size': '42', 'X-More-Data': 'true'}
+    url = g_url + '/logText/progressiveText'
+    mock_url(dict(url=url, text='new stuff', headers=headers))
+    assert session.follow_log(g_url, output, 30) == (42, True)
+    assert output.getvalue() == 'new stuff'
+
+    mock_url(dict(url=url, headers={'X-Text-Size': '42'}))
+    assert session.follow_log(g_url, output, 42) == (42, False)
+    assert output.getvalue() == 'new stuff'
+
+
+def test_follow_log_split_character(monkeypatch, session):
+    """
+    Check that a multibyte character split between two calls to follow_log
+    comes out in one piece.
+    """
+    chunks = [b'caf\xc3', b'\xa9']
+    requested = []
+
+    def fake_response(pool, request, *args, **kwargs):
+        requested.append(request.get_full_url())
+        text = chunks.pop(0)
+        return FakeResponse(text, headers={'X-Text-Size': len(text)})
+
+    monkeypatch.setattr(
+        launch_jenkins.ConnectionPool, 'urlopen', fake_response
+    )
+    output = StringIO()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    offset, _ = session.follow_log(g_url, output, 0, decoder)
+    session.follow_log(g_url, output, offset, decoder)
+    assert output.getvalue() == 'caf\xe9'
+    assert requested[0].endswith('progressiveText?start=0')
+    assert requested[1].endswith('progressiveText?start=4')
+
+
+def test_wait_job_follow(monkeypatch, session):
+    """
+    Check that wait_job writes the log as the build runs, and keeps fetching
+    it after the build has finished until Jenkins says there's nothing more.
+    """
+    statuses = [(None, {}), (None, {}), (True, {})]
+    log_calls = []
+
+    def follow_log(build_url, file, start, decoder):
+        log_calls.append(start)
+        file.write('line %d\n' % start)
+        return start + 1, len(log_calls) < 5
+
+    monkeypatch.setattr(session, 'job_status', lambda u: statuses.pop(0))
+    monkeypatch.setattr(session, 'follow_log', follow_log)
+    output = StringIO()
+    assert session.wait_job(g_url, 0.1, output=output)
+    assert log_calls == [0, 1, 2, 3, 4]
+    assert output.getvalue().splitlines()[-1] == 'line 4'
+
+
+def test_retrieve_log_split_character(mock_url, session):
+    """
+    Check that multibyte characters split between two blocks of the log are
+    not lost.
+    """
+    content = 'a' * 8191 + '\xe9' + 'b' * 10
+    mock_url(dict(url=g_url + '/consoleText', text=content))
+    assert session.retrieve_log(g_url) == content
+
+
+def test_dump_log_chunks(mock_url, monkeypatch, session):
+    """
+    Check that dump_log writes the log block by block instead of building the
+    whole thing in memory first.
+    """
+    written = []
+    output = Dummy(write=written.append)
+    content = 'a' * 8192 * 3
+    mock_url(dict(url=g_url + '/consoleText', text=content))
+    monkeypatch.setattr(session, 'retrieve_log', None)
+    session.dump_log(g_url, output)
+    assert ''.join(written) == content
+    assert max(len(w) for w in written) == 8192
+
+
+def test_dump_log(mock_url, monkeypatch, session):
     def assert_dump(filename, given=None):
         try:
             session.dump_log(g_url, filename=given)
@@ -626,7 +878,8 @@ def test_dump_log(monkeypatch, session):
                 os.remove(filename)
 
     content = 'some log content here'
-    monkeypatch.setattr(session, 'retrieve_log', lambda a: content)
+    url = g_url + '/logText/progressiveText'
+    mock_url(dict(url=url, text=content))
     filename = 'thing_other_master.txt'
     assert_dump(filename, given=None)
 
@@ -654,7 +907,7 @@ def test_dump_log_stdout(mock_url, monkeypatch, capsys, session):
 def test_dump_binary_log(mock_url, session):
     content = b'binary log \xe2\x80 here'
     filename = 'thing_other_master.txt'
-    mock_url(dict(url=g_url + '/consoleText', text=content))
+    mock_url(dict(url=g_url + '/logText/progressiveText', text=content))
     try:
         session.dump_log(g_url)
         assert os.path.isfile(filename)
@@ -664,6 +917,221 @@ def test_dump_binary_log(mock_url, session):
             os.remove(filename)
 
 
+def serve_log(server, path, content):
+    """
+    Serve `content` as the progressive log of a build, and keep count of the
+    bytes sent in `server.sent`.
+    """
+    server.sent = 0
+
+    def handler(request):
+        start = int(parse_qs(request.path.partition('?')[2])['start'][0])
+        body = content[start:]
+        server.sent += len(body)
+        return 200, {'X-Text-Size': str(len(content))}, body
+
+    server.routes[path + 'logText/progressiveText'] = handler
+
+
+@pytest.mark.parametrize('lines', [1, 5, 300, 2000])
+def test_tail_log(local_server, monkeypatch, lines):
+    """
+    Check that tail_log gets the last lines of the log from windows at the
+    end of it, without reading the whole log.
+    """
+    content = ''.join('line %d\n' % i for i in range(1000)).encode('utf-8')
+    serve_log(local_server, '/job/thing/1/', content)
+    monkeypatch.setattr(launch_jenkins, 'TAIL_WINDOW', 100)
+    session = Session(local_server.url, cache=False)
+    tail = session.tail_log(local_server.url + '/job/thing/1', lines)
+
+    expected = content.decode('utf-8').splitlines(True)[-lines:]
+    assert tail == ''.join(expected)
+    requests = [r[1:] for r in local_server.requests if 'start=' in r[2]]
+    url = '/job/thing/1/logText/progressiveText'
+    assert requests[0] == ('HEAD', url + '?start=0')
+    starts = [path.rpartition('=')[2] for _, path in requests[1:]]
+    if lines < 1000:
+        assert '0' not in starts
+
+
+def test_tail_log_line_start(local_server, monkeypatch):
+    """
+    Check that the first line of a window is kept when the window starts
+    right at the beginning of it.
+    """
+    serve_log(local_server, '/job/thing/1/', b'aaaa\nbbbb\ncccc\n')
+    monkeypatch.setattr(launch_jenkins, 'TAIL_WINDOW', 10)
+    session = Session(local_server.url, cache=False)
+    tail = session.tail_log(local_server.url + '/job/thing/1', 2)
+    assert tail == 'bbbb\ncccc\n'
+    paths = [r[2] for r in local_server.requests if r[1] == 'GET']
+    assert paths[-1] == '/job/thing/1/logText/progressiveText?start=4'
+    assert len([p for p in paths if 'start=' in p]) == 1
+
+
+def test_dump_log_tail(local_server):
+    """
+    Check that dump_log only writes the tail of the log when asked to.
+    """
+    content = b'first\nsecond\nthird\n'
+    serve_log(local_server, '/job/thing/1/', content)
+    session = Session(local_server.url, cache=False)
+    output = StringIO()
+    session.dump_log(local_server.url + '/job/thing/1', output, lines=2)
+    assert output.getvalue() == 'second\nthird\n'
+
+
+def test_dump_log_grep(local_server):
+    """
+    Check that dump_log only writes the lines that match a LineFilter, and
+    stops reading the log once it's done.
+    """
+    content = b''.join(b'line %d\n' % i for i in range(100000))
+    local_server.routes['/job/thing/1/consoleText'] = (200, {}, content)
+    session = Session(local_server.url, cache=False)
+    output = StringIO()
+    line_filter = launch_jenkins.LineFilter(['^line 1.$'], max_count=2)
+    build = local_server.url + '/job/thing/1'
+    session.dump_log(build, output, line_filter=line_filter)
+    assert output.getvalue() == 'line 10\nline 11\n'
+    # the connection is closed instead of reading the rest of the log
+    assert not any(session.pool.idle.values())
+
+
+class LogStream:
+    """
+    A streamed response with some blocks of a log, that breaks after sending
+    them if `broken` is set.
+    """
+
+    def __init__(self, blocks, headers=None, broken=False):
+        self.blocks = blocks
+        self.headers = headers or {}
+        self.broken = broken
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield Dummy(text=block)
+        if self.broken:
+            raise IOError('Connection reset by peer')
+
+
+def test_dump_log_interrupted(local_server, monkeypatch, tmp_path):
+    """
+    Check that an interrupted download leaves a marker with the offset
+    Jenkins gave for the part of the log that was saved, and that the next
+    one continues from there.
+    """
+    build = local_server.url + '/job/thing/1/'
+    output = str(tmp_path / 'output.txt')
+    session = Session(local_server.url, cache=False)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'interval', 0)
+    # the raw log is longer than its text because of console notes
+    headers = {'X-Text-Size': '20', 'X-More-Data': 'true'}
+    responses = [
+        LogStream([b'abc', b'def'], headers),
+        LogStream([b'gh\xc3'], broken=True),
+    ]
+    requested = []
+
+    def get_url(url, stream=False):
+        requested.append(url)
+        return responses.pop(0)
+
+    monkeypatch.setattr(session, 'get_url', get_url)
+    with pytest.raises(IOError):
+        session.dump_log(build, output)
+    assert requested == [
+        build + 'logText/progressiveText?start=0',
+        build + 'logText/progressiveText?start=20',
+    ]
+    with open(output + '.partial') as marker:
+        saved = json.load(marker)
+    assert saved == {'build_url': build, 'offset': 20, 'size': 6}
+
+    del session.get_url
+    url = '/job/thing/1/logText/progressiveText'
+    headers = {'X-Text-Size': '26'}
+    local_server.routes[url] = (200, headers, b'gh\xc3\xa9ij')
+    session.dump_log(build, output)
+    assert local_server.requests[-1][2] == url + '?start=20'
+    assert not os.path.exists(output + '.partial')
+    with open(output, 'rb') as file:
+        assert file.read() == 'abcdefgh\xe9ij'.encode('utf-8')
+
+
+def test_dump_log_last_build(local_server, tmp_path):
+    """
+    Check that the marker of a download of lastBuild is kept for the build
+    it points to, so that it isn't used to resume the log of a later build.
+    """
+    build = local_server.url + '/job/thing/1/'
+    local_server.routes['/job/thing/lastBuild/api/json'] = (
+        200,
+        {},
+        json.dumps({'url': build}),
+    )
+    session = Session(local_server.url, cache=False)
+    markers = []
+    session.download_log = lambda partial, *a: markers.append(partial)
+
+    output = str(tmp_path / 'output.txt')
+    session.dump_log(local_server.url + '/job/thing/lastBuild', output)
+    assert [m.build_url for m in markers] == [build]
+
+
+def test_partial_log_marker(monkeypatch, tmp_path):
+    """
+    Check that the marker of a partial log can be saved and read back when
+    json.dumps returns a str, like it does in python 2.
+    """
+
+    class Json:
+        load = staticmethod(json.load)
+
+        @staticmethod
+        def dumps(data):
+            return json.dumps(data).encode('ascii')
+
+    monkeypatch.setattr(launch_jenkins, 'json', Json)
+    output = tmp_path / 'output.txt'
+    output.write_text('abcdef')
+    partial = launch_jenkins.PartialLog(str(output), 'http://x/job/a/1')
+    partial.save(8, 6)
+    assert partial.load() == (8, 6)
+    assert sorted(os.listdir(str(tmp_path))) == [
+        'output.txt',
+        'output.txt.partial',
+    ]
+
+
+@pytest.mark.parametrize(
+    'marker_url,total',
+    [('/job/other/1/', 14), ('/job/thing/1/', 5)],
+    ids=['other_build', 'shorter_log'],
+)
+def test_dump_log_restart(local_server, tmp_path, marker_url, total):
+    """
+    Check that a partial log is downloaded again from scratch if it belongs
+    to another build, or if the log got shorter than the saved part.
+    """
+    build = local_server.url + '/job/thing/1/'
+    output = tmp_path / 'output.txt'
+    output.write_text('old log')
+    marker = {'build_url': local_server.url + marker_url}
+    marker.update(offset=7, size=7)
+    (tmp_path / 'output.txt.partial').write_text(json.dumps(marker))
+    url = '/job/thing/1/logText/progressiveText'
+    local_server.routes[url] = (200, {'X-Text-Size': str(total)}, 'new log')
+
+    Session(local_server.url, cache=False).dump_log(build, str(output))
+    assert output.read_text() == 'new log'
+    assert not (tmp_path / 'output.txt.partial').exists()
+    start = '0' if marker_url == '/job/other/1/' else '7'
+    assert local_server.requests[-1][2] == url + '?start=' + start
+
+
 def test_get_stderr_size_os(terminal_size):
     """
     Test get stderr size when the os module has the get_terminal_size method.
@@ -786,6 +1254,37 @@ def test_show_progress_force(capsys, monkeypatch, terminal_size):
         assert not is_progressbar_capable()
 
 
+@pytest.mark.skipif(
+    not hasattr(signal, 'SIGWINCH'), reason='Needs terminal resize signals'
+)
+def test_progress_bar_thread(capsys, monkeypatch, tty):
+    """
+    Check that the progress bar keeps moving between updates, and that the
+    terminal size is only read again when it changes.
+    """
+    sizes = []
+
+    def get_size():
+        sizes.append(1)
+        return os.terminal_size((50, 30))
+
+    monkeypatch.setattr(launch_jenkins, 'get_stderr_size_unix', get_size)
+    handler = signal.getsignal(signal.SIGWINCH)
+    with ProgressBar() as progress:
+        progress.update('message', millis=0)
+        time.sleep(0.35)  # e.g. a slow request
+        assert len(sizes) == 1
+        os.kill(os.getpid(), signal.SIGWINCH)
+        time.sleep(0.15)
+        assert len(sizes) == 2
+    assert signal.getsignal(signal.SIGWINCH) == handler
+
+    frames = capsys.readouterr().err.split('\r')
+    assert len(frames) >= 5
+    assert frames[0].startswith('[00:00] message ' + '.' * 40 + '  |')
+    assert frames[1].endswith('  /')
+
+
 def test_no_progress_quiet(capsys, monkeypatch, terminal_size):
     """
     Check that nothing is printed when the global "quiet" option is set.
@@ -841,3 +1340,32 @@ def test_deprecate(func, instead, monkeypatch, session):
         match='%s is deprecated.* use mock instead' % func
     ):
         getattr(session, func)()
+
+
+def test_wait_queue_deadline(monkeypatch, session):
+    """
+    Check that wait_queue gives up when the deadline passes, without sleeping
+    past it.
+    """
+    monkeypatch.setattr(session, 'get_queue_status', lambda location: None)
+    start = time.time()
+    deadline = launch_jenkins.monotonic() + 0.3
+    with pytest.raises(DeadlineExceeded) as error:
+        session.wait_queue(g_url + '/queue/item/1/', 5, deadline=deadline)
+    assert 0.3 <= time.time() - start < 1
+    assert error.value.url == g_url + '/queue/item/1/'
+
+
+def test_wait_job_deadline(monkeypatch, session):
+    """
+    Check that wait_job gives up when the deadline passes, without sleeping
+    past it.
+    """
+    monkeypatch.setattr(session, 'job_status', lambda url: (None, {}))
+    start = time.time()
+    deadline = launch_jenkins.monotonic() + 0.3
+    with pytest.raises(DeadlineExceeded) as error:
+        session.wait_job(g_url + '/1/', 5, deadline=deadline)
+    assert 0.3 <= time.time() - start < 1
+    assert error.value.url == g_url + '/1/'
+    assert str(error.value) == 'Timed out waiting for build #1 to finish'
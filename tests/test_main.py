@@ -1,4 +1,5 @@
 import sys
+import json
 import pytest
 
 from launch_jenkins import launch_jenkins
@@ -17,7 +18,7 @@ build_url = job_url + '/1/'
 def session(monkeypatch):
     monkeypatch.setattr(launch_jenkins.Session, '_get_crumb', lambda *a: None)
     session = launch_jenkins.Session(job_url, g_auth)
-    monkeypatch.setattr(launch_jenkins, 'Session', lambda a, b: session)
+    monkeypatch.setattr(launch_jenkins, 'Session', lambda *a, **kw: session)
     return session
 
 
@@ -41,7 +42,7 @@ def launch_build(monkeypatch, session):
 
 @pytest.fixture
 def wait_queue(monkeypatch, session):
-    def mock(location):
+    def mock(location, deadline=None):
         call_log.append(('wait_queue', [location]))
         return build_url
 
@@ -50,7 +51,7 @@ def wait_queue(monkeypatch, session):
 
 @pytest.fixture
 def wait_job(monkeypatch, session):
-    def mock(build_url):
+    def mock(build_url, deadline=None):
         call_log.append(('wait_job', [build_url]))
         return True
 
@@ -59,7 +60,7 @@ def wait_job(monkeypatch, session):
 
 @pytest.fixture
 def wait_job_fail(monkeypatch, session):
-    def mock(build_url):
+    def mock(build_url, deadline=None):
         call_log.append(('wait_job', [build_url]))
         return False
 
@@ -68,7 +69,7 @@ def wait_job_fail(monkeypatch, session):
 
 @pytest.fixture
 def dump_log(monkeypatch, session):
-    def mock(build_url):
+    def mock(build_url, lines=None, line_filter=None):
         call_log.append(('dump_log', [build_url]))
 
     monkeypatch.setattr(session, 'dump_log', mock)
@@ -177,6 +178,30 @@ def test_launch_jenkins_main_dumplog(monkeypatch):
     assert call_log[4] == ('dump_log', [build_url])
 
 
+@pytest.mark.usefixtures('parse_args', 'launch_build', 'wait_queue')
+def test_launch_jenkins_main_follow(monkeypatch, session, tmp_path):
+    """
+    Check that in follow mode the output file is passed to wait_job, and the
+    log is not downloaded again afterwards.
+    """
+    del call_log[:]
+
+    def wait_job(build_url, output=None, deadline=None):
+        call_log.append(('wait_job', [build_url]))
+        output.write('build output')
+        return True
+
+    output = tmp_path / 'output.txt'
+    monkeypatch.setattr(session, 'wait_job', wait_job)
+    monkeypatch.setattr(session, 'dump_log', None)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'mode', 'full')
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'follow', True)
+    monkeypatch.setitem(launch_jenkins.CONFIG, 'output', str(output))
+    assert launch_jenkins.main() == 0
+    assert call_log[3] == ('wait_job', [build_url])
+    assert output.read_text() == 'build output'
+
+
 @pytest.mark.usefixtures(
     'parse_args',
     'launch_build',
@@ -218,3 +243,102 @@ def test_launch_jenkins_help(monkeypatch, capsys):
     assert 'usage:' in out
     assert 'positional arguments:' in out
     assert 'optional arguments:' in out
+
+
+@pytest.mark.usefixtures('parse_args', 'launch_build', 'wait_queue')
+def test_main_timeout(monkeypatch, session, config):
+    """
+    Check that main exits with a special code when the build takes too long,
+    and stops it if requested.
+    """
+    deadlines = []
+    stopped = []
+
+    def wait_job(build_url, deadline=None):
+        deadlines.append(deadline)
+        raise launch_jenkins.DeadlineExceeded('Timed out', build_url)
+
+    monkeypatch.setattr(session, 'wait_job', wait_job)
+    monkeypatch.setattr(session, 'stop_build', stopped.append)
+    launch_jenkins.CONFIG['mode'] = 'full'
+    launch_jenkins.CONFIG['quiet'] = True
+    launch_jenkins.CONFIG['timeout'] = 60
+
+    now = launch_jenkins.monotonic()
+    assert launch_jenkins.main() == launch_jenkins.TIMEOUT_EXIT_CODE
+    assert now + 59 < deadlines[0] < now + 61
+    assert not stopped
+
+    launch_jenkins.CONFIG['abort_on_timeout'] = True
+    assert launch_jenkins.main() == launch_jenkins.TIMEOUT_EXIT_CODE
+    assert stopped == [build_url]
+
+
+def test_queue_deadline(monkeypatch, config):
+    launch_jenkins.CONFIG['queue_timeout'] = None
+    assert launch_jenkins.queue_deadline(None) is None
+    assert launch_jenkins.queue_deadline(100) == 100
+
+    monkeypatch.setattr(launch_jenkins, 'monotonic', lambda: 10)
+    launch_jenkins.CONFIG['queue_timeout'] = 30
+    assert launch_jenkins.queue_deadline(None) == 40
+    assert launch_jenkins.queue_deadline(100) == 40
+    assert launch_jenkins.queue_deadline(20) == 20
+
+
+@pytest.mark.usefixtures('parse_args', 'launch_build', 'wait_queue')
+@pytest.mark.usefixtures('wait_job')
+def test_main_stats(capsys, config):
+    """
+    Check that main prints a summary of where the time went with --stats.
+    """
+    launch_jenkins.CONFIG['mode'] = 'full'
+    launch_jenkins.CONFIG['stats'] = True
+    assert launch_jenkins.main() == 0
+    err = capsys.readouterr().err
+    assert '0 requests, 0 retries, 0 bytes received' in err
+    assert 'Time spent: launch 0.0s, queue wait 0.0s, build run 0.0s' in err
+
+
+@pytest.mark.usefixtures('parse_args', 'launch_build', 'wait_queue')
+@pytest.mark.usefixtures('wait_job')
+def test_main_metrics_file(capsys, config, tmp_path):
+    """
+    Check that main writes the metrics file at exit with --metrics-file.
+    """
+    path = tmp_path / 'launcher.prom'
+    launch_jenkins.CONFIG['mode'] = 'full'
+    launch_jenkins.CONFIG['metrics_file'] = str(path)
+    assert launch_jenkins.main() == 0
+    metrics = path.read_text()
+    assert 'launch_jenkins_queue_duration_seconds_count 1\n' in metrics
+    assert metrics.endswith('# EOF\n')
+    assert not capsys.readouterr().err
+
+
+@pytest.mark.usefixtures('parse_args', 'launch_build', 'wait_queue')
+@pytest.mark.usefixtures('wait_job')
+def test_main_trace(config, tmp_path):
+    """
+    Check that main writes a trace of the launch at exit with --trace.
+    """
+    path = tmp_path / 'trace.json'
+    launch_jenkins.CONFIG['mode'] = 'full'
+    launch_jenkins.CONFIG['trace'] = str(path)
+    assert launch_jenkins.main() == 0
+    events = json.loads(path.read_text())['traceEvents']
+    names = [event['name'] for event in events if event['ph'] == 'X']
+    assert names == ['launch', 'queue wait', 'build run']
+
+
+@pytest.mark.usefixtures('parse_args', 'launch_build', 'wait_queue')
+@pytest.mark.usefixtures('wait_job')
+def test_main_trace_error(capsys, config, tmp_path):
+    """
+    Check that failing to write the trace doesn't change the exit code.
+    """
+    path = tmp_path / 'missing' / 'trace.json'
+    launch_jenkins.CONFIG['mode'] = 'full'
+    launch_jenkins.CONFIG['trace'] = str(path)
+    assert launch_jenkins.main() == 0
+    assert 'Could not write %s' % path in capsys.readouterr().err
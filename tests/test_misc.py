@@ -1,9 +1,21 @@
+import os
+import sys
+import json
+import subprocess
+
 import pytest
 
 from launch_jenkins import launch_jenkins
 from launch_jenkins import log
 from launch_jenkins import errlog
 from launch_jenkins import CaseInsensitiveDict
+from launch_jenkins import adaptive_interval
+from launch_jenkins import LineFilter
+from launch_jenkins import LaunchStats
+from launch_jenkins import RequestEvent
+from launch_jenkins import StageEvent
+from launch_jenkins import url_endpoint
+from launch_jenkins import trace_span_name
 
 
 def test_log(monkeypatch, capsys):
@@ -62,3 +74,232 @@ def test_caseinsensitivedict():
 ])
 def test_format_millis(millis, expect):
     assert launch_jenkins.format_millis(millis) == expect
+
+
+@pytest.mark.parametrize('expected_end, stage, expect', [
+    (None, {'startTimeMillis': 0, 'durationMillis': 0}, 1),
+    (600000, {}, 1),
+    (600000, {'startTimeMillis': 0, 'durationMillis': 0}, 60),
+    (600000, {'startTimeMillis': 500000, 'durationMillis': 0}, 25),
+    (600000, {'startTimeMillis': 500000, 'durationMillis': 98000}, 1),
+    (600000, {'startTimeMillis': 500000, 'durationMillis': 200000}, 1),
+], ids=[
+    'no estimate',
+    'no stage times',
+    'early, capped at max',
+    'halfway',
+    'almost done, capped at min',
+    'late',
+])
+def test_adaptive_interval(expected_end, stage, expect):
+    assert adaptive_interval(expected_end, stage, 1, 60) == expect
+
+
+GREP_LOG = b'a1\nb2\na3\nc4\nc5\nc6\na7\nc8'
+
+
+@pytest.mark.parametrize('patterns, kwargs, expect', [
+    (['a'], {}, 'a1 a3 a7'),
+    (['^c', 'b'], {}, 'b2 c4 c5 c6 c8'),
+    (['a'], {'after': 1}, 'a1 b2 a3 c4 -- a7 c8'),
+    (['7'], {'before': 1}, 'c6 a7'),
+    (['[ab]'], {'before': 1}, 'a1 b2 a3 -- c6 a7'),
+    (['c'], {'before': 2, 'after': 1}, 'b2 a3 c4 c5 c6 a7 c8'),
+    (['8$'], {}, 'c8'),
+    (['a'], {'max_count': 2}, 'a1 a3'),
+    (['a'], {'after': 2, 'max_count': 1}, 'a1 b2 a3'),
+    (['x'], {'before': 2}, ''),
+    (['1\\sb', '6\\n'], {}, ''),
+    (['2\\s+a', 'a'], {}, 'a1 a3 a7'),
+], ids=[
+    'simple',
+    'many patterns',
+    'after context',
+    'before context',
+    'separator',
+    'overlapping context',
+    'no new line at the end',
+    'max count',
+    'context after max count',
+    'no matches',
+    'across lines',
+    'line after a match across lines',
+])
+def test_line_filter(patterns, kwargs, expect):
+    """
+    Check that LineFilter keeps the same lines as grep, however the log is
+    split into blocks.
+    """
+    expect = ''.join(line + '\n' for line in expect.split())
+    for size in range(1, len(GREP_LOG) + 1):
+        line_filter = LineFilter(patterns, **kwargs)
+        blocks = [
+            GREP_LOG[i : i + size] for i in range(0, len(GREP_LOG), size)
+        ]
+        out = b''.join(line_filter.feed(block) for block in blocks)
+        out += line_filter.flush()
+        assert out.decode('utf-8') == expect
+    assert line_filter.done == ('max_count' in kwargs)
+
+
+@pytest.mark.parametrize('url, expect', [
+    ('http://example.com/crumbIssuer/api/xml?x=y', '/crumbIssuer/api/xml'),
+    ('http://example.com/job/a/job/b/api/json', '/job/*/job/*/api/json'),
+    ('http://example.com/job/a/12/wfapi/describe', '/job/*/N/wfapi/describe'),
+    ('http://example.com/job/a/12', '/job/*/N'),
+    ('http://example.com/queue/item/345/api/json', '/queue/item/N/api/json'),
+])
+def test_url_endpoint(url, expect):
+    assert url_endpoint(url) == expect
+
+
+@pytest.mark.parametrize('endpoint, expect', [
+    ('/crumbIssuer/api/xml', 'crumb fetch'),
+    ('/job/*/job/*/api/json', 'parameter discovery'),
+    ('/job/*/buildWithParameters', 'build request'),
+    ('/queue/item/N/api/json', 'queue poll'),
+    ('/job/*/N/wfapi/describe', 'status poll'),
+    ('/job/*/N/logText/progressiveText', 'log download'),
+    ('/queue/cancelItem', '/queue/cancelItem'),
+])
+def test_trace_span_name(endpoint, expect):
+    assert trace_span_name(endpoint) == expect
+
+
+def test_launch_stats():
+    """
+    Check the summary of the requests and phases of a launch.
+    """
+    stats = LaunchStats()
+    for i in range(1, 101):
+        stats(
+            RequestEvent(
+                'GET', 'url', '/queue/item/N/api/json', 200, 10, i % 2, 0,
+                None, None, None, 0.001, i / 1000.0, None,
+            )
+        )
+    stats(
+        RequestEvent(
+            'POST', 'url', '/job/*/build', 201, 0, 0, 0,
+            None, None, None, 0.001, 0.5, None,
+        )
+    )
+    with stats.phase('queue'):
+        pass
+    stats.phases.append(('build', 10.0, 12.5))
+
+    lines = stats.summary().splitlines()
+    assert lines[2].split() == [
+        'GET', '/queue/item/N/api/json', '100', '50.0', '90.0', '99.0',
+        '100.0', '1000',
+    ]
+    assert lines[3].split()[:3] == ['POST', '/job/*/build', '1']
+    assert lines[-2] == '101 requests, 50 retries, 1000 bytes received'
+    assert lines[-1] == 'Time spent: queue wait 0.0s, build run 2.5s'
+
+
+def test_launch_stats_openmetrics():
+    """
+    Check the OpenMetrics export of the requests and phases of a launch.
+    """
+    stats = LaunchStats()
+    with stats.phase('queue'):
+        for total in (0.003, 0.2):
+            stats(
+                RequestEvent(
+                    'GET', 'url', '/queue/item/N/api/json', 200, 10, 1, 0,
+                    None, None, None, 0.001, total, None,
+                )
+            )
+    stats.phases.append(('log', 10.0, 12.5))
+
+    lines = stats.openmetrics().splitlines()
+    labels = '{method="GET",endpoint="/queue/item/N/api/json"}'
+    assert 'launch_jenkins_requests_total%s 2' % labels in lines
+    assert 'launch_jenkins_request_retries_total%s 2' % labels in lines
+    assert 'launch_jenkins_received_bytes_total%s 20' % labels in lines
+    bucket = 'launch_jenkins_request_duration_seconds_bucket'
+    labels = labels[:-1] + ',le="%s"}'
+    assert '%s%s 1' % (bucket, labels % '0.005') in lines
+    assert '%s%s 1' % (bucket, labels % '0.1') in lines
+    assert '%s%s 2' % (bucket, labels % '0.25') in lines
+    assert '%s%s 2' % (bucket, labels % '+Inf') in lines
+    assert 'launch_jenkins_queue_duration_seconds_count 1' in lines
+    assert 'launch_jenkins_build_duration_seconds_count 0' in lines
+    assert 'launch_jenkins_polls_total{phase="queue"} 2' in lines
+    assert 'launch_jenkins_polls_total{phase="build"} 0' in lines
+    assert 'launch_jenkins_log_download_seconds_total 2.5' in lines
+    assert '# TYPE launch_jenkins_requests counter' in lines
+    assert lines[-1] == '# EOF'
+
+
+def test_launch_stats_trace():
+    """
+    Check the Chrome trace of the requests, phases and pipeline stages of a
+    launch.
+    """
+    stats = LaunchStats()
+    with stats.phase('launch'):
+        start = launch_jenkins.monotonic()
+        stats(
+            RequestEvent(
+                'POST', 'url', '/job/*/build', 201, 0, 0, start,
+                None, None, None, 0.1, 0.25, None,
+            )
+        )
+    build = 'http://example.com/job/a/1/'
+    stage = {'id': '6', 'name': 'Build', 'status': 'IN_PROGRESS'}
+    stage.update(startTimeMillis=1600000000000, durationMillis=1000)
+    stats(StageEvent(build, [stage]))
+    stage = dict(stage, status='SUCCESS', durationMillis=5000)
+    stats(StageEvent(build, [stage, {'id': '7', 'name': 'Queued'}]))
+
+    trace = json.loads(stats.chrome_trace())
+    tracks = {
+        event['args']['name']: event['tid']
+        for event in trace['traceEvents']
+        if event['ph'] == 'M'
+    }
+    assert sorted(tracks) == ['MainThread', 'Stages of ' + build]
+    spans = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+    phase, request, stage = spans
+    assert (phase['name'], phase['cat']) == ('launch', 'phase')
+    assert (request['name'], request['cat']) == ('build request', 'request')
+    assert request['dur'] == 250000
+    assert phase['ts'] <= request['ts']
+    assert request['args']['status'] == 201
+    assert phase['tid'] == request['tid'] == tracks['MainThread']
+    assert stage['tid'] == tracks['Stages of ' + build]
+    assert (stage['name'], stage['cat']) == ('Build', 'stage')
+    assert stage['ts'] == 1600000000000000
+    assert stage['dur'] == 5000000
+    assert stage['args']['status'] == 'SUCCESS'
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 7), reason='Needs module level __getattr__'
+)
+def test_lazy_imports():
+    """
+    Check that importing the package doesn't import the slow modules, and
+    that the names it used to import are still there.
+    """
+    slow = [
+        'argparse',
+        'csv',
+        'json',
+        'ssl',
+        'http.client',
+        'http.cookiejar',
+        'urllib.request',
+        'multiprocessing.pool',
+    ]
+    code = (
+        'import sys, launch_jenkins\n'
+        'print(" ".join(m for m in {!r} if m in sys.modules))\n'
+        'launch_jenkins.HTTPError, launch_jenkins.LWPCookieJar\n'
+        'launch_jenkins.launch_jenkins.Request\n'
+    ).format(slow)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert output.decode('utf-8').strip() == ''
@@ -1,8 +1,40 @@
+import io
+import os
+import json
+import base64
+import threading
+import sys
+
+import ssl
+import socket
+import time
+import gzip
+import zlib
+from multiprocessing.pool import ThreadPool
+
 import pytest
 
 from launch_jenkins import Session
 from launch_jenkins import HTTPError
+from launch_jenkins import CrumbCache
+from launch_jenkins import ParamsCache
+from launch_jenkins import write_atomic
+from launch_jenkins import LWPCookieJar
+from launch_jenkins import ConnectionPool
+from launch_jenkins import https_connection_class
+from launch_jenkins import init_ssl
+from launch_jenkins import Request
+from launch_jenkins import RetryPolicy
+from launch_jenkins import StageEvent
+from launch_jenkins import QueueWatcher
+from launch_jenkins import launch_jenkins
+
+if sys.version_info >= (3,):
+    from http.cookiejar import Cookie
+else:
+    from cookielib import Cookie
 
+from .conftest import Dummy
 from .conftest import g_auth, g_auth_b64, g_url
 
 
@@ -52,3 +84,779 @@ def test_crumb_httperror(mock_url, session):
     # if response was anything other than 404 the error is propagated
     with pytest.raises(HTTPError):
         session._get_crumb()
+
+
+def test_pool_reuse(local_server):
+    """
+    Check that consecutive requests to the same host reuse the same
+    connection.
+    """
+    local_server.routes['/thing'] = (200, {}, 'hello')
+    session = Session(local_server.url)
+    for _ in range(3):
+        assert session.get_url(local_server.url + '/thing').text == 'hello'
+    clients = set(r[0] for r in local_server.requests)
+    assert len(local_server.requests) == 4  # crumb + 3 requests
+    assert len(clients) == 1
+
+
+def test_pool_stream_reuse(local_server):
+    """
+    Check that a streamed response gives its connection back to the pool once
+    it has been read completely.
+    """
+    local_server.routes['/log'] = (200, {}, 'a' * 10000)
+    session = Session(local_server.url)
+    for _ in range(2):
+        blocks = session.get_url(local_server.url + '/log', stream=True)
+        assert sum(len(b.text) for b in blocks) == 10000
+    assert len(set(r[0] for r in local_server.requests)) == 1
+
+
+def test_pool_stale_connection(local_server):
+    """
+    Check that we transparently reconnect when the server closes a connection
+    that was sitting idle in the pool.
+    """
+
+    def close_after(handler):
+        handler.close_connection = True
+        return 200, {}, 'bye'
+
+    local_server.routes['/close'] = close_after
+    local_server.routes['/thing'] = (200, {}, 'hello')
+    session = Session(local_server.url)
+    assert session.get_url(local_server.url + '/close').text == 'bye'
+    assert session.get_url(local_server.url + '/thing').text == 'hello'
+    assert len(set(r[0] for r in local_server.requests)) == 2
+
+
+def test_pool_timeout_no_resend(local_server):
+    """
+    Check that a POST that times out on a reused connection isn't sent again,
+    since the server may have processed it already.
+    """
+    done = threading.Event()
+
+    def slow(handler):
+        done.wait(1)
+        return 201, {}, ''
+
+    local_server.routes['/thing'] = (200, {}, 'hello')
+    local_server.routes['/build'] = slow
+    pool = ConnectionPool(timeout=0.2)
+    response = pool.send(Request(local_server.url + '/thing'))
+    response.read()
+    response.release_conn()
+    try:
+        with pytest.raises(socket.timeout):
+            pool.send(Request(local_server.url + '/build', data=b'x'))
+    finally:
+        done.set()
+    time.sleep(0.2)
+    paths = [r[2] for r in local_server.requests]
+    assert paths == ['/thing', '/build']
+
+
+def test_pool_maxsize(local_server):
+    """
+    Check that the pool doesn't keep more idle connections than allowed.
+    """
+    local_server.routes['/thing'] = (200, {}, 'hello')
+    session = Session(local_server.url, pool_size=1)
+    key = ('http', local_server.url.split('/')[2])
+    first = session.pool.get_connection(key)[0]
+    second = session.pool.get_connection(key)[0]
+    for conn in (first, second):
+        conn.request('GET', '/thing')
+        response = conn.getresponse()
+        response.read()
+        session.pool.put_connection(key, conn, response)
+    assert session.pool.idle[key] == [first]
+
+    session.pool.clear()
+    assert not session.pool.idle
+
+
+def test_pool_redirect_and_errors(local_server):
+    """
+    Check that the pool follows redirects and raises HTTPError for error
+    codes, like urllib would.
+    """
+    local_server.routes['/old'] = (302, {'Location': '/new'}, '')
+    local_server.routes['/new'] = (200, {}, 'moved')
+    session = Session(local_server.url)
+    assert session.get_url(local_server.url + '/old').text == 'moved'
+
+    with pytest.raises(HTTPError) as error:
+        session.get_url(local_server.url + '/nothing', retries=1)
+    assert error.value.code == 404
+
+
+def test_shared_ssl_context(monkeypatch, tmp_path, config):
+    """
+    Check that SSL contexts are only created once for the same settings.
+    """
+    assert init_ssl() is init_ssl()
+
+    monkeypatch.setenv('SSL_CERT_DIR', str(tmp_path))
+    pool = ThreadPool(8)
+    try:
+        contexts = pool.map(lambda _: init_ssl(), range(8))
+    finally:
+        pool.close()
+    assert len(set(map(id, contexts))) == 1
+
+    launch_jenkins.CONFIG['verify_ssl'] = False
+    insecure = init_ssl()
+    assert insecure is not contexts[0]
+    assert insecure.verify_mode == ssl.CERT_NONE
+    assert init_ssl() is insecure
+
+
+def test_pool_tls_sessions():
+    """
+    Check that new connections try to resume the last TLS session to the
+    same host.
+    """
+    pool = ConnectionPool(init_ssl())
+    conn = pool.new_connection('https', 'example.com')
+    assert isinstance(conn, https_connection_class())
+    assert conn.tls_session is None
+
+    conn = Dummy(
+        sock=Dummy(session='tls session'),
+        connect=lambda: None,
+        request=lambda *args: None,
+        getresponse=lambda: Dummy(info=None, headers={}),
+    )
+    pool.get_connection = lambda key: (conn, False)
+    pool.send(Request('https://example.com/'))
+    conn = pool.new_connection('https', 'example.com')
+    assert conn.tls_session == 'tls session'
+    assert pool.new_connection('https', 'example.org').tls_session is None
+    conn = pool.new_connection('http', 'example.com')
+    assert not hasattr(conn, 'tls_session')
+
+
+def test_pool_proxy_auth(local_server, monkeypatch):
+    """
+    Check that the credentials in the proxy url are sent to the proxy, both
+    with plain requests and when tunneling to an HTTPS host.
+    """
+    proxy = local_server.url.replace('://', '://user:p%40ss@')
+    monkeypatch.setenv('http_proxy', proxy)
+    monkeypatch.setenv('https_proxy', proxy)
+    monkeypatch.delenv('no_proxy', raising=False)
+    monkeypatch.delenv('NO_PROXY', raising=False)
+    local_server.routes['http://example.com/thing'] = lambda handler: (
+        200,
+        {},
+        handler.headers['Proxy-Authorization'],
+    )
+    expect = 'Basic ' + base64.b64encode(b'user:p@ss').decode('ascii')
+
+    pool = ConnectionPool()
+    response = pool.urlopen(Request('http://example.com/thing'))
+    assert response.read().decode('ascii') == expect
+    conn = pool.new_connection('https', 'example.com')
+    assert conn._tunnel_host == 'example.com'
+    assert conn._tunnel_headers == {'Proxy-Authorization': expect}
+
+
+def test_crumb_cache(tmp_path):
+    """
+    Save a crumb and some cookies to the cache and read them back.
+    """
+    jar = LWPCookieJar()
+    jar.set_cookie(make_cookie('JSESSIONID', 'abc'))
+    cache = CrumbCache('http://example.com', 'user', str(tmp_path / 'x'))
+    assert cache.load(LWPCookieJar()) is None
+
+    cache.save(('key', 'value'), jar)
+    assert oct(os.stat(cache.path).st_mode & 0o777) == oct(0o600)
+    assert oct(os.stat(cache.cookies_path).st_mode & 0o777) == oct(0o600)
+    loaded = LWPCookieJar()
+    assert cache.load(loaded) == ('key', 'value')
+    assert [c.value for c in loaded] == ['abc']
+
+    # different user, different entry
+    other = CrumbCache('http://example.com', 'other', str(tmp_path / 'x'))
+    assert other.load(LWPCookieJar()) is None
+
+    cache.save((), jar)
+    assert cache.load(LWPCookieJar()) == ()
+
+    cache.ttl = -1
+    assert cache.load(LWPCookieJar()) is None
+
+    cache.clear()
+    assert not os.listdir(str(tmp_path / 'x'))
+
+
+def make_cookie(name, value):
+    return Cookie(
+        0, name, value, None, False, 'example.com', False, False, '/',
+        True, False, None, True, None, None, {},
+    )
+
+
+def test_session_crumb_cache(local_server, monkeypatch, tmp_path):
+    """
+    Check that a new session reuses the cached crumb and cookies instead of
+    asking Jenkins for them again.
+    """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    crumb_headers = {'Set-Cookie': 'JSESSIONID=abc; Path=/'}
+    local_server.routes['/crumbIssuer/api/xml'] = (200, crumb_headers, 'k:v')
+    local_server.routes['/thing'] = lambda handler: (
+        200,
+        {},
+        '{} {}'.format(handler.headers['k'], handler.headers['Cookie']),
+    )
+
+    Session(local_server.url, g_auth, cache=True)
+    assert len(local_server.requests) == 1
+
+    session = Session(local_server.url, g_auth, cache=True)
+    assert len(local_server.requests) == 1
+    assert session.get_url(local_server.url + '/thing').text == (
+        'v JSESSIONID=abc'
+    )
+
+
+def test_session_crumb_cache_rejected(local_server, monkeypatch, tmp_path):
+    """
+    Check that we get a new crumb when Jenkins rejects the cached one.
+    """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    crumb = local_server.routes['/crumbIssuer/api/xml'] = [200, {}, 'k:old']
+
+    def post(handler):
+        if handler.headers['k'] != 'new':
+            return 403, {}, 'No valid crumb was included in the request'
+        return 201, {'Location': 'queue'}, ''
+
+    local_server.routes['/build'] = post
+    Session(local_server.url, g_auth, cache=True)
+    crumb[2] = 'k:new'
+
+    session = Session(local_server.url, g_auth, cache=True)
+    response = session.get_url(local_server.url + '/build', data='')
+    assert response.headers['Location'] == 'queue'
+    assert session.headers['k'] == 'new'
+    assert [r[2].split('?')[0] for r in local_server.requests] == [
+        '/crumbIssuer/api/xml',
+        '/build',
+        '/crumbIssuer/api/xml',
+        '/build',
+    ]
+
+    # the new crumb is cached now
+    Session(local_server.url, g_auth, cache=True)
+    assert len(local_server.requests) == 4
+
+
+def test_session_crumb_rejected_threads(local_server, monkeypatch, tmp_path):
+    """
+    Check that when threads sharing a session get their cached crumb
+    rejected at the same time, only one of them gets a new crumb, and all of
+    them send their requests again with it.
+    """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    crumb = local_server.routes['/crumbIssuer/api/xml'] = [200, {}, 'k:old']
+    lock = threading.Lock()
+    arrived = [0]
+    all_arrived = threading.Event()
+
+    def get(handler):
+        if handler.headers['k'] != 'new':
+            # all the threads are rejected at once
+            with lock:
+                arrived[0] += 1
+                if arrived[0] == 4:
+                    all_arrived.set()
+            all_arrived.wait(5)
+            return 403, {}, 'No valid crumb was included in the request'
+        return 200, {}, 'ok'
+
+    local_server.routes['/thing'] = get
+    Session(local_server.url, g_auth, cache=True)
+    crumb[2] = 'k:new'
+    session = Session(local_server.url, g_auth, cache=True, pool_size=4)
+    del local_server.requests[:]
+
+    pool = ThreadPool(4)
+    try:
+        texts = pool.map(
+            lambda _: session.get_url(local_server.url + '/thing').text,
+            range(4),
+        )
+    finally:
+        pool.close()
+    assert texts == ['ok'] * 4
+    paths = [r[2].split('?')[0] for r in local_server.requests]
+    assert paths.count('/crumbIssuer/api/xml') == 1
+    assert paths.count('/thing') == 8
+
+
+def params_response(*names):
+    definitions = [{'name': name} for name in names]
+    prop = {
+        '_class': 'hudson.model.ParametersDefinitionProperty',
+        'parameterDefinitions': definitions,
+    }
+    return (200, {}, json.dumps({'property': [prop]}))
+
+
+def build_paths(server):
+    return [
+        r[2].split('?')[0] for r in server.requests if 'crumb' not in r[2]
+    ]
+
+
+def test_params_cache(tmp_path):
+    """
+    Save some parameter definitions in the cache and read them back, from
+    memory and from disk.
+    """
+    cache = ParamsCache(str(tmp_path))
+    assert cache.get('http://job/') is None
+    cache.set('http://job/', {'a': None, 'b': ['x', 'y']})
+    assert cache.get('http://job/') == {'a': None, 'b': ['x', 'y']}
+
+    other = ParamsCache(str(tmp_path))
+    assert other.get('http://job/') == {'a': None, 'b': ['x', 'y']}
+    assert ParamsCache().get('http://job/') is None
+
+    other.ttl = -1
+    assert other.get('http://job/') is None
+
+    cache.discard('http://job/')
+    assert cache.get('http://job/') is None
+    assert not os.listdir(str(tmp_path))
+
+
+def test_write_atomic(tmp_path):
+    """
+    Check that files can be written from text or bytes (what json.dumps
+    returns in python 2), and that no temporary file is left behind when
+    the write fails.
+    """
+    path = str(tmp_path / 'file.json')
+    write_atomic(path, u'{"caf\xe9": 1}')
+    assert (tmp_path / 'file.json').read_bytes() == b'{"caf\xc3\xa9": 1}'
+    write_atomic(path, b'{"a": 1}')
+    assert (tmp_path / 'file.json').read_bytes() == b'{"a": 1}'
+
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'x').touch()
+    with pytest.raises(OSError):
+        write_atomic(str(tmp_path / 'dir'), 'text')
+    assert sorted(os.listdir(str(tmp_path))) == ['dir', 'file.json']
+
+
+def test_write_atomic_threads(tmp_path):
+    """
+    Check that threads can write the same file at the same time.
+    """
+    path = str(tmp_path / 'file.txt')
+    texts = ['%d' % i * 100000 for i in range(8)]
+    pool = ThreadPool(8)
+    try:
+        pool.map(lambda text: write_atomic(path, text), texts * 16)
+    finally:
+        pool.close()
+    assert (tmp_path / 'file.txt').read_text() in texts
+    assert os.listdir(str(tmp_path)) == ['file.txt']
+
+
+def test_launch_cached_params(local_server, monkeypatch, tmp_path):
+    """
+    Check that the job parameters are only requested once per session, or
+    once in total when the disk cache is enabled.
+    """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    local_server.routes['/job/thing/api/json'] = params_response('a')
+    local_server.routes['/job/thing/buildWithParameters'] = (
+        201,
+        {'Location': 'queue/item/1/'},
+        '',
+    )
+    job = local_server.url + '/job/thing'
+
+    session = Session(local_server.url, cache=False)
+    session.launch_build(job, {'a': 1})
+    session.launch_build(job + '/', {'a': 2})
+    assert build_paths(local_server) == [
+        '/job/thing/api/json',
+        '/job/thing/buildWithParameters',
+        '/job/thing/buildWithParameters',
+    ]
+    assert Session(local_server.url, cache=False).params_cache.entries == {}
+
+    del local_server.requests[:]
+    Session(local_server.url, cache=True).launch_build(job, {'a': 1})
+    Session(local_server.url, cache=True).launch_build(job, {'a': 1})
+    assert build_paths(local_server) == [
+        '/job/thing/api/json',
+        '/job/thing/buildWithParameters',
+        '/job/thing/buildWithParameters',
+    ]
+
+
+def test_launch_stale_params(local_server):
+    """
+    Check that the cached parameters are refreshed when the ones given to
+    launch_build don't match them.
+    """
+    local_server.routes['/job/thing/api/json'] = params_response('a', 'b')
+    local_server.routes['/job/thing/buildWithParameters'] = (
+        201,
+        {'Location': 'queue/item/1/'},
+        '',
+    )
+    job = local_server.url + '/job/thing'
+    session = Session(local_server.url, cache=False)
+    session.params_cache.set(job + '/', {'a': None})
+
+    assert session.launch_build(job, {'b': 1}) == 'queue/item/1/'
+    assert session.params_cache.get(job + '/') == {'a': None, 'b': None}
+    assert build_paths(local_server) == [
+        '/job/thing/api/json',
+        '/job/thing/buildWithParameters',
+    ]
+
+    with pytest.raises(ValueError):
+        session.launch_build(job, {'c': 1})
+
+
+def test_launch_rejected_params(local_server):
+    """
+    Check that the cached parameters are refreshed and the build request sent
+    again when Jenkins rejects it.
+    """
+    local_server.routes['/job/thing/api/json'] = (200, {}, '{}')
+    local_server.routes['/job/thing/build'] = (
+        201,
+        {'Location': 'queue/item/1/'},
+        '',
+    )
+    job = local_server.url + '/job/thing'
+    session = Session(local_server.url, cache=False)
+    session.params_cache.set(job + '/', {'a': None})
+
+    assert session.launch_build(job) == 'queue/item/1/'
+    assert build_paths(local_server) == [
+        '/job/thing/buildWithParameters',
+        '/job/thing/api/json',
+        '/job/thing/build',
+    ]
+
+    # nothing changed, so there's nothing to retry
+    del local_server.requests[:]
+    del local_server.routes['/job/thing/build']
+    with pytest.raises(HTTPError):
+        session.launch_build(job)
+    assert build_paths(local_server) == [
+        '/job/thing/build',
+        '/job/thing/api/json',
+    ]
+
+
+def http_error(code, headers=None):
+    return HTTPError('http://example.com', code, 'Error', headers or {}, None)
+
+
+def test_retry_policy(monkeypatch):
+    """
+    Check which errors are retried and how long we wait before retrying.
+    """
+    policy = RetryPolicy(attempts=4, backoff=1, max_backoff=3, jitter=False)
+    assert policy.next_delay(1, http_error(503), 0) == 1
+    assert policy.next_delay(2, http_error(502), 0) == 2
+    assert policy.next_delay(3, http_error(500), 0) == 3
+    assert policy.next_delay(4, http_error(500), 0) is None
+    assert policy.next_delay(1, socket.timeout('timed out'), 0) == 1
+    assert policy.next_delay(1, socket.error('reset'), 0) == 1
+
+    assert policy.next_delay(1, http_error(404), 0) is None
+    assert policy.next_delay(1, http_error(403), 0) is None
+    assert policy.next_delay(1, ssl.SSLError(), 0) is None
+    assert policy.next_delay(1, ValueError(), 0) is None
+    assert policy.next_delay(1, http_error(503), 0, idempotent=False) is None
+
+    # don't go past max_elapsed
+    policy.max_elapsed = 10
+    assert policy.next_delay(3, http_error(503), 7) == 3
+    assert policy.next_delay(3, http_error(503), 7.5) is None
+
+    # Retry-After can be a number of seconds or a date
+    error = http_error(503, {'Retry-After': '5'})
+    assert policy.next_delay(1, error, 0) == 5
+    assert policy.next_delay(1, error, 6) is None
+    monkeypatch.setattr(time, 'time', lambda: 784111770)
+    error = http_error(429, {'Retry-After': 'Sun, 06 Nov 1994 08:49:37 GMT'})
+    assert policy.next_delay(1, error, 0) == 7
+
+    policy = RetryPolicy(backoff=1, max_backoff=30)
+    delays = [policy.next_delay(4, http_error(503), 0) for _ in range(100)]
+    assert all(4 <= delay <= 8 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_get_url_retry_policy(local_server, monkeypatch):
+    """
+    Check that get_url retries failed requests according to the policy.
+    """
+    delays = []
+    monkeypatch.setattr(time, 'sleep', delays.append)
+    responses = [
+        (503, {'Retry-After': '3'}, 'restarting'),
+        (502, {}, 'bad gateway'),
+        (200, {}, 'hello'),
+    ]
+    local_server.routes['/thing'] = lambda handler: responses.pop(0)
+    local_server.routes['/missing'] = (404, {}, 'not found')
+
+    retry = RetryPolicy(backoff=1, jitter=False)
+    session = Session(local_server.url, cache=False, retry=retry)
+    assert session.get_url(local_server.url + '/thing').text == 'hello'
+    assert delays == [3, 2]
+
+    # POSTs are only retried if they are idempotent
+    del delays[:]
+    responses[:] = [(503, {}, ''), (200, {}, 'hello')]
+    with pytest.raises(HTTPError):
+        session.get_url(local_server.url + '/thing', data={'a': 1})
+    assert delays == []
+    responses.insert(0, (503, {}, ''))
+    assert session.get_url(
+        local_server.url + '/thing', data={'a': 1}, idempotent=True
+    )
+    assert delays == [1]
+
+    del local_server.requests[:]
+    with pytest.raises(HTTPError):
+        session.get_url(local_server.url + '/missing')
+    assert len(local_server.requests) == 1
+
+
+def test_request_timeout(local_server):
+    """
+    Check that requests don't wait forever for a response.
+    """
+
+    def slow(handler):
+        time.sleep(1)
+        return 200, {}, 'slow'
+
+    local_server.routes['/slow'] = slow
+    retry = RetryPolicy(attempts=1)
+    session = Session(local_server.url, cache=False, retry=retry, timeout=0.2)
+    start = time.time()
+    with pytest.raises(socket.timeout):
+        session.get_url(local_server.url + '/slow')
+    assert time.time() - start < 1
+
+
+def test_abort(local_server):
+    """
+    Check the requests to cancel a queue item and stop a build.
+    """
+    local_server.routes['/queue/cancelItem'] = (404, {}, '')
+    local_server.routes['/job/thing/1/stop'] = (302, {'Location': '/'}, '')
+    session = Session(local_server.url, cache=False)
+    session.cancel_queue_item(local_server.url + '/queue/item/42/')
+    session.stop_build(local_server.url + '/job/thing/1/')
+    requests = [r[1:3] for r in local_server.requests if 'crumb' not in r[2]]
+    assert requests == [
+        ('POST', '/queue/cancelItem?id=42'),
+        ('POST', '/job/thing/1/stop'),
+    ]
+
+
+def gzip_compress(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as file:
+        file.write(data)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize(
+    'encoding, compress',
+    [
+        ('gzip', gzip_compress),
+        ('deflate', zlib.compress),
+        ('deflate', lambda data: zlib.compress(data)[2:-4]),  # raw deflate
+    ],
+)
+def test_compressed_response(local_server, encoding, compress):
+    """
+    Check that compressed responses are decompressed, also when streaming
+    them.
+    """
+    body = b'line of build output\n' * 50000
+    headers = {'Content-Encoding': encoding}
+    local_server.routes['/log'] = (200, headers, compress(body))
+    local_server.routes['/json'] = lambda handler: (
+        200,
+        headers,
+        compress(handler.headers['Accept-Encoding'].encode('utf-8')),
+    )
+    session = Session(local_server.url, cache=False)
+
+    assert session.get_url(local_server.url + '/json').text == 'gzip, deflate'
+
+    stream = session.get_url(local_server.url + '/log', stream=True)
+    blocks = [block.text for block in stream]
+    assert b''.join(blocks) == body
+    assert max(len(block) for block in blocks) <= 8192
+    assert stream.decoded_bytes == len(body)
+    assert stream.wire_bytes < len(body) / 10
+
+
+def test_compressed_debug(local_server, capsys, config):
+    """
+    Check that the debug output tells how much data was transferred.
+    """
+    launch_jenkins.CONFIG['debug'] = True
+    body = gzip_compress(b'a' * 10000)
+    local_server.routes['/log'] = (200, {'Content-Encoding': 'gzip'}, body)
+    session = Session(local_server.url, cache=False)
+    list(session.get_url(local_server.url + '/log', stream=True))
+    err = capsys.readouterr().err
+    msg = '/log: %d bytes on the wire, 10000 decoded (100%% saved)'
+    assert msg % len(body) in err
+
+
+def test_request_hooks(local_server):
+    """
+    Check that hooks get an event for every request, with the timings of the
+    connection when it's a new one.
+    """
+    events = []
+    local_server.routes['/job/thing/12/api/json'] = (200, {}, '{}')
+    local_server.routes['/job/thing/12/consoleText'] = (200, {}, 'a' * 10000)
+    session = Session(local_server.url, hooks=[events.append])
+    build = local_server.url + '/job/thing/12/'
+    session.get_url(build + 'api/json?tree=x')
+    for _ in session.get_url(build + 'consoleText', stream=True):
+        pass
+    with pytest.raises(HTTPError):
+        session.get_url(build + 'missing', retries=1)
+
+    crumb, api, log, missing = events
+    assert crumb.endpoint == '/crumbIssuer/api/xml'
+    assert crumb.dns is not None and crumb.connect is not None
+    assert crumb.tls is None
+    assert api.method == 'GET'
+    assert api.endpoint == '/job/*/N/api/json'
+    assert (api.status, api.bytes, api.retries) == (200, 2, 0)
+    assert api.dns is None  # reused connection
+    assert 0 < api.first_byte <= api.total
+    assert (log.endpoint, log.bytes) == ('/job/*/N/consoleText', 10000)
+    assert (missing.status, missing.bytes) == (404, 0)
+    assert isinstance(missing.error, HTTPError)
+    assert crumb.start < api.start < log.start < missing.start
+
+
+def test_stage_hooks(local_server):
+    """
+    Check that hooks get the stages of the pipelines whose status is checked.
+    """
+    events = []
+    stages = [{'id': '6', 'name': 'Build', 'status': 'IN_PROGRESS'}]
+    local_server.routes['/job/thing/12/wfapi/describe'] = (
+        200,
+        {},
+        json.dumps({'status': 'IN_PROGRESS', 'stages': stages}),
+    )
+    session = Session(local_server.url, hooks=[events.append])
+    build = local_server.url + '/job/thing/12/'
+    assert session.job_status(build) == (None, stages[0])
+    assert events[-1] == StageEvent(build, stages)
+    assert events[-2].endpoint == '/job/*/N/wfapi/describe'
+
+
+def test_queue_watcher(local_server):
+    """
+    Check that many queue items can be checked with one request to the
+    queue, and that only the items that left it are looked up on their own.
+    """
+    items = [{'id': 1, 'why': 'Waiting', 'task': {'url': 'x'}}, {'id': 2}]
+    local_server.routes['/queue/api/json'] = (
+        200,
+        {},
+        json.dumps({'items': items}),
+    )
+    build = local_server.url + '/job/thing/3/'
+    local_server.routes['/queue/item/3/api/json'] = (
+        200,
+        {},
+        json.dumps({'executable': {'url': build}}),
+    )
+    session = Session(local_server.url, cache=False)
+    watcher = QueueWatcher(session, tick=60)
+    locations = [local_server.url + '/queue/item/%d/' % i for i in (1, 2, 3)]
+    del local_server.requests[:]
+
+    for _ in range(3):
+        assert [watcher.get_queue_status(loc) for loc in locations] == [
+            None,
+            None,
+            build,
+        ]
+    paths = [path.partition('?')[0] for _, _, path in local_server.requests]
+    assert paths == ['/queue/api/json'] + ['/queue/item/3/api/json'] * 3
+    assert 'tree=items' in local_server.requests[0][2]
+    assert watcher.items['1']['why'] == 'Waiting'
+
+    watcher.tick = 0
+    watcher.get_queue_status(locations[0])
+    assert local_server.requests[-1][2].startswith('/queue/api/json')
+
+
+def test_wait_queue_watcher(local_server):
+    """
+    Check that threads waiting for queue items with a shared watcher send
+    one request to the queue per tick between them.
+    """
+    ready = []
+
+    def queue(handler):
+        items = [] if ready else [{'id': i} for i in range(8)]
+        return 200, {}, json.dumps({'items': items})
+
+    def item(handler):
+        number = handler.path.split('/')[3]
+        url = local_server.url + '/job/thing/%s/' % number
+        return 200, {}, json.dumps({'executable': {'url': url}})
+
+    local_server.routes['/queue/api/json'] = queue
+    for i in range(8):
+        local_server.routes['/queue/item/%d/api/json' % i] = item
+    session = Session(local_server.url, cache=False, pool_size=8)
+    session.queue_watcher = QueueWatcher(session, tick=0.1)
+    locations = [local_server.url + '/queue/item/%d/' % i for i in range(8)]
+    del local_server.requests[:]
+
+    def wait(location):
+        return session.wait_queue(location, interval=0.2)
+
+    pool = ThreadPool(8)
+    try:
+        result = pool.map_async(wait, locations)
+        time.sleep(0.5)
+        ready.append(True)
+        builds = result.get(5)
+    finally:
+        pool.close()
+    assert builds == [
+        local_server.url + '/job/thing/%d/' % i for i in range(8)
+    ]
+    paths = [path.partition('?')[0] for _, _, path in local_server.requests]
+    item_requests = [path for path in paths if path.startswith('/queue/item')]
+    assert len(item_requests) == 8
+    # one per tick instead of one per item (8 per tick)
+    assert paths.count('/queue/api/json') <= 6